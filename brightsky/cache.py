@@ -0,0 +1,206 @@
+import datetime
+import json
+import logging
+import zlib
+from urllib.parse import urlencode
+
+import falcon
+import redis
+from dateutil.tz import tzutc
+from falcon.util import http_date_to_dt
+
+from brightsky import compression, formats
+from brightsky.settings import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+KEY_PREFIX = 'brightsky:cache:'
+CACHED_HEADERS = [
+    'ETag', 'Last-Modified', 'Cache-Control', 'Vary', 'Content-Encoding']
+
+
+def get_redis():
+    if getattr(get_redis, '_url', None) != settings.REDIS_URL:
+        get_redis._client = redis.from_url(settings.REDIS_URL)
+        get_redis._url = settings.REDIS_URL
+    return get_redis._client
+
+
+def response_key(req):
+    params = sorted(req.params.items())
+    key = f'{KEY_PREFIX}response:{req.path}?{urlencode(params, doseq=True)}'
+    # Responses in other formats than JSON may be negotiated via the Accept
+    # header
+    format_ = formats.negotiate(req)
+    if format_ != 'json':
+        key += f'#{format_}'
+    # Compressed responses are cached as such
+    encoding = compression.negotiate(req)
+    if encoding is not None:
+        key += f'~{encoding}'
+    return key
+
+
+def source_tag(source_id):
+    return f'{KEY_PREFIX}source:{source_id}'
+
+
+def cache_ttl(sources, now=None):
+    """
+    Return for how many seconds a response built from the given sources may
+    be cached. Forecasts are valid until the next (hourly) MOSMIX issue.
+    """
+    if now is None:
+        now = datetime.datetime.now(tzutc())
+    next_issue = now.replace(minute=0, second=0, microsecond=0) + (
+        datetime.timedelta(hours=1))
+    ttls = {
+        'historical': settings.RESPONSE_CACHE_TTL_HISTORICAL,
+        'recent': settings.RESPONSE_CACHE_TTL_RECENT,
+        'current': settings.RESPONSE_CACHE_TTL_CURRENT,
+        'synop': settings.RESPONSE_CACHE_TTL_CURRENT,
+        'forecast': int((next_issue - now).total_seconds()) or 1,
+    }
+    return min(
+        (ttls[source['observation_type']] for source in sources),
+        default=None)
+
+
+def not_modified(req, etag, last_modified):
+    """
+    Return whether the client's copy of a response, as identified by the
+    request's conditional headers, matches the given validators.
+    `last_modified` must be a naive UTC datetime.
+    """
+    if req.if_none_match is not None:
+        # Entity tags of compressed representations match the uncompressed
+        # representation's tag
+        etags = {
+            compression.strip_etag_encoding(tag) for tag in req.if_none_match}
+        return '*' in etags or compression.strip_etag_encoding(etag) in etags
+    if req.if_modified_since is not None and last_modified is not None:
+        return last_modified <= req.if_modified_since
+    return False
+
+
+def invalidate_sources(source_ids):
+    """Delete all cached responses that used any of the given sources."""
+    if not settings.RESPONSE_CACHE:
+        return
+    client = get_redis()
+    tags = [source_tag(source_id) for source_id in set(source_ids)]
+    try:
+        keys = client.sunion(tags) if tags else set()
+        client.delete(*keys, *tags)
+    except redis.RedisError:
+        logger.exception("Failed to invalidate cached responses")
+    else:
+        logger.debug(
+            "Invalidated %d cached responses for %d sources",
+            len(keys), len(tags))
+
+
+def cache_stats():
+    """Return the cache's hits and misses, or None if Redis is down."""
+    try:
+        hits, misses = get_redis().mget(
+            f'{KEY_PREFIX}hits', f'{KEY_PREFIX}misses')
+    except redis.RedisError:
+        logger.exception("Failed to look up cache stats")
+        return None
+    return {'hits': int(hits or 0), 'misses': int(misses or 0)}
+
+
+class ResponseCache:
+    """
+    Middleware caching successful GET responses of all resources with a truthy
+    `cache_responses` attribute in Redis, shared between all web workers.
+
+    Responders must store the sources that went into a response in
+    `resp.context.sources`. They determine the response's TTL, and cached
+    responses are invalidated whenever the exporter updates one of them.
+    """
+
+    def process_resource(self, req, resp, resource, params):
+        if not settings.RESPONSE_CACHE or req.method != 'GET':
+            return
+        if not getattr(resource, 'cache_responses', False):
+            return
+        try:
+            key = response_key(req)
+        except ValueError:
+            # Invalid format, the resource will respond with an error
+            return
+        client = get_redis()
+        try:
+            cached, ttl = client.pipeline().get(key).ttl(key).execute()
+            client.incr(
+                f"{KEY_PREFIX}{'misses' if cached is None else 'hits'}")
+        except redis.RedisError:
+            logger.exception("Failed to look up cached response")
+            return
+        if cached is not None:
+            headers, _, data = cached.partition(b'\n')
+            try:
+                headers = json.loads(headers)
+            except ValueError:
+                # Stored in an earlier format
+                cached = None
+        if cached is None:
+            req.context.cache_key = key
+            return
+        content_type = headers.pop('Content-Type')
+        encoding = headers.pop('Content-Encoding', None)
+        resp.set_headers(headers)
+        if 'Cache-Control' in headers and ttl > 0:
+            resp.cache_control = [f'max-age={ttl}']
+        last_modified = headers.get('Last-Modified')
+        if 'ETag' in headers and not_modified(
+                req, headers['ETag'].strip('"'),
+                last_modified and http_date_to_dt(last_modified)):
+            resp.status = falcon.HTTP_NOT_MODIFIED
+        else:
+            resp.content_type = content_type
+            if encoding:
+                resp.set_header('Content-Encoding', encoding)
+                resp.data = data
+            else:
+                resp.data = zlib.decompress(data)
+        resp.complete = True
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        key = getattr(req.context, 'cache_key', None)
+        sources = getattr(resp.context, 'sources', None)
+        if not (key and req_succeeded and sources):
+            return
+        if resp.status != '200 OK':
+            return
+        # Serializes the media first, which may also set the content type
+        data = resp.data
+        if data is None:
+            # Streamed response
+            return
+        headers = {
+            'Content-Type': (
+                resp.content_type or resp.options.default_media_type),
+        }
+        for name in CACHED_HEADERS:
+            value = resp.get_header(name)
+            if value is not None:
+                headers[name] = value
+        if 'Content-Encoding' not in headers:
+            data = zlib.compress(data)
+        payload = json.dumps(headers).encode() + b'\n' + data
+        pipe = get_redis().pipeline()
+        pipe.set(key, payload, ex=cache_ttl(sources))
+        for source in sources:
+            tag = source_tag(source['id'])
+            pipe.sadd(tag, key)
+            # Cover the longest possible TTL of any response using the source
+            pipe.expire(tag, settings.RESPONSE_CACHE_TTL_HISTORICAL)
+        try:
+            pipe.execute()
+        except redis.RedisError:
+            logger.exception("Failed to cache response")
@@ -1,11 +1,15 @@
 import json
+import os
+import tempfile
+import textwrap
 from multiprocessing import cpu_count
 
 import click
 from falcon.testing import simulate_get
 from huey.consumer_options import ConsumerConfig
 
-from brightsky import db, tasks
+from brightsky import db, icons, metrics, rollups, sqlstats, tasks
+from brightsky.settings import settings
 from brightsky.utils import parse_date
 from brightsky.web import app, StandaloneApplication
 from brightsky.worker import huey
@@ -73,10 +77,65 @@ def clean():
     tasks.clean()
 
 
+@cli.command()
+@click.option(
+    '--start', type=str, callback=parse_date_arg,
+    help='First day to build rollups for (default: first record)')
+@click.option(
+    '--end', type=str, callback=parse_date_arg,
+    help='Last day to build rollups for (default: last record)')
+def rollup(start, end):
+    """Build daily weather rollups for existing records."""
+    rollups.backfill_weather_daily(
+        first_day=start and start.date(), last_day=end and end.date())
+
+
+@cli.command('icons')
+@click.option(
+    '--chunk-size', default=10000, help='Number of records per transaction')
+def icons_(chunk_size):
+    """Derive the stored weather icons anew, e.g. after changing thresholds."""
+    icons.rederive_icons(chunk_size=chunk_size)
+
+
+@cli.command('db-report')
+@click.option(
+    '--sort', type=click.Choice(['total', 'mean', 'p95', 'max', 'count']),
+    default='total', help='Statistic to rank statements by')
+@click.option('--limit', default=20, help='Number of statements to show')
+@click.option(
+    '--explain/--no-explain', default=False,
+    help='Show the captured query plans of slow statements')
+@click.option(
+    '--reset', is_flag=True, help='Clear the statistics after reporting')
+def db_report(sort, limit, explain, reset):
+    """Show the slowest SQL statements of all processes."""
+    sqlstats.sql_stats.flush()
+    rows = sqlstats.report(sort=sort, limit=limit)
+    if not rows:
+        click.echo('No SQL statistics recorded (see the SQL_STATS setting)')
+    for i, row in enumerate(rows, 1):
+        click.echo(
+            f"{i:>3}. total {row['total']:.3f}s, {row['count']} calls, "
+            f"mean {row['mean'] * 1000:.1f}ms, "
+            f"p95 <= {row['p95'] * 1000:.0f}ms, "
+            f"max {row['max'] * 1000:.1f}ms, "
+            f"{row['rows'] / row['count']:.1f} rows/call")
+        click.echo(f"     callers: {', '.join(row['callers'][:3])}")
+        click.echo(textwrap.indent(
+            textwrap.fill(row['statement'], 75), '     '))
+        if explain and row['plan']:
+            click.echo(textwrap.indent(row['plan'], '       | '))
+    if reset:
+        sqlstats.reset()
+
+
 @cli.command()
 def work():
     """Start brightsky worker."""
     huey.flush()
+    if settings.METRICS_WORKER_PORT:
+        metrics.serve_worker_metrics(huey, settings.METRICS_WORKER_PORT)
     config = ConsumerConfig(worker_type='thread', workers=2*cpu_count()+1)
     config.validate()
     consumer = huey.create_consumer(**config.values)
@@ -88,12 +147,32 @@ def work():
 @click.option(
     '--reload/--no-reload', default=False,
     help='Reload server on source code changes')
-def serve(bind, reload):
+@click.option(
+    '--workers', type=int,
+    help='Number of worker processes (default: 2 * CPUs + 1)')
+@click.option(
+    '--threads', type=int,
+    help='Number of threads per worker process (default: 1)')
+def serve(bind, reload, workers, threads):
     """Start brightsky API webserver."""
+    if reload:
+        workers = 1
+    workers = workers or settings.WEB_WORKERS or 2*cpu_count()+1
+    threads = threads or settings.WEB_THREADS
+    # Size the workers' connection pools (settings are reloaded in workers)
+    os.environ['BRIGHTSKY_WEB_THREADS'] = str(threads)
+    if settings.METRICS and workers > 1:
+        # Aggregate the metrics of all workers (metrics files of earlier runs
+        # must be removed from custom directories)
+        if not os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+            os.environ['PROMETHEUS_MULTIPROC_DIR'] = tempfile.mkdtemp(
+                prefix='brightsky-metrics-')
     StandaloneApplication(
         'brightsky.web:app',
         bind=bind,
-        workers=1 if reload else 2*cpu_count()+1,
+        workers=workers,
+        threads=threads,
+        worker_class='gthread' if threads > 1 else 'sync',
         reload=reload
     ).run()
 
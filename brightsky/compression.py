@@ -0,0 +1,145 @@
+import importlib.util
+import zlib
+
+import falcon
+
+from brightsky.settings import settings
+
+
+ENCODINGS = ['br', 'zstd', 'gzip']
+# Optional dependencies of the encodings
+REQUIRED_MODULES = {
+    'br': 'brotli',
+    'zstd': 'zstandard',
+}
+# Levels that keep compressing on the fly cheap
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 4
+ZSTD_LEVEL = 3
+
+
+def is_available(encoding):
+    module = REQUIRED_MODULES.get(encoding)
+    return module is None or importlib.util.find_spec(module) is not None
+
+
+def negotiate(req):
+    """
+    Return the content coding to compress the response to the given request
+    with, or None. Picks the coding with the highest quality in the
+    `Accept-Encoding` header, preferring the ones listed first in
+    `COMPRESSION_ENCODINGS` on ties.
+    """
+    header = req.get_header('Accept-Encoding')
+    if not header:
+        return None
+    qualities = {}
+    for coding in header.split(','):
+        coding, *params = coding.split(';')
+        quality = 1.
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.
+        qualities[coding.strip().lower()] = quality
+    wildcard = qualities.get('*', 0.)
+    best, best_quality = None, 0.
+    for encoding in settings.COMPRESSION_ENCODINGS:
+        if encoding not in ENCODINGS or not is_available(encoding):
+            continue
+        quality = qualities.get(encoding, wildcard)
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def compressor(encoding):
+    """
+    Return a `(compress, flush)` pair of functions compressing a stream of
+    bytes with the given content coding.
+    """
+    if encoding == 'gzip':
+        obj = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return obj.compress, obj.flush
+    elif encoding == 'br':
+        import brotli
+        obj = brotli.Compressor(quality=BROTLI_QUALITY)
+        return obj.process, obj.finish
+    elif encoding == 'zstd':
+        import zstandard
+        obj = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+        return obj.compress, obj.flush
+    raise ValueError(f"Unknown encoding '{encoding}'")
+
+
+def compress(data, encoding):
+    compress_, flush = compressor(encoding)
+    return compress_(data) + flush()
+
+
+def compress_stream(stream, encoding):
+    compress_, flush = compressor(encoding)
+    if hasattr(stream, 'read'):
+        stream = iter(lambda: stream.read(65536), b'')
+    for chunk in stream:
+        if (data := compress_(chunk)):
+            yield data
+    yield flush()
+
+
+def encoding_etag(etag, encoding):
+    """Return the entity tag of the given encoding of a representation."""
+    return f'{strip_etag_encoding(etag)}-{encoding}'
+
+
+def strip_etag_encoding(etag):
+    base, _, encoding = etag.rpartition('-')
+    return base if base and encoding in ENCODINGS else etag
+
+
+class CompressionMiddleware:
+    """
+    Middleware compressing response bodies of at least `COMPRESSION_MIN_SIZE`
+    bytes with the content coding negotiated through `negotiate()`.
+    Streamed responses are compressed on the fly.
+
+    Must be listed after `ResponseCache`, so that responses are compressed
+    before they are cached, and hot responses are only compressed once.
+    """
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        if not settings.COMPRESSION_ENCODINGS:
+            return
+        if req.method not in ('GET', 'POST'):
+            return
+        if resp.status not in (falcon.HTTP_OK, falcon.HTTP_NOT_MODIFIED):
+            return
+        if resp.get_header('Content-Encoding'):
+            # Served from the cache
+            return
+        vary = [v.strip() for v in (resp.get_header('Vary') or '').split(',')]
+        if 'Accept-Encoding' not in vary:
+            resp.vary = [v for v in vary if v] + ['Accept-Encoding']
+        encoding = negotiate(req)
+        if encoding is None:
+            return
+        # Each encoding is a representation of its own, even if the body ends
+        # up too small to be compressed
+        if (etag := resp.get_header('ETag')):
+            resp.etag = encoding_etag(etag.strip('"'), encoding)
+        if resp.status != falcon.HTTP_OK:
+            return
+        if resp.stream is not None:
+            resp.stream = compress_stream(resp.stream, encoding)
+        else:
+            data = resp.data
+            if data is None and resp.body is not None:
+                data = resp.body.encode()
+            if data is None or len(data) < settings.COMPRESSION_MIN_SIZE:
+                return
+            resp.body = None
+            resp.data = compress(data, encoding)
+        resp.set_header('Content-Encoding', encoding)
@@ -1,49 +1,129 @@
 import glob
+import itertools
 import logging
 import os
+import random
 import re
+import threading
+import time
 from contextlib import contextmanager, suppress
 from multiprocessing import cpu_count
 
 import psycopg2
-from psycopg2.extras import DictCursor
-from psycopg2.pool import ThreadedConnectionPool
+from psycopg2.pool import PoolError, ThreadedConnectionPool
 
+from brightsky import metrics
 from brightsky.settings import settings
+from brightsky.sqlstats import TimingCursor
 
 
 logger = logging.getLogger(__name__)
 
 
+def _create_pool(url, **kwargs):
+    if 'gunicorn' in os.getenv('SERVER_SOFTWARE', ''):
+        # Each of the web worker's threads handles one request at a time
+        minconn = 1
+        maxconn = max(settings.WEB_THREADS, 1)
+    else:
+        minconn = maxconn = 2*cpu_count()+1
+    return ThreadedConnectionPool(
+        minconn, maxconn, url, cursor_factory=TimingCursor, **kwargs)
+
+
+# Guards creating and discarding the pools, as web workers may be threaded
+_pools_lock = threading.Lock()
+
+
+def _get_pool():
+    with _pools_lock:
+        if not hasattr(get_connection, '_pool'):
+            get_connection._pool = _create_pool(settings.DATABASE_URL)
+        return get_connection._pool
+
+
+def _get_read_pool():
+    urls = tuple(settings.READ_DATABASE_URL)
+    with _pools_lock:
+        if getattr(get_connection, '_read_urls', None) != urls:
+            for pool in getattr(get_connection, '_read_pools', []):
+                pool.closeall()
+            get_connection._read_pools = [
+                _create_pool(
+                    url, options='-c default_transaction_read_only=on')
+                for url in urls]
+            get_connection._read_urls = urls
+        pools = get_connection._read_pools
+    if settings.READ_DATABASE_SELECTION == 'random':
+        return random.choice(pools)
+    return pools[next(_read_pool_counter) % len(pools)]
+
+
+def _discard_pool(pool):
+    with _pools_lock:
+        # Another thread may have replaced the pool already
+        if pool in getattr(get_connection, '_read_pools', []):
+            for read_pool in get_connection._read_pools:
+                read_pool.closeall()
+            del get_connection._read_pools
+            del get_connection._read_urls
+        elif getattr(get_connection, '_pool', None) is pool:
+            pool.closeall()
+            del get_connection._pool
+
+
+def _use_replica():
+    if not settings.READ_DATABASE_URL:
+        return False
+    last_write = getattr(get_connection, '_last_write', 0)
+    return time.time() - last_write >= settings.READ_YOUR_WRITES_WINDOW
+
+
+_read_pool_counter = itertools.count()
+
+
 @contextmanager
-def get_connection():
-    if not hasattr(get_connection, '_pool'):
-        if 'gunicorn' in os.getenv('SERVER_SOFTWARE', ''):
-            # gunicorn sync workers are single-threaded
-            minconn = 1
-        else:
-            minconn = 2*cpu_count()+1
-        get_connection._pool = ThreadedConnectionPool(
-            minconn, minconn, settings.DATABASE_URL, cursor_factory=DictCursor)
-    pool = get_connection._pool
-    conn = pool.getconn()
+def get_connection(read_only=False):
+    """
+    Check out a connection from the connection pool.
+
+    Read-only connections are routed to one of the `READ_DATABASE_URL`
+    replicas if any are configured. For `READ_YOUR_WRITES_WINDOW` seconds
+    after a connection to the primary database has been used, all reads from
+    this process will go to the primary database as well.
+    """
+    is_replica = read_only and _use_replica()
+    pool = _get_read_pool() if is_replica else _get_pool()
+    pool_name = 'replica' if is_replica else 'primary'
+    try:
+        conn = pool.getconn()
+    except PoolError:
+        # The pool never blocks, but fails when all connections are in use
+        metrics.DB_POOL_EXHAUSTED.labels(pool_name).inc()
+        raise
+    metrics.DB_CHECKOUTS.labels(pool_name).inc()
     try:
         with conn:
             yield conn
     except psycopg2.InterfaceError:
         logger.warning('Discarding dead connection pool')
-        pool.closeall()
-        del get_connection._pool
+        _discard_pool(pool)
         raise
     finally:
         if not pool.closed:
             pool.putconn(conn)
+        if not read_only:
+            get_connection._last_write = time.time()
 
 
-def fetch(*args, **kwargs):
+def fetch(*args, read_only=False, **kwargs):
+    """
+    Execute a query and return all rows. Pass `read_only=True` to allow
+    routing it to a replica (see `get_connection()`), which may lag behind.
+    """
     for retry in range(5):
         with suppress(psycopg2.InterfaceError):
-            with get_connection() as conn:
+            with get_connection(read_only=read_only) as conn:
                 with conn.cursor() as cur:
                     cur.execute(*args, **kwargs)
                     return cur.fetchall()
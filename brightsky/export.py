@@ -1,16 +1,36 @@
 import functools
 import logging
+from contextlib import nullcontext
 from threading import Lock
 
 from psycopg2 import sql
 from psycopg2.extras import execute_values
 
+from brightsky import metrics
+from brightsky.cache import invalidate_sources
 from brightsky.db import get_connection
+from brightsky.icons import (
+    derive_icons, icon_columns, TABLES as ICON_TABLES, update_icons)
+from brightsky.rollups import update_weather_daily, utc_day
 
 
 logger = logging.getLogger(__name__)
 
 
+def touch_sources(conn, source_ids):
+    """Record that the records of the given sources have changed."""
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            INSERT INTO sources_modified (source_id, last_modified)
+            SELECT source_id, current_timestamp
+            FROM unnest(%s::int[]) source_id
+            ON CONFLICT (source_id) DO UPDATE SET
+                last_modified = EXCLUDED.last_modified
+            """,
+            (sorted(set(source_ids)),))
+
+
 class DBExporter:
 
     # The ON CONFLICT clause won't change anything in most cases, but it
@@ -37,14 +57,19 @@ class DBExporter:
     """
     WEATHER_TABLE = 'weather'
     UPDATE_WEATHER_STMT = sql.SQL("""
-        INSERT INTO {weather_table} (timestamp, source_id, {fields})
+        INSERT INTO {weather_table} (timestamp, source_id, {fields}, icon)
         VALUES %s
         ON CONFLICT
             ON CONSTRAINT {constraint} DO UPDATE SET
-                {conflict_updates};
+                {conflict_updates},
+                icon = {icon_update}
+        RETURNING {icon_columns}, icon IS NULL;
     """)
     UPDATE_WEATHER_CONFLICT_UPDATE = '{field} = EXCLUDED.{field}'
+    # Condition for an updated field to take the value of the exported record
+    UPDATE_WEATHER_CONFLICT_TAKES_EXPORTED = None
     UPDATE_WEATHER_CLEANUP = None
+    UPDATE_DAILY_ROLLUPS = True
     SOURCE_FIELDS = [
         'observation_type', 'lat', 'lon', 'height', 'dwd_station_id',
         'wmo_station_id', 'station_name']
@@ -64,6 +89,7 @@ class DBExporter:
             self.update_weather(conn, source_map, records)
             if fingerprint:
                 self.update_parsed_files(conn, fingerprint)
+        invalidate_sources(source_map.values())
 
     def prepare_records(self, records):
         return records
@@ -104,6 +130,13 @@ class DBExporter:
     def update_weather(self, conn, source_map, records):
         for r in records:
             r['source_id'] = source_map[r['source']]
+        touched_days = {
+            (r['source_id'], utc_day(r['timestamp'])) for r in records}
+        icon_source_map = self.make_icon_source_map(source_map)
+        self.derive_icons(records, icon_source_map)
+        # Rows whose icon inputs were merged with the fields of earlier
+        # exports, and whose icons must be derived from the rows as stored
+        icon_rows = {}
         for fields, records in self.make_batches(records).items():
             logger.info(
                 "Exporting %d records with fields %s",
@@ -118,18 +151,84 @@ class DBExporter:
                         field=sql.Identifier(f),
                         weather_table=sql.Identifier(self.WEATHER_TABLE))
                     for f in fields),
+                icon_update=self.make_icon_update(fields),
+                icon_columns=sql.SQL(', ').join(
+                    sql.Identifier(c) for c in icon_columns(
+                        *ICON_TABLES[self.WEATHER_TABLE])),
             )
             template = sql.SQL(
-                "(%(timestamp)s, %(source_id)s, {values})"
+                "(%(timestamp)s, %(source_id)s, {values}, "
+                "%(icon)s::weather_icon)"
             ).format(
                 values=sql.SQL(', ').join(
                     sql.Placeholder(f) for f in fields),
             )
             with conn.cursor() as cur:
-                execute_values(cur, stmt, records, template, page_size=1000)
+                rows = execute_values(
+                    cur, stmt, records, template, page_size=1000, fetch=True)
+            for row in rows:
+                if row[-1]:
+                    icon_rows[(row[0], row[1])] = row
+                else:
+                    icon_rows.pop((row[0], row[1]), None)
+        if icon_rows:
+            update_icons(
+                conn, self.WEATHER_TABLE, icon_rows.values(), icon_source_map)
+        if self.UPDATE_DAILY_ROLLUPS:
+            update_weather_daily(conn, touched_days)
+        touch_sources(conn, source_map.values())
         if self.UPDATE_WEATHER_CLEANUP:
             with conn.cursor() as cur:
-                cur.execute(self.UPDATE_WEATHER_CLEANUP)
+                with self.cleanup_timer():
+                    cur.execute(self.UPDATE_WEATHER_CLEANUP)
+
+    def cleanup_timer(self):
+        return nullcontext()
+
+    def derive_icons(self, records, source_map):
+        """Set the icons of the given records, as if they were stored as is."""
+        names = icon_columns(*ICON_TABLES[self.WEATHER_TABLE])
+        icons = derive_icons(
+            {name: [r.get(name) for r in records] for name in names},
+            source_map, *ICON_TABLES[self.WEATHER_TABLE])
+        for r, icon in zip(records, icons):
+            r['icon'] = icon
+
+    def make_icon_update(self, fields):
+        """
+        Return the SQL for the icon of a row updated with a batch of records
+        with the given fields. It is the icon derived from the exported record
+        if its icon inputs are all taken from that record, the stored icon if
+        none are, and NULL, i.e. to be derived from the row as stored,
+        otherwise.
+        """
+        input_fields = icon_columns(*ICON_TABLES[self.WEATHER_TABLE])[2:]
+        if not any(field in fields for field in input_fields):
+            return sql.SQL('{weather_table}.icon').format(
+                weather_table=sql.Identifier(self.WEATHER_TABLE))
+        conditions = []
+        for field in input_fields:
+            if field not in fields:
+                template = '{weather_table}.{field} IS NULL'
+            elif self.UPDATE_WEATHER_CONFLICT_TAKES_EXPORTED:
+                template = self.UPDATE_WEATHER_CONFLICT_TAKES_EXPORTED
+            else:
+                continue
+            conditions.append(sql.SQL(template).format(
+                field=sql.Identifier(field),
+                weather_table=sql.Identifier(self.WEATHER_TABLE)))
+        if not conditions:
+            return sql.SQL('EXCLUDED.icon')
+        return sql.SQL('CASE WHEN {conditions} THEN EXCLUDED.icon END').format(
+            conditions=sql.SQL(' AND ').join(conditions))
+
+    def make_icon_source_map(self, source_map):
+        lat = self.SOURCE_FIELDS.index('lat')
+        lon = self.SOURCE_FIELDS.index('lon')
+        return {
+            source_id: {'id': source_id, 'lat': key[lat], 'lon': key[lon]}
+            for key, source_id in source_map.items()
+        }
 
     def make_batches(self, records):
         batches = {}
@@ -165,8 +264,11 @@ class SYNOPExporter(DBExporter):
     WEATHER_TABLE = 'synop'
     UPDATE_WEATHER_CONFLICT_UPDATE = (
         '{field} = COALESCE(EXCLUDED.{field}, {weather_table}.{field})')
+    UPDATE_WEATHER_CONFLICT_TAKES_EXPORTED = (
+        '(EXCLUDED.{field} IS NOT NULL OR {weather_table}.{field} IS NULL)')
     UPDATE_WEATHER_CLEANUP = (
         'REFRESH MATERIALIZED VIEW CONCURRENTLY current_weather')
+    UPDATE_DAILY_ROLLUPS = False
 
     ELEMENT_FIELDS = [
         'cloud_cover', 'condition', 'dew_point', 'precipitation_10',
@@ -201,3 +303,6 @@ class SYNOPExporter(DBExporter):
     def update_weather(self, *args, **kwargs):
         with self.synop_update_lock:
             super().update_weather(*args, **kwargs)
+
+    def cleanup_timer(self):
+        return metrics.CURRENT_WEATHER_REFRESH_DURATION.time()
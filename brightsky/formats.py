@@ -0,0 +1,158 @@
+import csv
+import datetime
+import importlib.util
+import io
+import json
+
+import falcon
+from falcon.media import BaseHandler
+
+
+MEDIA_ARROW_STREAM = 'application/vnd.apache.arrow.stream'
+MEDIA_CSV = 'text/csv; charset=utf-8'
+
+FORMATS = {
+    'json': falcon.MEDIA_JSON,
+    'msgpack': falcon.MEDIA_MSGPACK,
+    'csv': MEDIA_CSV,
+    'arrow': MEDIA_ARROW_STREAM,
+}
+# Formats holding a single table, see `to_columns()`
+TABULAR_FORMATS = ['csv', 'arrow']
+# Formats encoding datetimes themselves, rather than ISO 8601 strings
+DATETIME_FORMATS = ['arrow']
+# Optional dependencies of the formats
+REQUIRED_MODULES = {
+    'msgpack': 'msgpack',
+    'arrow': 'pyarrow',
+}
+
+
+def is_available(format_):
+    module = REQUIRED_MODULES.get(format_)
+    return module is None or importlib.util.find_spec(module) is not None
+
+
+def negotiate(req):
+    """
+    Return the name of the response format requested via the `format`
+    parameter or, failing that, the `Accept` header. Defaults to JSON.
+    """
+    format_ = req.get_param('format')
+    if format_ is not None:
+        format_ = format_.lower()
+        if format_ not in FORMATS:
+            raise ValueError(f"'format' must be in {list(FORMATS)}")
+        if not is_available(format_):
+            raise ValueError(
+                f"The {format_} format requires the "
+                f"{REQUIRED_MODULES[format_]} package")
+        return format_
+    available = {
+        media_type.split(';')[0]: name
+        for name, media_type in FORMATS.items() if is_available(name)}
+    # Ties go to the last media type, so list JSON last
+    preferred = req.client_prefers(list(available)[::-1])
+    return available.get(preferred, 'json')
+
+
+def to_columns(rows):
+    """
+    Turn a list of records (or a single record) into a dict of columns, with
+    `None` for fields missing in some of the records.
+    """
+    if isinstance(rows, dict):
+        rows = [rows]
+    names = list(dict.fromkeys(name for row in rows for name in row))
+    return {name: [row.get(name) for row in rows] for name in names}
+
+
+def media_handlers():
+    handlers = {
+        MEDIA_ARROW_STREAM: ArrowHandler(),
+        MEDIA_CSV: CSVHandler(),
+    }
+    if is_available('msgpack'):
+        handlers[falcon.MEDIA_MSGPACK] = falcon.media.MessagePackHandler()
+    return handlers
+
+
+class CSVHandler(BaseHandler):
+    """
+    Serialize a `{'columns': ..., 'sources': ...}` table as CSV. Sources are
+    left out, and dicts (i.e. `fallback_source_ids`) are JSON-encoded.
+    """
+
+    def deserialize(self, stream, content_type, content_length):
+        raise NotImplementedError
+
+    def serialize(self, media, content_type):
+        columns = media['columns']
+        buf = io.StringIO()
+        writer = csv.writer(buf, lineterminator='\n')
+        writer.writerow(columns)
+        writer.writerows(
+            [
+                json.dumps(v, separators=(',', ':'))
+                if isinstance(v, dict) else v
+                for v in row
+            ]
+            for row in zip(*columns.values()))
+        return buf.getvalue().encode()
+
+
+class ArrowHandler(BaseHandler):
+    """
+    Serialize a `{'columns': ..., 'sources': ..., 'timezone': ...}` table as
+    an Arrow IPC stream with typed columns. The sources are stored as JSON in
+    the schema metadata. Timestamps may be aware datetimes or ISO 8601
+    strings.
+    """
+
+    TIMESTAMP_FIELDS = ['timestamp', 'first_record', 'last_record']
+    DICTIONARY_FIELDS = ['condition', 'icon', 'observation_type']
+    INT16_FIELDS = [
+        'cloud_cover', 'relative_humidity', 'wind_direction',
+        'wind_gust_direction']
+    FLOAT64_FIELDS = ['lat', 'lon', 'distance']
+
+    def deserialize(self, stream, content_type, content_length):
+        raise NotImplementedError
+
+    def serialize(self, media, content_type):
+        import pyarrow as pa
+        timezone = media.get('timezone') or 'UTC'
+        arrays = {
+            name: self.to_array(pa, name, values, timezone)
+            for name, values in media['columns'].items()}
+        metadata = {'sources': json.dumps(media.get('sources'))}
+        table = pa.table(arrays, metadata=metadata)
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return sink.getvalue().to_pybytes()
+
+    def to_array(self, pa, name, values, timezone):
+        field = name.rsplit('_', 1)[0] if name[-2:].isdigit() else name
+        if name in self.TIMESTAMP_FIELDS:
+            if isinstance(next(filter(None, values), None), str):
+                values = [
+                    v if v is None else datetime.datetime.fromisoformat(v)
+                    for v in values]
+            return pa.array(values, type=pa.timestamp('s', tz=timezone))
+        elif name in self.DICTIONARY_FIELDS:
+            return pa.array(values, type=pa.string()).dictionary_encode()
+        elif field in self.INT16_FIELDS:
+            return pa.array(values, type=pa.int16())
+        elif name in self.FLOAT64_FIELDS:
+            return pa.array(values, type=pa.float64())
+        elif name == 'fallback_source_ids':
+            return pa.array(
+                [v if v is None else list(v.items()) for v in values],
+                type=pa.map_(pa.string(), pa.int32()))
+        array = pa.array(values)
+        if pa.types.is_floating(array.type):
+            return array.cast(pa.float32())
+        elif pa.types.is_integer(array.type):
+            return array.cast(pa.int32())
+        return array
@@ -0,0 +1,161 @@
+import logging
+
+from psycopg2.extras import execute_values
+
+from brightsky import metrics
+from brightsky.db import get_connection
+from brightsky.settings import settings
+from brightsky.sun import sun_table
+
+
+logger = logging.getLogger(__name__)
+
+
+ICONS = [
+    'clear-day', 'clear-night', 'partly-cloudy-day', 'partly-cloudy-night',
+    'cloudy', 'fog', 'wind', 'rain', 'sleet', 'snow', 'hail', 'thunderstorm']
+
+# Precipitation and wind speed fields of the tables with stored icons
+TABLES = {
+    'weather': ('precipitation', 'wind_speed'),
+    'synop': ('precipitation_10', 'wind_speed_10'),
+}
+
+
+def icon_columns(precipitation_field, wind_speed_field):
+    """Return the columns that `derive_icons()` expects."""
+    return [
+        'source_id', 'timestamp', 'condition', precipitation_field,
+        wind_speed_field, 'cloud_cover']
+
+
+def derive_icons(
+        columns, source_map, precipitation_field='precipitation',
+        wind_speed_field='wind_speed'):
+    """
+    Return the icons of the records given as columns (see `icon_columns()`),
+    derived in a single pass. Values must be in SI units.
+    """
+    rain_threshold = settings.ICON_RAIN_THRESHOLD
+    wind_threshold = settings.ICON_WIND_THRESHOLD
+    cloudy_threshold = settings.ICON_CLOUDY_THRESHOLD
+    partly_cloudy_threshold = settings.ICON_PARTLY_CLOUDY_THRESHOLD
+    is_daytime = sun_table.is_daytime
+    names = icon_columns(precipitation_field, wind_speed_field)
+    icons = []
+    for (source_id, timestamp, condition, precipitation, wind_speed,
+            cloud_cover) in zip(*map(columns.get, names)):
+        if condition in ('fog', 'sleet', 'snow', 'hail', 'thunderstorm'):
+            icons.append(condition)
+        # Don't show 'rain' icon for little precipitation, and do show 'rain'
+        # icon when condition is None but there is significant precipitation
+        elif (condition == 'rain' and precipitation is None) or (
+                (precipitation or 0) > rain_threshold):
+            icons.append('rain')
+        elif (wind_speed or 0) > wind_threshold:
+            icons.append('wind')
+        elif (cloud_cover or 0) >= cloudy_threshold:
+            icons.append('cloudy')
+        else:
+            daytime = (
+                'day' if is_daytime(source_map[source_id], timestamp)
+                else 'night')
+            if (cloud_cover or 0) >= partly_cloudy_threshold:
+                icons.append(f'partly-cloudy-{daytime}')
+            else:
+                icons.append(f'clear-{daytime}')
+    return icons
+
+
+def complete_icons(
+        columns, source_map, precipitation_field='precipitation',
+        wind_speed_field='wind_speed'):
+    """
+    Return the icons of the records given as columns, like `derive_icons()`,
+    but keep the icons stored at ingestion (in the `icon` column). Only
+    records without a stored icon, or whose icon inputs were filled from a
+    fallback source (as per the `fallback_source_ids` column), are derived.
+    """
+    names = icon_columns(precipitation_field, wind_speed_field)
+    input_fields = names[2:]
+    n = len(columns['source_id'])
+    stored = columns.get('icon') or [None] * n
+    fallbacks = columns.get('fallback_source_ids') or [None] * n
+    missing = [
+        i for i, (icon, fallback_source_ids) in enumerate(
+            zip(stored, fallbacks))
+        if icon is None or (
+            fallback_source_ids and
+            any(f in fallback_source_ids for f in input_fields))
+    ]
+    icons = list(stored)
+    if missing:
+        derived = derive_icons(
+            {name: [columns[name][i] for i in missing] for name in names},
+            source_map, precipitation_field, wind_speed_field)
+        for i, icon in zip(missing, derived):
+            icons[i] = icon
+    return icons
+
+
+def update_icons(conn, table, rows, source_map):
+    """
+    Derive and store the icons of the given rows of `table`, which must hold
+    the `icon_columns()` of the table's records as stored.
+    """
+    columns = icon_columns(*TABLES[table])
+    rows = list(rows)
+    icons = derive_icons(
+        {name: [row[i] for row in rows] for i, name in enumerate(columns)},
+        source_map, *TABLES[table])
+    with conn.cursor() as cur:
+        execute_values(
+            cur,
+            f"""
+            UPDATE {table} SET icon = v.icon::weather_icon
+            FROM (VALUES %s) AS v(source_id, timestamp, icon)
+            WHERE
+                {table}.source_id = v.source_id AND
+                {table}.timestamp = v.timestamp AND
+                {table}.icon IS DISTINCT FROM v.icon::weather_icon
+            """,
+            [(row[0], row[1], icon) for row, icon in zip(rows, icons)],
+            page_size=1000)
+
+
+def rederive_icons(chunk_size=10000):
+    """
+    Derive the stored icons of all weather and SYNOP records anew. Must be
+    run whenever the `ICON_*` thresholds change.
+    """
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute('SELECT id, lat, lon FROM sources')
+            source_map = {row['id']: dict(row) for row in cur.fetchall()}
+            for table in TABLES:
+                columns = ', '.join(icon_columns(*TABLES[table]))
+                last_key = (-1, '-infinity')
+                updated = 0
+                while True:
+                    cur.execute(
+                        f"""
+                        SELECT {columns}
+                        FROM {table}
+                        WHERE (source_id, timestamp) > (%s, %s)
+                        ORDER BY source_id, timestamp
+                        LIMIT %s
+                        """,
+                        (*last_key, chunk_size))
+                    rows = cur.fetchall()
+                    if not rows:
+                        break
+                    update_icons(conn, table, rows, source_map)
+                    conn.commit()
+                    updated += len(rows)
+                    last_key = (rows[-1][0], rows[-1][1])
+                logger.info(
+                    'Derived icons of %d %s records', updated, table)
+            with metrics.CURRENT_WEATHER_REFRESH_DURATION.time():
+                cur.execute(
+                    'REFRESH MATERIALIZED VIEW CONCURRENTLY current_weather')
+            conn.commit()
@@ -0,0 +1,112 @@
+import os
+import time
+
+import falcon
+from prometheus_client import (
+    CollectorRegistry, CONTENT_TYPE_LATEST, Counter, generate_latest,
+    Histogram, multiprocess, start_http_server, values)
+from prometheus_client.core import GaugeMetricFamily
+
+from brightsky.settings import settings
+
+
+# The value class is chosen when prometheus_client is first imported, which
+# may be before `serve` asked for multi-process mode by setting the
+# environment variable. This module is reloaded in each web worker.
+if (os.getenv('PROMETHEUS_MULTIPROC_DIR') and
+        values.ValueClass is values.MutexValue):
+    values.ValueClass = values.get_value_class()
+
+# Our own registry, as this module is reloaded in each web worker and metrics
+# cannot be registered twice
+REGISTRY = CollectorRegistry()
+
+REQUESTS = Counter(
+    'brightsky_requests', 'Number of handled API requests',
+    ['resource', 'method', 'status'], registry=REGISTRY)
+REQUEST_DURATION = Histogram(
+    'brightsky_request_duration_seconds', 'Duration of API requests',
+    ['resource'], registry=REGISTRY)
+DB_CHECKOUTS = Counter(
+    'brightsky_db_checkouts', 'Number of connections checked out',
+    ['pool'], registry=REGISTRY)
+DB_POOL_EXHAUSTED = Counter(
+    'brightsky_db_pool_exhausted',
+    'Number of failed checkouts from a pool without free connections',
+    ['pool'], registry=REGISTRY)
+PARSE_DURATION = Histogram(
+    'brightsky_parse_duration_seconds',
+    'Duration of downloading and parsing a file', ['parser'],
+    buckets=(.1, .5, 1., 5., 10., 30., 60., 120., 300., 600.),
+    registry=REGISTRY)
+EXPORT_DURATION = Histogram(
+    'brightsky_export_duration_seconds',
+    'Duration of exporting the records of a file', ['parser'],
+    buckets=(.1, .5, 1., 5., 10., 30., 60., 120., 300., 600.),
+    registry=REGISTRY)
+PARSED_RECORDS = Counter(
+    'brightsky_parsed_records', 'Number of parsed records', ['parser'],
+    registry=REGISTRY)
+CURRENT_WEATHER_REFRESH_DURATION = Histogram(
+    'brightsky_current_weather_refresh_duration_seconds',
+    'Duration of refreshing the current weather view', registry=REGISTRY)
+
+
+def collect():
+    """
+    Return the metrics of this process, or of all web workers when running
+    in multi-process mode, in the Prometheus text format.
+    """
+    registry = REGISTRY
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry)
+
+
+class HueyCollector:
+    """Collect the queue depth and the held task locks of the worker."""
+
+    def __init__(self, huey):
+        self.huey = huey
+
+    def collect(self):
+        yield GaugeMetricFamily(
+            'brightsky_queue_depth', 'Number of pending tasks',
+            value=self.huey.pending_count())
+        lock_prefix = f'{self.huey.name}.lock.'.encode()
+        yield GaugeMetricFamily(
+            'brightsky_task_locks', 'Number of held task locks',
+            value=sum(
+                1 for key in self.huey.storage.result_items()
+                if key.startswith(lock_prefix)))
+
+
+def serve_worker_metrics(huey, port):
+    """Serve the worker's metrics on the given port from a thread."""
+    REGISTRY.register(HueyCollector(huey))
+    start_http_server(port, registry=REGISTRY)
+
+
+class MetricsMiddleware:
+    """Count API requests and observe their duration per resource."""
+
+    def process_request(self, req, resp):
+        req.context.metrics_start = time.perf_counter()
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        duration = time.perf_counter() - req.context.metrics_start
+        name = type(resource).__name__ if resource is not None else 'None'
+        REQUESTS.labels(name, req.method, resp.status[:3]).inc()
+        REQUEST_DURATION.labels(name).observe(duration)
+
+
+class MetricsResource:
+
+    cache_responses = False
+
+    def on_get(self, req, resp):
+        if not settings.METRICS:
+            raise falcon.HTTPNotFound()
+        resp.content_type = CONTENT_TYPE_LATEST
+        resp.data = collect()
@@ -18,8 +18,9 @@ from brightsky.db import fetch
 from brightsky.export import DBExporter, SYNOPExporter
 from brightsky.settings import settings
 from brightsky.units import (
-    celsius_to_kelvin, current_observations_weather_code_to_condition,
-    eighths_to_percent, hpa_to_pa, km_to_m, kmh_to_ms, minutes_to_seconds,
+    celsius_to_kelvin, convert_column, convert_fields,
+    current_observations_weather_code_to_condition, eighths_to_percent,
+    hpa_to_pa, km_to_m, kmh_to_ms, minutes_to_seconds,
     synop_current_weather_code_to_condition,
     synop_form_of_precipitation_code_to_condition,
     synop_past_weather_code_to_condition)
@@ -93,6 +94,9 @@ class MOSMIXParser(Parser):
         'VV': 'visibility',
         'ww': 'condition',
     }
+    CONVERTERS = {
+        'condition': synop_current_weather_code_to_condition,
+    }
 
     def parse(self):
         # Wrap in process as it seems to be leaking memory somewhere in lxml
@@ -150,12 +154,14 @@ class MOSMIXParser(Parser):
             values_str = station_sel.css(
                 f'Forecast[elementName="{element}"] value::text'
             ).extract_first()
-            converter = getattr(self, f'parse_{column}', float)
-            records[column] = [
-                None if row[0] == '-' else converter(row[0])
+            values = [
+                None if row[0] == '-' else float(row[0])
                 for row in csv.reader(
                     re.sub(r'\s+', '\n', values_str.strip()).splitlines())
             ]
+            if converter := self.CONVERTERS.get(column):
+                values = convert_column(values, converter)
+            records[column] = values
             assert len(records[column]) == len(timestamps)
         base_record = {
             'observation_type': 'forecast',
@@ -173,10 +179,6 @@ class MOSMIXParser(Parser):
             for row in zip(*records.values())
         )
 
-    def parse_condition(self, value):
-        code = int(value.split('.')[0])
-        return synop_current_weather_code_to_condition(code)
-
     def sanitize_records(self, records):
         for r in records:
             if r['precipitation'] and r['precipitation'] < 0:
@@ -360,17 +362,20 @@ class CurrentObservationsParser(Parser):
                     wmo_station_id)
             # Skip row with German header titles
             next(reader)
-            for row in reader:
-                yield {
-                    'observation_type': 'current',
-                    'lat': lat,
-                    'lon': lon,
-                    'height': height,
-                    'dwd_station_id': dwd_station_id,
-                    'wmo_station_id': wmo_station_id,
-                    'station_name': station_name,
-                    **self.parse_row(row)
-                }
+            records = [self.parse_row(row) for row in reader]
+        convert_fields(records, self.CONVERTERS)
+        for record in records:
+            self.sanitize_record(record)
+            yield {
+                'observation_type': 'current',
+                'lat': lat,
+                'lon': lon,
+                'height': height,
+                'dwd_station_id': dwd_station_id,
+                'wmo_station_id': wmo_station_id,
+                'station_name': station_name,
+                **record
+            }
 
     def parse_row(self, row):
         record = {
@@ -384,15 +389,8 @@ class CurrentObservationsParser(Parser):
             f'{row[self.DATE_COLUMN]} {row[self.HOUR_COLUMN]}',
             '%d.%m.%y %H:%M'
         ).replace(tzinfo=tzutc())
-        self.convert_units(record)
-        self.sanitize_record(record)
         return record
 
-    def convert_units(self, record):
-        for element, converter in self.CONVERTERS.items():
-            if record[element] is not None:
-                record[element] = converter(record[element])
-
     def sanitize_record(self, record):
         if record['cloud_cover'] and record['cloud_cover'] > 100:
             self.logger.warning(
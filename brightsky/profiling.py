@@ -0,0 +1,161 @@
+import datetime
+import hmac
+import logging
+import os
+import random
+import re
+import sys
+import threading
+from collections import Counter
+from contextlib import contextmanager
+
+from brightsky.settings import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+PROFILE_HEADER = 'X-Brightsky-Profile'
+
+# Only one profile is sampled per process at a time
+_active = threading.Lock()
+
+
+class Sampler(threading.Thread):
+    """Periodically sample the stack of the given thread."""
+
+    def __init__(self, thread_id, interval):
+        super().__init__(name='brightsky-profiler', daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                break
+            self.stacks[format_stack(frame)] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def format_stack(frame):
+    """Return the stack of the given frame, outermost function first."""
+    names = []
+    while frame is not None:
+        module = frame.f_globals.get('__name__', '?')
+        names.append(f'{module}:{frame.f_code.co_name}')
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+def write_profile(stacks, name):
+    """
+    Write the sampled stacks in the folded format understood by
+    `flamegraph.pl`, speedscope and others, and return the file's path.
+    """
+    os.makedirs(settings.PROFILE_DIR, exist_ok=True)
+    timestamp = datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')
+    name = re.sub(r'[^\w.-]+', '_', name).strip('_')
+    path = os.path.join(
+        settings.PROFILE_DIR, f'{timestamp}-{os.getpid()}-{name}.folded')
+    with open(path, 'w') as f:
+        for stack, count in stacks.most_common():
+            f.write(f'{stack} {count}\n')
+    return path
+
+
+def should_profile(forced=False):
+    """
+    Return whether to profile a request or task. A share of `PROFILE_RATE`
+    of them is profiled, or all forced ones, as long as `PROFILE_DIR` is set.
+    """
+    if not settings.PROFILE_DIR:
+        return False
+    return forced or random.random() < settings.PROFILE_RATE
+
+
+class Profiler:
+    """
+    Sample the stack of the thread calling `start()` until `stop()` is
+    called, then write the profile to `PROFILE_DIR`.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.sampler = None
+
+    def start(self):
+        """Start sampling, unless another profile is already being taken."""
+        if not _active.acquire(blocking=False):
+            return False
+        self.sampler = Sampler(
+            threading.get_ident(), settings.PROFILE_INTERVAL)
+        self.sampler.start()
+        return True
+
+    def stop(self):
+        """Stop sampling and return the path of the written profile."""
+        self.sampler.stop()
+        _active.release()
+        try:
+            return write_profile(self.sampler.stacks, self.name)
+        except OSError:
+            logger.exception("Failed to write profile '%s'", self.name)
+
+
+@contextmanager
+def profile(name, forced=False):
+    """Profile the block if `should_profile()` says so."""
+    profiler = None
+    if should_profile(forced):
+        profiler = Profiler(name)
+        if not profiler.start():
+            profiler = None
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.stop()
+
+
+def is_profile_requested(req):
+    token = req.get_header(PROFILE_HEADER)
+    # Compare bytes, as compare_digest() rejects non-ASCII strings
+    return bool(
+        token and settings.PROFILE_TOKEN and
+        hmac.compare_digest(
+            token.encode(), settings.PROFILE_TOKEN.encode()))
+
+
+class ProfilingMiddleware:
+    """
+    Middleware profiling a share of `PROFILE_RATE` of all requests, and the
+    requests of admins who send the `PROFILE_TOKEN` in the
+    `X-Brightsky-Profile` header. The profile's file name is returned in the
+    same header to the latter.
+
+    Streamed response bodies are produced after the request was handled and
+    are not covered.
+    """
+
+    def process_request(self, req, resp):
+        requested = is_profile_requested(req)
+        if not should_profile(forced=requested):
+            return
+        profiler = Profiler(f'{req.method}-{req.path}')
+        if profiler.start():
+            req.context.profiler = profiler
+            req.context.profile_requested = requested
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        profiler = getattr(req.context, 'profiler', None)
+        if profiler is None:
+            return
+        path = profiler.stop()
+        if path and req.context.profile_requested:
+            resp.set_header(PROFILE_HEADER, os.path.basename(path))
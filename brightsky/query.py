@@ -1,127 +1,1259 @@
 import datetime
+import math
+import os
+import threading
+import time
+from array import array
+from collections import OrderedDict
 
-from dateutil.tz import tzutc
+import psycopg2
+from dateutil.relativedelta import relativedelta
+from dateutil.tz import tzfile, TZPATHS, tzutc
 
-from brightsky.db import fetch
+from brightsky import rollups, spatial
+from brightsky.db import fetch, get_connection
+from brightsky.settings import settings
+from brightsky.sun import sun_table
+from brightsky.timing import timed
+from brightsky.units import CONVERTERS, SQL_CONVERTERS
 
 
 def _make_dicts(rows):
     return [dict(row) for row in rows]
 
 
+WEATHER_OBSERVATION_TYPES = ['historical', 'recent', 'current', 'forecast']
+
+
 def weather(
         date, last_date=None, lat=None, lon=None, dwd_station_id=None,
-        wmo_station_id=None, source_id=None, max_dist=50000):
+        wmo_station_id=None, source_id=None, max_dist=50000, fields=None,
+        sources_rows=None):
+    """
+    Return the weather records of the given location, picking records from
+    the closest source and filling missing fields from other sources.
+    `fields` restricts the selected weather fields (default: all).
+
+    `sources_rows` may hold the sources as returned by `weather_sources()`
+    if they were looked up already. Otherwise, they are resolved within the
+    weather query where possible. The result's `candidate_sources` holds all
+    candidate sources, and its `modified` maps their IDs to when their
+    records last changed, as in `sources_modified()`.
+    """
+    sources_rows, rows, modified = _weather_rows(
+        date, last_date, lat=lat, lon=lon, dwd_station_id=dwd_station_id,
+        wmo_station_id=wmo_station_id, source_id=source_id,
+        max_dist=max_dist, fields=fields, sources_rows=sources_rows)
+    weather_rows = []
+    used_source_ids = set()
+    for row in rows:
+        if row['timestamp'] is None:
+            continue
+        row = dict(row)
+        for key in ('sources', 'modified_source_ids', 'last_modified'):
+            row.pop(key, None)
+        fallback_source_ids = row.pop('fallback_source_ids')
+        if fallback_source_ids is not None:
+            row['fallback_source_ids'] = fallback_source_ids
+            used_source_ids.update(fallback_source_ids.values())
+        used_source_ids.add(row['source_id'])
+        weather_rows.append(row)
+    return {
+        'weather': weather_rows,
+        'sources': [s for s in sources_rows if s['id'] in used_source_ids],
+        'candidate_sources': sources_rows,
+        'modified': modified,
+    }
+
+
+def weather_columns(
+        date, last_date=None, lat=None, lon=None, dwd_station_id=None,
+        wmo_station_id=None, source_id=None, max_dist=50000, fields=None,
+        sources_rows=None):
+    """
+    Like `weather()`, but return the weather records as columns, i.e. as a
+    dict mapping `timestamp`, `source_id`, each field and
+    `fallback_source_ids` to a list holding one value per record.
+    """
+    sources_rows, rows, modified = _weather_rows(
+        date, last_date, lat=lat, lon=lon, dwd_station_id=dwd_station_id,
+        wmo_station_id=wmo_station_id, source_id=source_id,
+        max_dist=max_dist, fields=fields, sources_rows=sources_rows)
+    names = [
+        'timestamp', 'source_id', *_weather_fields(fields), 'icon',
+        'fallback_source_ids']
+    rows = [row for row in rows if row['timestamp'] is not None]
+    # The rows start with the columns of `merged`, in the order of `names`
+    values = list(zip(*rows)) or [()] * len(names)
+    columns = {name: list(column) for name, column in zip(names, values)}
+    used_source_ids = set(columns['source_id'])
+    for fallback_source_ids in columns['fallback_source_ids']:
+        if fallback_source_ids is not None:
+            used_source_ids.update(fallback_source_ids.values())
+    return {
+        'weather': columns,
+        'sources': [s for s in sources_rows if s['id'] in used_source_ids],
+        'candidate_sources': sources_rows,
+        'modified': modified,
+    }
+
+
+def _weather_rows(date, last_date, fields=None, sources_rows=None, **kwargs):
+    date, last_date = _weather_date_range(date, last_date)
+    sources_kwargs = dict(
+        observation_types=WEATHER_OBSERVATION_TYPES, date=date,
+        last_date=last_date, **kwargs)
+    if sources_rows is None and not (
+            _sources_cache.enabled or settings.SOURCES_INDEX):
+        # Sources are resolved within the weather query
+        with timed('query'):
+            sources_rows, rows = _weather_with_sources(
+                fields=fields, **sources_kwargs)
+        return sources_rows, rows, _modified(rows[0])
+    if sources_rows is None:
+        sources_rows = sources(**sources_kwargs)['sources']
+    params = _source_ids_params(sources_rows)
+    params.update({
+        'date': date,
+        'last_date': last_date,
+        'expected_rows': _expected_rows(date, last_date),
+    })
+    # The validators are only attached to the first row (of which there is
+    # always one, even if there are no records)
+    sql = f"""
+        WITH {SOURCE_IDS_CTE},
+        {MODIFIED_CTE},
+        {_merged_weather_ctes(fields)}
+        SELECT
+            merged.*,
+            CASE WHEN row_number() OVER (ORDER BY merged.timestamp) = 1
+                THEN modified.modified_source_ids
+            END AS modified_source_ids,
+            CASE WHEN row_number() OVER (ORDER BY merged.timestamp) = 1
+                THEN modified.last_modified
+            END AS last_modified
+        FROM modified
+        LEFT JOIN merged ON true
+        ORDER BY merged.timestamp
+    """
+    with timed('query'):
+        rows = fetch(sql, params, read_only=True)
+    return sources_rows, rows, _modified(rows[0])
+
+
+def _weather_with_sources(date, last_date, fields=None, **kwargs):
+    sources_sql, order_by, params = _sources_query(
+        date=date, last_date=last_date, **kwargs)
+    params['expected_rows'] = _expected_rows(date, last_date)
+    # Resolve sources, select primary and fallback records, and fill missing
+    # fields all within one query. The sources are only attached to the first
+    # row (of which there is always one, even if there are no records).
+    sql = f"""
+        WITH sources_rows AS (
+            {sources_sql}
+        ),
+        ranked_sources AS (
+            SELECT
+                id,
+                observation_type,
+                row_number() OVER (ORDER BY {order_by}) AS position
+            FROM sources_rows
+        ),
+        source_ids AS (
+            SELECT
+                array(
+                    SELECT id FROM ranked_sources ORDER BY position
+                ) AS source_ids,
+                array(
+                    SELECT id
+                    FROM (
+                        SELECT DISTINCT ON (observation_type) id, position
+                        FROM ranked_sources
+                        ORDER BY observation_type, position
+                    ) first_of_type
+                    ORDER BY position
+                ) AS primary_source_ids
+        ),
+        {MODIFIED_CTE},
+        {_merged_weather_ctes(fields)}
+        SELECT
+            merged.*,
+            CASE WHEN row_number() OVER (ORDER BY merged.timestamp) = 1
+                THEN header.sources
+            END AS sources,
+            CASE WHEN row_number() OVER (ORDER BY merged.timestamp) = 1
+                THEN modified.modified_source_ids
+            END AS modified_source_ids,
+            CASE WHEN row_number() OVER (ORDER BY merged.timestamp) = 1
+                THEN modified.last_modified
+            END AS last_modified
+        FROM (
+            SELECT json_agg(sources_rows ORDER BY {order_by}) AS sources
+            FROM sources_rows
+        ) header
+        CROSS JOIN modified
+        LEFT JOIN merged ON true
+        ORDER BY merged.timestamp
+    """
+    rows = fetch(sql, params, read_only=True)
+    if rows[0]['sources'] is None:
+        raise LookupError("No sources match your criteria")
+    return _parse_sources_json(rows[0]['sources']), rows
+
+
+def _parse_sources_json(sources_rows):
+    for row in sources_rows:
+        for key in ('first_record', 'last_record'):
+            if row[key] is not None:
+                row[key] = datetime.datetime.fromisoformat(row[key])
+        # JSON drops the fractional part of whole numbers
+        for key in ('lat', 'lon', 'height', 'distance'):
+            if key in row:
+                row[key] = float(row[key])
+    return sources_rows
+
+
+def _weather_date_range(date, last_date):
     if not last_date:
         last_date = date + datetime.timedelta(days=1)
     if not date.tzinfo:
         date = date.replace(tzinfo=tzutc())
     if not last_date.tzinfo:
         last_date = last_date.replace(tzinfo=tzutc())
-    sources_rows = sources(
-        lat=lat, lon=lon, dwd_station_id=dwd_station_id, source_id=source_id,
-        wmo_station_id=wmo_station_id, max_dist=max_dist,
-        observation_types=['historical', 'recent', 'current', 'forecast'],
-        date=date, last_date=last_date)['sources']
+    return date, last_date
+
+
+def _weather_sources(date, last_date, sources_rows=None, **kwargs):
+    date, last_date = _weather_date_range(date, last_date)
+    if sources_rows is None:
+        sources_rows = sources(
+            observation_types=WEATHER_OBSERVATION_TYPES, date=date,
+            last_date=last_date, **kwargs)['sources']
+    return date, last_date, sources_rows
+
+
+def weather_sources(date, last_date=None, **kwargs):
+    """Return the candidate sources of `weather()`."""
+    return _weather_sources(date, last_date, **kwargs)[2]
+
+
+def sources_modified(sources_rows):
+    """Return when the records of each of the given sources last changed."""
+    rows = fetch(
+        """
+        SELECT source_id, last_modified
+        FROM sources_modified
+        WHERE source_id = ANY(%s)
+        """,
+        ([row['id'] for row in sources_rows],),
+        read_only=True)
+    return {row['source_id']: row['last_modified'] for row in rows}
+
+
+def _source_ids_params(sources_rows):
     primary_source_ids = {}
     for row in sources_rows:
         primary_source_ids.setdefault(row['observation_type'], row['id'])
-    primary_source_ids = list(primary_source_ids.values())
-    weather_rows = _weather(date, last_date, primary_source_ids)
-    source_ids = [row['id'] for row in sources_rows]
-    if len(weather_rows) < int((last_date - date).total_seconds()) // 3600:
-        weather_rows = _weather(date, last_date, source_ids)
-    _fill_missing_fields(weather_rows, date, last_date, source_ids)
-    used_source_ids = {row['source_id'] for row in weather_rows}
-    used_source_ids.update(
-        source_id
-        for row in weather_rows
-        for source_id in row.get('fallback_source_ids', {}).values())
     return {
-        'weather': weather_rows,
-        'sources': [s for s in sources_rows if s['id'] in used_source_ids],
+        'primary_source_ids': list(primary_source_ids.values()),
+        'source_ids': [row['id'] for row in sources_rows],
     }
 
 
-def _weather(date, last_date, source_id, not_null=None):
+SOURCE_IDS_CTE = """
+    source_ids AS (
+        SELECT
+            %(primary_source_ids)s::int[] AS primary_source_ids,
+            %(source_ids)s::int[] AS source_ids
+    )
+"""
+
+# The data of `sources_modified()`, for selecting it along with the records.
+# Expects a preceding `source_ids` CTE.
+MODIFIED_CTE = """
+    modified AS (
+        SELECT
+            array_agg(source_id) AS modified_source_ids,
+            array_agg(last_modified) AS last_modified
+        FROM sources_modified
+        WHERE source_id = ANY((SELECT source_ids FROM source_ids)::int[])
+    )
+"""
+
+
+def _modified(row):
+    return dict(zip(
+        row['modified_source_ids'] or [], row['last_modified'] or []))
+
+
+def _expected_rows(date, last_date):
+    return int((last_date - date).total_seconds()) // 3600
+
+
+# Not available in MOSMIX
+IGNORED_MISSING_FIELDS = {'wind_gust_direction', 'relative_humidity'}
+
+
+# Element columns of the weather table, in table order
+WEATHER_FIELDS = [
+    'precipitation', 'pressure_msl', 'sunshine', 'temperature',
+    'wind_direction', 'wind_speed', 'cloud_cover', 'dew_point',
+    'relative_humidity', 'visibility', 'wind_gust_direction',
+    'wind_gust_speed', 'condition']
+FALLBACK_FIELDS = [
+    f for f in WEATHER_FIELDS if f not in IGNORED_MISSING_FIELDS]
+# Columns of the weather table of type real
+REAL_FIELDS = [
+    'precipitation', 'temperature', 'wind_speed', 'dew_point',
+    'wind_gust_speed']
+# Fields that `WeatherResource.get_icon()` and `_icon_sql()` depend on
+ICON_FIELDS = ['cloud_cover', 'condition', 'precipitation', 'wind_speed']
+
+# Order of the bits in the weather table's `not_null_mask` column
+NOT_NULL_MASK_FIELDS = [
+    'cloud_cover', 'condition', 'dew_point', 'precipitation', 'pressure_msl',
+    'relative_humidity', 'sunshine', 'temperature', 'visibility',
+    'wind_direction', 'wind_speed', 'wind_gust_direction', 'wind_gust_speed']
+
+
+def _not_null_mask(fields):
+    mask = 0
+    for field in fields:
+        mask |= 1 << NOT_NULL_MASK_FIELDS.index(field)
+    return mask
+
+
+def _weather_fields(fields):
+    """Return the given weather fields in their canonical order."""
+    if fields is None:
+        return WEATHER_FIELDS
+    if (unknown := set(fields) - set(WEATHER_FIELDS)):
+        raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+    return [f for f in WEATHER_FIELDS if f in fields]
+
+
+def _fallback_fields(fields):
+    return [f for f in FALLBACK_FIELDS if f in _weather_fields(fields)]
+
+
+def weather_batch(locations, date, last_date=None, max_dist=50000):
+    """
+    Like `weather()` for a list of `(lat, lon)` locations, returning one
+    result per location. Locations without any sources get empty results.
+
+    Sources of all locations are resolved in one query, and all records of
+    these sources are fetched in one query. Picking records and filling
+    missing fields from fallback sources is then done per location.
+    """
+    date, last_date = _weather_date_range(date, last_date)
+    sources_by_location = _batch_sources(locations, max_dist, date, last_date)
+    source_ids = {
+        source['id']
+        for sources_rows in sources_by_location
+        for source in sources_rows
+    }
+    rows_by_source = {}
+    if source_ids:
+        sql = f"""
+            SELECT timestamp, source_id, {', '.join(WEATHER_FIELDS)}, icon
+            FROM weather
+            WHERE
+                timestamp BETWEEN %(date)s AND %(last_date)s AND
+                source_id = ANY(%(source_ids)s)
+        """
+        params = {
+            'date': date,
+            'last_date': last_date,
+            'source_ids': list(source_ids),
+        }
+        for row in fetch(sql, params, read_only=True):
+            rows_by_source.setdefault(row['source_id'], {})[
+                row['timestamp']] = dict(row)
+    expected_rows = _expected_rows(date, last_date)
+    results = []
+    for sources_rows in sources_by_location:
+        weather_rows = _merge_weather_rows(
+            rows_by_source, sources_rows, expected_rows)
+        used_source_ids = set()
+        for row in weather_rows:
+            used_source_ids.add(row['source_id'])
+            used_source_ids.update(row.get('fallback_source_ids', {}).values())
+        results.append({
+            'weather': weather_rows,
+            'sources': [
+                dict(s) for s in sources_rows if s['id'] in used_source_ids],
+        })
+    return results
+
+
+def _batch_sources(locations, max_dist, date, last_date):
+    if settings.SOURCES_INDEX:
+        index = _sources_cache.get_index()
+        return [
+            index.find(
+                lat, lon, max_dist=max_dist,
+                observation_types=WEATHER_OBSERVATION_TYPES, date=date,
+                last_date=last_date)
+            for lat, lon in locations
+        ]
+    # Same conditions and ordering as in _sources_query()
+    distance = """
+        earth_distance(
+            ll_to_earth(locations.lat, locations.lon),
+            ll_to_earth(sources.lat, sources.lon)
+        )
+    """
+    sql = f"""
+        SELECT locations.i, sources.*, round({distance}) AS distance
+        FROM
+            unnest(%(lats)s::float8[], %(lons)s::float8[])
+                WITH ORDINALITY AS locations(lat, lon, i)
+            JOIN sources ON (
+                earth_box(
+                    ll_to_earth(locations.lat, locations.lon),
+                    %(max_dist)s
+                ) @> ll_to_earth(sources.lat, sources.lon) AND
+                {distance} < %(max_dist)s AND
+                sources.observation_type IN %(observation_types)s AND
+                sources.last_record >= %(date)s AND
+                sources.first_record <= %(last_date)s
+            )
+        ORDER BY locations.i, sources.observation_type, distance
+    """
     params = {
+        'lats': [float(lat) for lat, _ in locations],
+        'lons': [float(lon) for _, lon in locations],
+        'max_dist': max_dist,
+        'observation_types': tuple(WEATHER_OBSERVATION_TYPES),
         'date': date,
         'last_date': last_date,
-        'source_id': source_id,
     }
-    where = "timestamp BETWEEN %(date)s AND %(last_date)s"
-    order_by = "timestamp"
-    if isinstance(source_id, list):
-        where += " AND source_id IN %(source_id_tuple)s"
-        order_by += ", array_position(%(source_id)s, source_id)"
-        params['source_id_tuple'] = tuple(source_id)
+    sources_by_location = [[] for _ in locations]
+    for row in fetch(sql, params, read_only=True):
+        row = dict(row)
+        sources_by_location[row.pop('i') - 1].append(row)
+    return sources_by_location
+
+
+def _merge_weather_rows(rows_by_source, sources_rows, expected_rows):
+    """Python equivalent of the `_merged_weather_ctes()` SQL."""
+
+    def first_rows(source_ids, condition=None):
+        # Rows of earlier sources override those of later sources
+        rows = {}
+        for source_id in reversed(source_ids):
+            for timestamp, row in rows_by_source.get(source_id, {}).items():
+                if condition is None or condition(row):
+                    rows[timestamp] = row
+        return rows
+
+    source_ids = _source_ids_params(sources_rows)
+    weather_rows = first_rows(source_ids['primary_source_ids'])
+    if len(weather_rows) < expected_rows:
+        weather_rows = first_rows(source_ids['source_ids'])
+    weather_rows = [weather_rows[t] for t in sorted(weather_rows)]
+    missing, min_date, max_date = _missing_fields(weather_rows)
+    fallback_rows = {}
+    if missing:
+        fallback_rows = first_rows(
+            source_ids['source_ids'],
+            lambda row: (
+                min_date <= row['timestamp'] <= max_date and
+                all(row[f] is not None for f in missing)))
+    return _fill_missing_fields(weather_rows, fallback_rows)
+
+
+def _missing_fields(weather_rows, fallback_fields=FALLBACK_FIELDS):
+    """
+    Return the fields missing in any of the given rows, and the time range of
+    the rows they are missing in.
+    """
+    incomplete = [
+        row for row in weather_rows
+        if any(row[f] is None for f in fallback_fields)]
+    if not incomplete:
+        return [], None, None
+    missing = [
+        f for f in fallback_fields
+        if any(row[f] is None for row in incomplete)]
+    min_date = min(row['timestamp'] for row in incomplete)
+    max_date = max(row['timestamp'] for row in incomplete)
+    return missing, min_date, max_date
+
+
+def _fill_missing_fields(
+        weather_rows, fallback_rows, fallback_fields=FALLBACK_FIELDS):
+    merged = []
+    for row in weather_rows:
+        row = dict(row)
+        fallback_row = fallback_rows.get(row['timestamp'])
+        null_fields = [f for f in fallback_fields if row[f] is None]
+        if fallback_row and null_fields:
+            for f in null_fields:
+                row[f] = fallback_row[f]
+            row['fallback_source_ids'] = {
+                f: fallback_row['source_id'] for f in null_fields}
+        merged.append(row)
+    return merged
+
+
+def weather_stream(
+        date, last_date=None, lat=None, lon=None, dwd_station_id=None,
+        wmo_station_id=None, source_id=None, max_dist=50000,
+        chunk_size=1000, fields=None, sources_rows=None):
+    """
+    Like `weather()`, but return a generator yielding the weather records in
+    chunks of `chunk_size`, which are read from a server-side cursor. Missing
+    fields are filled from fallback sources per chunk.
+
+    Only the source lookup happens right away, so that `LookupError` is raised
+    before any records are streamed. The returned sources are all candidate
+    sources, not only the ones used.
+    """
+    date, last_date, sources_rows = _weather_sources(
+        date, last_date, lat=lat, lon=lon, dwd_station_id=dwd_station_id,
+        wmo_station_id=wmo_station_id, source_id=source_id,
+        max_dist=max_dist, sources_rows=sources_rows)
+    params = {
+        **_source_ids_params(sources_rows),
+        'date': date,
+        'last_date': last_date,
+    }
+    with timed('query'):
+        row = fetch(
+            f"""
+            WITH {SOURCE_IDS_CTE},
+            {MODIFIED_CTE}
+            SELECT
+                (
+                    SELECT count(DISTINCT timestamp)
+                    FROM weather
+                    WHERE
+                        timestamp BETWEEN %(date)s AND %(last_date)s AND
+                        source_id = ANY(%(primary_source_ids)s)
+                ) AS count,
+                modified.*
+            FROM modified
+            """,
+            params, read_only=True)[0]
+    if row['count'] >= _expected_rows(date, last_date):
+        params['selected_source_ids'] = params['primary_source_ids']
     else:
-        where += " AND source_id = %(source_id)s"
-    if not_null:
-        where += ''.join(f" AND {element} IS NOT NULL" for element in not_null)
+        params['selected_source_ids'] = params['source_ids']
+    return {
+        'weather': _stream_weather_rows(
+            params, chunk_size, _weather_fields(fields)),
+        'sources': sources_rows,
+        'candidate_sources': sources_rows,
+        'modified': _modified(row),
+    }
+
+
+def _stream_weather_rows(params, chunk_size, fields):
+    fallback_fields = _fallback_fields(fields)
     sql = f"""
-        SELECT DISTINCT ON (timestamp) *
+        SELECT DISTINCT ON (timestamp)
+            {', '.join(['timestamp', 'source_id', *fields, 'icon'])}
         FROM weather
-        WHERE {where}
-        ORDER BY {order_by}
+        WHERE
+            timestamp BETWEEN %(date)s AND %(last_date)s AND
+            source_id = ANY(%(selected_source_ids)s)
+        ORDER BY timestamp, array_position(%(selected_source_ids)s, source_id)
     """
-    return _make_dicts(fetch(sql, params))
+    with get_connection(read_only=True) as conn:
+        with conn.cursor(name='weather_stream') as cur:
+            cur.execute(sql, params)
+            while rows := cur.fetchmany(chunk_size):
+                weather_rows = _make_dicts(rows)
+                with timed('fallback'):
+                    fallback_rows = _fetch_fallback_rows(
+                        conn, weather_rows, params['source_ids'], fields)
+                yield _fill_missing_fields(
+                    weather_rows, fallback_rows, fallback_fields)
 
 
-# Not available in MOSMIX
-IGNORED_MISSING_FIELDS = {'wind_gust_direction', 'relative_humidity'}
+def _fetch_fallback_rows(conn, weather_rows, source_ids, fields):
+    missing, min_date, max_date = _missing_fields(
+        weather_rows, _fallback_fields(fields))
+    if not missing:
+        return {}
+    # As in `_merged_weather_ctes()`, pick the fallback records within an
+    # index-only scan before fetching them
+    sql = f"""
+        SELECT {', '.join(['timestamp', 'source_id', *fields])}
+        FROM (
+            SELECT DISTINCT ON (timestamp) source_id, timestamp
+            FROM weather
+            WHERE
+                timestamp BETWEEN %(min_date)s AND %(max_date)s AND
+                source_id = ANY(%(source_ids)s) AND
+                not_null_mask & %(mask)s = %(mask)s
+            ORDER BY timestamp, array_position(%(source_ids)s, source_id)
+        ) fallback_keys
+        JOIN weather USING (source_id, timestamp)
+    """
+    params = {
+        'min_date': min_date,
+        'max_date': max_date,
+        'source_ids': source_ids,
+        'mask': _not_null_mask(missing),
+    }
+    # Use the streaming connection, as gunicorn's single-threaded workers only
+    # have one connection each
+    with conn.cursor() as cur:
+        cur.execute(sql, params)
+        return {row['timestamp']: dict(row) for row in cur.fetchall()}
 
 
-def _fill_missing_fields(weather_rows, date, last_date, source_ids):
-    incomplete_rows = []
-    missing_fields = set()
-    for row in weather_rows:
-        missing_row_fields = set(
-            k for k, v in row.items() if v is None
-        ).difference(IGNORED_MISSING_FIELDS)
-        if missing_row_fields:
-            incomplete_rows.append((row, missing_row_fields))
-            missing_fields.update(missing_row_fields)
-    if incomplete_rows:
-        min_date = incomplete_rows[0][0]['timestamp']
-        max_date = incomplete_rows[-1][0]['timestamp']
-        # NOTE: If there are multiple missing fields we may be missing out on
-        #       a "better" fallback if there are preferred sources that have
-        #       one (but not all) of the missing fields. However, this lets us
-        #       get by with using the basic weather query, and with performing
-        #       it only one extra time.
-        fallback_rows = {
-            row['timestamp']: row
-            for row in _weather(
-                min_date, max_date, source_ids, not_null=missing_fields)
-        }
-        for row, fields in incomplete_rows:
-            fallback_row = fallback_rows.get(row['timestamp'])
-            if fallback_row:
-                row['fallback_source_ids'] = {}
-                for f in fields:
-                    row[f] = fallback_row[f]
-                    row['fallback_source_ids'][f] = fallback_row['source_id']
+# Aggregates of the hourly weather fields, in the units of the weather table
+AGGREGATES = {
+    'precipitation': 'sum(precipitation::text::numeric)::float8',
+    'pressure_msl': 'round(avg(pressure_msl))::int',
+    'sunshine': 'sum(sunshine)::int',
+    'temperature': 'round(avg(temperature::text::numeric), 2)::float8',
+    'temperature_min': 'min(temperature)',
+    'temperature_max': 'max(temperature)',
+    'wind_direction': (
+        '(round(atan2d(avg(sind(wind_direction)), avg(cosd(wind_direction))))'
+        '::int + 360) %% 360'),
+    'wind_speed': 'round(avg(wind_speed::text::numeric), 1)::float8',
+    'cloud_cover': 'round(avg(cloud_cover))::int',
+    'dew_point': 'round(avg(dew_point::text::numeric), 2)::float8',
+    'relative_humidity': 'round(avg(relative_humidity))::int',
+    'visibility': 'round(avg(visibility))::int',
+    # Direction of the strongest gust
+    'wind_gust_direction': (
+        '(array_agg(wind_gust_direction '
+        'ORDER BY wind_gust_speed DESC NULLS LAST))[1]'),
+    'wind_gust_speed': 'max(wind_gust_speed)',
+    'condition': 'mode() WITHIN GROUP (ORDER BY condition)',
+}
+AGGREGATE_RESOLUTIONS = ['day', 'month']
+
+
+def weather_aggregate(
+        date, last_date=None, lat=None, lon=None, dwd_station_id=None,
+        wmo_station_id=None, source_id=None, max_dist=50000,
+        resolution='day', timezone=None):
+    """
+    Aggregate the records that `weather()` would return into daily or monthly
+    records. Records are grouped by the days or months of `timezone` (UTC by
+    default). Unlike in `weather()`, `last_date` is exclusive, and it defaults
+    to one day or month after `date`.
+    """
+    if resolution not in AGGREGATE_RESOLUTIONS:
+        raise ValueError(
+            f"'resolution' must be in {AGGREGATE_RESOLUTIONS}")
+    if timezone is not None and sql_timezone(timezone) is None:
+        raise ValueError(f'Unsupported timezone: {timezone}')
+    if not last_date and resolution == 'month':
+        last_date = date + relativedelta(months=1)
+    date, last_date, sources_rows = _weather_sources(
+        date, last_date, lat=lat, lon=lon, dwd_station_id=dwd_station_id,
+        wmo_station_id=wmo_station_id, source_id=source_id,
+        max_dist=max_dist)
+    if settings.WEATHER_AGGREGATE_ROLLUPS and _is_utc_days(
+            date, last_date, timezone):
+        sql, params = _weather_daily_aggregate_query(
+            sources_rows, date, last_date, resolution)
+    else:
+        sql, params = _weather_aggregate_query(
+            sources_rows, date, last_date, resolution, timezone)
+    rows = _make_dicts(_fetch_localized(sql, params))
+    used_source_ids = set()
+    for row in rows:
+        used_source_ids.update(row.pop('used_source_ids') or [])
+    return {
+        'weather': rows,
+        'sources': [s for s in sources_rows if s['id'] in used_source_ids],
+    }
+
+
+def _is_utc_days(date, last_date, timezone):
+    if timezone is not None and (
+            sql_timezone(timezone) not in ('UTC', 'Etc/UTC')):
+        return False
+    return all(
+        d.astimezone(tzutc()).time() == datetime.time(0)
+        for d in (date, last_date))
+
+
+def _weather_aggregate_query(
+        sources_rows, date, last_date, resolution, timezone):
+    params = {
+        **_source_ids_params(sources_rows),
+        'date': date,
+        'last_date': last_date,
+        'expected_rows': _expected_rows(date, last_date),
+        'resolution': resolution,
+        'timezone': sql_timezone(timezone) or 'UTC',
+    }
+    aggregates = ', '.join(f'{v} AS {k}' for k, v in AGGREGATES.items())
+    sql = f"""
+        WITH {SOURCE_IDS_CTE},
+        {_merged_weather_ctes()},
+        aggregated_rows AS (
+            SELECT * FROM merged WHERE timestamp < %(last_date)s
+        )
+        SELECT
+            date_trunc(%(resolution)s, timestamp, %(timezone)s) AS timestamp,
+            {aggregates},
+            (
+                SELECT array_agg(DISTINCT source_id)
+                FROM (
+                    SELECT source_id FROM aggregated_rows
+                    UNION
+                    SELECT value::int
+                    FROM aggregated_rows, jsonb_each_text(fallback_source_ids)
+                ) used
+            ) AS used_source_ids
+        FROM aggregated_rows
+        GROUP BY 1
+        ORDER BY 1
+    """
+    return sql, params
+
+
+def _weather_daily_aggregate_query(
+        sources_rows, date, last_date, resolution):
+    """
+    Same as `_weather_aggregate_query()`, but reading the daily rollups
+    instead of the hourly records where they yield the same result. That is
+    on days for which the source of the hourly records has all fields that
+    would otherwise be filled from fallback sources for each hour. The other
+    days, e.g. the current one or those at the boundary between observation
+    types, are aggregated from the hourly records.
+    """
+    source_ids_params = _source_ids_params(sources_rows)
+    primary_source_ids = source_ids_params['primary_source_ids']
+    params = {
+        **source_ids_params,
+        # Order of the primary records, which come from the first primary
+        # source if there is one for the day
+        'positions': primary_source_ids + [
+            source_id for source_id in source_ids_params['source_ids']
+            if source_id not in primary_source_ids],
+        'first_day': date.astimezone(tzutc()).date(),
+        'last_day': last_date.astimezone(tzutc()).date(),
+        'resolution': resolution,
+    }
+    columns = rollups.partial_columns()
+    complete = ' AND '.join(
+        f'{field}_count = 24'
+        for field in rollups.PARTIALS if field in FALLBACK_FIELDS)
+    hourly_timestamps = (
+        '(SELECT timestamps FROM hourly_timestamps)::timestamptz[]')
+    aggregates = ', '.join(
+        f'{v} AS {k}' for k, v in rollups.AGGREGATES.items())
+    sql = f"""
+        WITH {SOURCE_IDS_CTE},
+        source_days AS (
+            SELECT
+                *,
+                array_position(%(positions)s::int[], source_id) AS position,
+                array_position(%(source_ids)s::int[], source_id)
+                    AS source_position
+            FROM weather_daily
+            WHERE
+                source_id = ANY(%(source_ids)s::int[]) AND
+                day >= %(first_day)s AND
+                day < %(last_day)s AND
+                hours > 0
+        ),
+        day_sources AS (
+            SELECT DISTINCT ON (day) *
+            FROM source_days
+            ORDER BY day, position
+        ),
+        complete_days AS (
+            SELECT *
+            FROM day_sources
+            WHERE
+                hours = 24 AND
+                {complete} AND
+                -- Also the first source when not picking primary records
+                NOT EXISTS (
+                    SELECT
+                    FROM source_days
+                    WHERE
+                        source_days.day = day_sources.day AND
+                        source_days.source_position <
+                            day_sources.source_position
+                )
+        ),
+        hourly_timestamps AS (
+            SELECT array_agg(timestamp) AS timestamps
+            FROM
+                generate_series(
+                    %(first_day)s::date, %(last_day)s::date - 1, '1 day'
+                ) AS days(day),
+                generate_series(
+                    (day::timestamp AT TIME ZONE 'UTC'),
+                    (day::timestamp AT TIME ZONE 'UTC') + interval '23 hours',
+                    '1 hour'
+                ) AS timestamp
+            WHERE day::date NOT IN (SELECT day FROM complete_days)
+        ),
+        {_merged_weather_ctes(timestamps=hourly_timestamps)},
+        daily AS (
+            SELECT day, {', '.join(columns)}
+            FROM complete_days
+            UNION ALL
+            SELECT
+                (timestamp AT TIME ZONE 'UTC')::date,
+                {', '.join(columns.values())}
+            FROM merged
+            GROUP BY 1
+        )
+        SELECT
+            date_trunc(%(resolution)s, day::timestamp) AT TIME ZONE 'UTC'
+                AS timestamp,
+            {aggregates},
+            (
+                SELECT array_agg(DISTINCT source_id)
+                FROM (
+                    SELECT source_id FROM complete_days
+                    UNION
+                    SELECT source_id FROM merged
+                    UNION
+                    SELECT value::int
+                    FROM merged, jsonb_each_text(fallback_source_ids)
+                ) used
+            ) AS used_source_ids
+        FROM daily
+        GROUP BY 1
+        ORDER BY 1
+    """
+    return sql, params
+
+
+def weather_json(
+        date, last_date=None, lat=None, lon=None, dwd_station_id=None,
+        wmo_station_id=None, source_id=None, max_dist=50000, units='dwd',
+        timezone=None, fields=None, sources_rows=None):
+    """
+    Like `weather()`, but let the database perform the source fallback, unit
+    conversion, icon calculation and timestamp formatting, and return the
+    weather records as a serialized JSON array.
+
+    `timezone` may be a time zone name or a tzinfo supported by
+    `sql_timezone()`. Unlike in `weather()`, `fields` may include 'icon'.
+    """
+    if timezone is not None and sql_timezone(timezone) is None:
+        raise ValueError(f'Unsupported timezone: {timezone}')
+    icon = fields is None or 'icon' in fields
+    output_fields = _weather_fields(
+        None if fields is None else [f for f in fields if f != 'icon'])
+    input_fields = output_fields
+    if icon:
+        input_fields = _weather_fields({*output_fields, *ICON_FIELDS})
+    date, last_date, sources_rows = _weather_sources(
+        date, last_date, lat=lat, lon=lon, dwd_station_id=dwd_station_id,
+        wmo_station_id=wmo_station_id, source_id=source_id,
+        max_dist=max_dist, sources_rows=sources_rows)
+    params = {
+        **_source_ids_params(sources_rows),
+        'date': date,
+        'last_date': last_date,
+        'expected_rows': _expected_rows(date, last_date),
+        'timezone': sql_timezone(timezone),
+        **_sun_params(sources_rows if icon else [], date, last_date),
+        **_icon_params(),
+    }
+    record_sql = _weather_json_sql(
+        units, timezone is not None, fields=output_fields, icon=icon,
+        icon_only_fields=[f for f in input_fields if f not in output_fields])
+    # The sun parameters depend on the sources' locations, so sources are
+    # looked up in a separate query here
+    sql = f"""
+        WITH {SOURCE_IDS_CTE},
+        {MODIFIED_CTE},
+        {_merged_weather_ctes(input_fields)},
+        sun AS (
+            SELECT *
+            FROM unnest(
+                %(sun_source_ids)s::int[], %(sun_dates)s::date[],
+                %(sunrises)s::timestamptz[], %(sunsets)s::timestamptz[],
+                %(daytimes)s::text[]
+            ) AS sun(source_id, date, sunrise, sunset, daytime)
+        ),
+        weather_json AS (
+            SELECT
+                merged.timestamp,
+                merged.source_id,
+                merged.fallback_source_ids,
+                {record_sql} AS record
+            FROM merged
+            LEFT JOIN sun ON (
+                sun.source_id = merged.source_id AND
+                sun.date = (merged.timestamp AT TIME ZONE 'UTC')::date)
+        )
+        SELECT
+            COALESCE(
+                '[' || string_agg(record, ', ' ORDER BY timestamp) || ']',
+                '[]'
+            ) AS weather,
+            array(
+                SELECT source_id FROM weather_json
+                UNION
+                SELECT value::int
+                FROM weather_json, jsonb_each_text(fallback_source_ids)
+            ) AS used_source_ids,
+            (SELECT modified_source_ids FROM modified),
+            (SELECT last_modified FROM modified)
+        FROM weather_json
+    """
+    with timed('query'):
+        row = _fetch_localized(sql, params)[0]
+    used_source_ids = set(row['used_source_ids'])
+    return {
+        'weather': row['weather'],
+        'sources': [s for s in sources_rows if s['id'] in used_source_ids],
+        'candidate_sources': sources_rows,
+        'modified': _modified(row),
+    }
+
+
+def _merged_weather_ctes(fields=None, timestamps=None):
+    """
+    Return SQL for CTEs resulting in a `merged` relation that holds the
+    weather records including fallback values, with the `fallback_source_ids`
+    column being NULL for rows without fallback. Only the given `fields` are
+    selected and filled from fallback sources (default: all). The `icon`
+    column holds the icon stored with the primary record.
+
+    Records are selected between the `date` and `last_date` parameters, or
+    at the given `timestamps`, an SQL expression for an array, instead.
+
+    Expects a preceding `source_ids` CTE with a `primary_source_ids` and a
+    `source_ids` array column.
+    """
+    # Cast so that Postgres doesn't take these for subqueries within ANY()
+    primary_source_ids = '(SELECT primary_source_ids FROM source_ids)::int[]'
+    source_ids = '(SELECT source_ids FROM source_ids)::int[]'
+    if timestamps is None:
+        within = 'timestamp BETWEEN %(date)s AND %(last_date)s'
+        expected_rows = '%(expected_rows)s'
+        fallback_within = ''
+    else:
+        within = f'timestamp = ANY({timestamps})'
+        expected_rows = f'cardinality({timestamps})'
+        fallback_within = f'weather.{within} AND'
+    weather_fields = _weather_fields(fields)
+    fallback_fields = _fallback_fields(fields)
+    selected = ', '.join(
+        ['timestamp', 'source_id', 'not_null_mask', *weather_fields, 'icon'])
+    is_incomplete = ' OR '.join(
+        f'weather_rows.{f} IS NULL' for f in fallback_fields) or 'false'
+    fallback_mask = _not_null_mask(fallback_fields)
+    merged_fields = ''.join(
+        f', COALESCE(weather_rows.{f}, fallback_rows.{f}) AS {f}'
+        if f in fallback_fields else f', weather_rows.{f}'
+        for f in weather_fields)
+    fallback_source_ids = ', '.join(
+        f"'{f}', CASE WHEN weather_rows.{f} IS NULL "
+        f"THEN fallback_rows.source_id END"
+        for f in fallback_fields)
+    return f"""
+        primary_rows AS (
+            SELECT DISTINCT ON (timestamp) {selected}
+            FROM weather
+            WHERE
+                {within} AND
+                source_id = ANY({primary_source_ids})
+            ORDER BY timestamp, array_position({primary_source_ids}, source_id)
+        ),
+        all_rows AS (
+            SELECT DISTINCT ON (timestamp) {selected}
+            FROM weather
+            WHERE
+                (SELECT count(*) FROM primary_rows) < {expected_rows} AND
+                {within} AND
+                source_id = ANY({source_ids})
+            ORDER BY timestamp, array_position({source_ids}, source_id)
+        ),
+        weather_rows AS (
+            SELECT * FROM primary_rows
+            WHERE (SELECT count(*) FROM primary_rows) >= {expected_rows}
+            UNION ALL
+            SELECT * FROM all_rows
+        ),
+        missing AS (
+            SELECT
+                MIN(timestamp) AS min_date,
+                MAX(timestamp) AS max_date,
+                bit_or(~not_null_mask) & {fallback_mask} AS mask
+            FROM weather_rows
+            WHERE {is_incomplete}
+        ),
+        fallback_keys AS (
+            -- Only selects columns of the weather_key index, so that the
+            -- candidates' masks are checked within an index-only scan
+            SELECT DISTINCT ON (weather.timestamp)
+                weather.source_id, weather.timestamp
+            FROM weather, missing
+            WHERE
+                {fallback_within}
+                weather.timestamp
+                    BETWEEN missing.min_date AND missing.max_date AND
+                weather.source_id = ANY({source_ids}) AND
+                weather.not_null_mask & missing.mask = missing.mask
+            ORDER BY
+                weather.timestamp,
+                array_position({source_ids}, weather.source_id)
+        ),
+        fallback_rows AS (
+            SELECT weather.*
+            FROM fallback_keys
+            JOIN weather USING (source_id, timestamp)
+        ),
+        merged AS (
+            SELECT
+                weather_rows.timestamp,
+                weather_rows.source_id{merged_fields},
+                weather_rows.icon,
+                CASE
+                    WHEN fallback_rows.source_id IS NOT NULL AND (
+                        {is_incomplete})
+                    THEN jsonb_strip_nulls(jsonb_build_object(
+                        {fallback_source_ids}))
+                END AS fallback_source_ids
+            FROM weather_rows
+            LEFT JOIN fallback_rows ON (
+                weather_rows.timestamp = fallback_rows.timestamp)
+        )
+    """
+
+
+def _weather_json_sql(
+        units, has_timezone, fields=WEATHER_FIELDS, icon=True,
+        icon_only_fields=()):
+    """
+    Return SQL serializing a `merged` row to JSON, with the same text as the
+    `WeatherResource` response rows are serialized to.
+    """
+    converters = CONVERTERS.get(units, {})
+    values = {
+        'timestamp': (
+            f"to_json({_isoformat_sql('merged.timestamp', has_timezone)})"
+            f"::text"),
+        'source_id': 'merged.source_id::text',
+    }
+    for f in fields:
+        if f in converters:
+            values[f] = _float_json_sql(
+                SQL_CONVERTERS[converters[f]].format(f'merged.{f}'))
+        elif f in REAL_FIELDS:
+            values[f] = _float_json_sql(f'merged.{f}')
+        else:
+            values[f] = f'to_json(merged.{f})::text'
+    members = [
+        f"""'"{k}": ' || COALESCE({v}, 'null')""" for k, v in values.items()]
+    fallback_source_ids = 'merged.fallback_source_ids'
+    if icon_only_fields:
+        fallback_source_ids = f"""
+            NULLIF(
+                {fallback_source_ids} -
+                    array[{', '.join(f"'{f}'" for f in icon_only_fields)}],
+                '{{}}')
+        """
+    # Stored icons don't match records with icon inputs from fallback sources
+    stored_icon = f"""
+        CASE
+            WHEN merged.fallback_source_ids ?|
+                array[{', '.join(f"'{f}'" for f in ICON_FIELDS)}]
+            THEN NULL
+            ELSE merged.icon::text
+        END
+    """
+    # Members that are NULL are left out by concat_ws()
+    members.append(
+        f"""'"fallback_source_ids": ' || ({fallback_source_ids})::text""")
+    if icon:
+        members.append(
+            f"""'"icon": ' ||
+            to_json(COALESCE({stored_icon}, {_icon_sql()}))::text""")
+    return f"""'{{' || concat_ws(', ', {', '.join(members)}) || '}}'"""
+
+
+def _float_json_sql(value):
+    # Python writes integral floats with a trailing '.0'
+    return rf"regexp_replace(({value})::text, '^-?\d+$', '\&.0')"
+
+
+def _isoformat_sql(column, has_timezone):
+    if not has_timezone:
+        return f"""to_char({column}, 'YYYY-MM-DD"T"HH24:MI:SSTZH:TZM')"""
+    local = f'{column} AT TIME ZONE %(timezone)s'
+    offset = (
+        f"extract(epoch FROM {local} - {column} AT TIME ZONE 'UTC')::int")
+    return f"""
+        to_char({local}, 'YYYY-MM-DD"T"HH24:MI:SS') ||
+        CASE WHEN {offset} < 0 THEN '-' ELSE '+' END ||
+        to_char(abs({offset}) / 3600, 'FM00') || ':' ||
+        to_char(abs({offset}) %% 3600 / 60, 'FM00')
+    """
+
+
+def sql_timezone(timezone):
+    """
+    Return the name of the given tzinfo in the time zone database, or the
+    POSIX specification of its fixed UTC offset, for use in SQL. Return None
+    if it has neither, e.g. for POSIX-style time zones with DST rules. Time
+    zone names are returned as they are.
+    """
+    if timezone is None or isinstance(timezone, str):
+        return timezone
+    if isinstance(timezone, tzfile) and (
+            name := _zone_name(timezone._filename)):
+        return name
+    offset = timezone.utcoffset(None)
+    if offset is None:
+        return None
+    offset = int(offset.total_seconds()) // 60
+    if not offset:
+        return 'UTC'
+    # POSIX time zone specification, with inverted sign of the offset
+    sign = '-' if offset < 0 else '+'
+    hhmm = '%02d:%02d' % divmod(abs(offset), 60)
+    return f"<{sign}{hhmm}>{'+' if sign == '-' else '-'}{hhmm}"
+
+
+def _zone_name(filename):
+    if not os.path.isabs(filename):
+        # Loaded from the database bundled with dateutil
+        return filename
+    for path in TZPATHS:
+        if filename.startswith(os.path.join(path, '')):
+            return os.path.relpath(filename, path)
+    return None
+
+
+def _fetch_localized(sql, params):
+    """
+    Fetch the rows of a query with a `timezone` parameter, raising
+    `ValueError` for time zones unknown to Postgres.
+    """
+    try:
+        return fetch(sql, params, read_only=True)
+    except psycopg2.errors.InvalidParameterValue as e:
+        raise ValueError(f"Unknown timezone: {params['timezone']}") from e
+
+
+def _icon_sql():
+    """SQL equivalent of `icons.derive_icons()`"""
+    daytime = """
+        COALESCE(
+            sun.daytime,
+            CASE
+                WHEN merged.timestamp BETWEEN sun.sunrise AND sun.sunset
+                THEN 'day'
+                ELSE 'night'
+            END
+        )
+    """
+    return f"""
+        CASE
+            WHEN merged.condition IN (
+                'fog', 'sleet', 'snow', 'hail', 'thunderstorm')
+            THEN merged.condition::text
+            WHEN (
+                merged.condition = 'rain' AND
+                merged.precipitation IS NULL
+            ) OR (
+                COALESCE(merged.precipitation::text::float8, 0) >
+                %(icon_rain_threshold)s
+            )
+            THEN 'rain'
+            WHEN
+                COALESCE(merged.wind_speed::text::float8, 0) >
+                %(icon_wind_threshold)s
+            THEN 'wind'
+            WHEN
+                COALESCE(merged.cloud_cover, 0) >= %(icon_cloudy_threshold)s
+            THEN 'cloudy'
+            WHEN
+                COALESCE(merged.cloud_cover, 0) >=
+                %(icon_partly_cloudy_threshold)s
+            THEN 'partly-cloudy-' || {daytime}
+            ELSE 'clear-' || {daytime}
+        END
+    """
+
+
+def _icon_params():
+    return {
+        f'icon_{name}_threshold': float(
+            getattr(settings, f'ICON_{name.upper()}_THRESHOLD'))
+        for name in ['rain', 'wind', 'cloudy', 'partly_cloudy']
+    }
+
+
+def _sun_params(sources_rows, date, last_date):
+    # Per UTC day, like `icons.derive_icons()`
+    first_day = date.astimezone(tzutc()).date()
+    last_day = last_date.astimezone(tzutc()).date()
+    days = [
+        first_day + datetime.timedelta(days=i)
+        for i in range((last_day - first_day).days + 1)]
+    params = {
+        'sun_source_ids': [],
+        'sun_dates': [],
+        'sunrises': [],
+        'sunsets': [],
+        'daytimes': [],
+    }
+    for source in sources_rows:
+        for day in days:
+            sunrise, sunset = sun_table.sunrise_sunset(source, day)
+            if math.isinf(sunrise):
+                daytime = 'day' if sunrise < sunset else 'night'
+                sunrise = sunset = None
+            else:
+                daytime = None
+                sunrise = datetime.datetime.fromtimestamp(sunrise, tzutc())
+                sunset = datetime.datetime.fromtimestamp(sunset, tzutc())
+            params['sun_source_ids'].append(source['id'])
+            params['sun_dates'].append(day)
+            params['sunrises'].append(sunrise)
+            params['sunsets'].append(sunset)
+            params['daytimes'].append(daytime)
+    return params
 
 
 def current_weather(
         lat=None, lon=None, dwd_station_id=None, wmo_station_id=None,
-        source_id=None, max_dist=50000, fallback=True):
-    sources_rows = sources(
-        lat=lat, lon=lon, dwd_station_id=dwd_station_id,
-        wmo_station_id=wmo_station_id, observation_types=['synop'],
-        max_dist=max_dist
-    )['sources']
-    source_ids = [row['id'] for row in sources_rows]
-    weather = _current_weather(source_ids)
+        source_id=None, max_dist=50000, fallback=True, fields=None,
+        sources_rows=None):
+    """
+    Return the most recent record of the closest SYNOP source, filling
+    missing fields from other sources if `fallback` is set. `sources_rows`
+    and the result's `candidate_sources` and `modified` are as in
+    `weather()`.
+    """
+    if fields is not None and (
+            unknown := set(fields) - set(CURRENT_WEATHER_FIELDS)):
+        raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+    if sources_rows is None:
+        sources_rows = sources(
+            lat=lat, lon=lon, dwd_station_id=dwd_station_id,
+            wmo_station_id=wmo_station_id, observation_types=['synop'],
+            max_dist=max_dist
+        )['sources']
+    with timed('query'):
+        weather, modified = _current_weather(
+            sources_rows, fields=fields, modified=True)
     if not weather:
         raise LookupError(
             "Could not find current weather for your location criteria")
     used_source_ids = [weather['source_id']]
     if fallback:
-        missing_fields = [k for k, v in weather.items() if v is None]
-        fallback_weather = _current_weather(
-            source_ids, not_null=missing_fields)
+        missing_fields = [
+            k for k, v in weather.items()
+            if v is None and k in CURRENT_WEATHER_FIELDS]
+        with timed('fallback'):
+            fallback_weather, _ = _current_weather(
+                sources_rows, not_null=missing_fields, fields=fields)
         if fallback_weather:
             weather.update({k: fallback_weather[k] for k in missing_fields})
             weather['fallback_source_ids'] = {
@@ -131,62 +1263,369 @@ def current_weather(
     return {
         'weather': weather,
         'sources': [s for s in sources_rows if s['id'] in used_source_ids],
+        'candidate_sources': sources_rows,
+        'modified': modified,
     }
 
 
-def _current_weather(source_ids, not_null=None):
+def _current_weather(sources_rows, not_null=None, fields=None, modified=False):
+    source_ids = [row['id'] for row in sources_rows]
     params = {
-        'source_ids': source_ids,
+        **_source_ids_params(sources_rows),
         'source_ids_tuple': tuple(source_ids),
     }
     where = "source_id IN %(source_ids_tuple)s"
     if not_null:
         where += ''.join(f" AND {element} IS NOT NULL" for element in not_null)
+    columns = '*'
+    if fields is not None:
+        columns = ', '.join(
+            ['source_id', 'timestamp'] +
+            [f for f in CURRENT_WEATHER_FIELDS if f in fields] + ['icon'])
     sql = f"""
-        SELECT *
+        SELECT {columns}
         FROM current_weather
         WHERE {where}
         ORDER BY array_position(%(source_ids)s, source_id)
         LIMIT 1
     """
-    rows = _make_dicts(fetch(sql, params))
-    if not rows:
-        return {}
-    return rows[0]
+    if modified:
+        sql = f"""
+            WITH {SOURCE_IDS_CTE},
+            {MODIFIED_CTE}
+            SELECT current.*, modified.*
+            FROM modified
+            LEFT JOIN ({sql}) current ON true
+        """
+    rows = _make_dicts(fetch(sql, params, read_only=True))
+    if not modified:
+        return (rows[0] if rows else {}), None
+    row = rows[0]
+    modified = _modified(row)
+    for key in ('modified_source_ids', 'last_modified'):
+        del row[key]
+    if row['source_id'] is None:
+        return {}, modified
+    return row, modified
 
 
 def synop(
         date, last_date=None, dwd_station_id=None, wmo_station_id=None,
-        source_id=None):
+        source_id=None, sources_rows=None):
+    """
+    Return the SYNOP records of the given sources. `sources_rows` and the
+    result's `candidate_sources` and `modified` are as in `weather()`.
+    """
     if not last_date:
         last_date = date + datetime.timedelta(days=1)
-    sources_rows = sources(
-        dwd_station_id=dwd_station_id, wmo_station_id=wmo_station_id,
-        source_id=source_id, observation_types=['synop'])['sources']
-    source_ids = [row['id'] for row in sources_rows]
-    sql = """
-        SELECT *
-        FROM synop
-        WHERE
-            timestamp BETWEEN %(date)s AND %(last_date)s AND
-            source_id IN %(source_ids_tuple)s
-        ORDER BY timestamp
+    if sources_rows is None:
+        sources_rows = sources(
+            dwd_station_id=dwd_station_id, wmo_station_id=wmo_station_id,
+            source_id=source_id, observation_types=['synop'])['sources']
+    # The validators are only attached to the first row (of which there is
+    # always one, even if there are no records)
+    sql = f"""
+        WITH {SOURCE_IDS_CTE},
+        {MODIFIED_CTE}
+        SELECT
+            synop.*,
+            CASE WHEN row_number() OVER (ORDER BY synop.timestamp) = 1
+                THEN modified.modified_source_ids
+            END AS modified_source_ids,
+            CASE WHEN row_number() OVER (ORDER BY synop.timestamp) = 1
+                THEN modified.last_modified
+            END AS last_modified
+        FROM modified
+        LEFT JOIN synop ON (
+            synop.timestamp BETWEEN %(date)s AND %(last_date)s AND
+            synop.source_id IN %(source_ids_tuple)s
+        )
+        ORDER BY synop.timestamp
         """
     params = {
+        **_source_ids_params(sources_rows),
         'date': date,
         'last_date': last_date,
-        'source_ids_tuple': tuple(source_ids),
+        'source_ids_tuple': tuple(row['id'] for row in sources_rows),
     }
+    rows = _make_dicts(fetch(sql, params, read_only=True))
+    modified = _modified(rows[0])
+    weather_rows = []
+    for row in rows:
+        if row['timestamp'] is None:
+            continue
+        for key in ('modified_source_ids', 'last_modified'):
+            del row[key]
+        weather_rows.append(row)
     return {
-        'weather': _make_dicts(fetch(sql, params)),
+        'weather': weather_rows,
         'sources': _make_dicts(sources_rows),
+        'candidate_sources': sources_rows,
+        'modified': modified,
     }
 
 
+CURRENT_WEATHER_FIELDS = [
+    'cloud_cover', 'condition', 'dew_point', 'precipitation_10',
+    'precipitation_30', 'precipitation_60', 'pressure_msl',
+    'relative_humidity', 'visibility', 'wind_direction_10',
+    'wind_direction_30', 'wind_direction_60', 'wind_speed_10',
+    'wind_speed_30', 'wind_speed_60', 'wind_gust_direction_10',
+    'wind_gust_direction_30', 'wind_gust_direction_60', 'wind_gust_speed_10',
+    'wind_gust_speed_30', 'wind_gust_speed_60', 'sunshine_30', 'sunshine_60',
+    'temperature']
+SNAPSHOT_SOURCE_FIELDS = [
+    'id', 'observation_type', 'lat', 'lon', 'height', 'station_name',
+    'wmo_station_id', 'dwd_station_id']
+
+
+def weather_snapshot(bbox, date=None, fields=None):
+    """
+    Return the records at `date` of all sources within `bbox`, given as
+    `(west, south, east, north)`, or the current weather of all SYNOP
+    sources within `bbox` if no date is given. Weather and sources are
+    returned as columns of the same length, with one row per source.
+    """
+    west, south, east, north = bbox
+    if not (south <= north and west <= east):
+        raise ValueError(
+            "'bbox' must be given as west, south, east, north")
+    available_fields = WEATHER_FIELDS if date else CURRENT_WEATHER_FIELDS
+    if fields is None:
+        fields = available_fields
+    elif (unknown := set(fields) - set(available_fields)):
+        raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+    if date:
+        weather_sql = """
+            JOIN weather ON
+                weather.source_id = sources.id AND
+                weather.timestamp = %(date)s
+        """
+        observation_types = WEATHER_OBSERVATION_TYPES
+    else:
+        weather_sql = """
+            JOIN current_weather weather ON weather.source_id = sources.id
+        """
+        observation_types = ['synop']
+    sources_columns = [f'sources.{f}' for f in SNAPSHOT_SOURCE_FIELDS]
+    weather_columns = [f'weather.{f}' for f in ['timestamp', *fields]]
+    sql = f"""
+        SELECT {', '.join(sources_columns + weather_columns)}
+        FROM sources
+        {weather_sql}
+        WHERE
+            point(sources.lon, sources.lat) <@ box(
+                point(%(west)s, %(south)s), point(%(east)s, %(north)s)) AND
+            sources.observation_type =
+                ANY(%(observation_types)s::observation_type[])
+        ORDER BY sources.id
+    """
+    params = {
+        'west': west,
+        'south': south,
+        'east': east,
+        'north': north,
+        'date': date,
+        'observation_types': observation_types,
+    }
+    rows = fetch(sql, params, read_only=True)
+    columns = list(zip(*rows)) or [()] * (
+        len(sources_columns) + len(weather_columns))
+    n_sources = len(sources_columns)
+    sources_fields = SNAPSHOT_SOURCE_FIELDS
+    weather_fields = ['source_id', 'timestamp', *fields]
+    return {
+        'weather': dict(zip(
+            weather_fields,
+            map(list, [columns[0], *columns[n_sources:]]))),
+        'sources': dict(zip(sources_fields, map(list, columns[:n_sources]))),
+    }
+
+
+class SourcesCache:
+    """
+    Per-process LRU cache for source lookups.
+
+    Lookups are cached without their date window, which is applied to the
+    cached sources afterwards. All entries are dropped whenever the version
+    counter bumped by the `sources` table trigger changes, which is checked at
+    most every `SOURCES_CACHE_CHECK_INTERVAL` seconds. The same version
+    decides when the spatial index of all sources needs to be rebuilt.
+    """
+
+    lock = threading.Lock()
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.index = None
+        self.version = None
+        self.last_check = 0
+
+    @property
+    def enabled(self):
+        return settings.SOURCES_CACHE_SIZE > 0
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.index = None
+            self.version = None
+            self.last_check = 0
+
+    def check_version(self):
+        interval = settings.SOURCES_CACHE_CHECK_INTERVAL
+        if time.time() - self.last_check < interval:
+            return self.version
+        version = fetch(
+            'SELECT version FROM sources_version', read_only=True
+        )[0]['version']
+        with self.lock:
+            self._set_version(version)
+            self.last_check = time.time()
+        return self.version
+
+    def _set_version(self, version):
+        if version != self.version:
+            self.entries.clear()
+            self.version = version
+
+    def get_index(self):
+        version = self.check_version()
+        index = self.index
+        if index is None or index.version != version:
+            # Built aside and swapped in at once, so concurrent lookups keep
+            # using the previous index in the meantime
+            index = spatial.SourcesIndex.load()
+            with self.lock:
+                # The index may include changes the last check didn't see yet
+                if version is None or index.version > version:
+                    self._set_version(index.version)
+                self.index = index
+        return index
+
+    def get(self, key, load):
+        version = self.check_version()
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+        value = load()
+        with self.lock:
+            # Don't store lookups that may have raced a sources update
+            if version == self.version:
+                self.entries[key] = value
+                while len(self.entries) > settings.SOURCES_CACHE_SIZE:
+                    self.entries.popitem(last=False)
+        return value
+
+
+_sources_cache = SourcesCache()
+
+
 def sources(
         lat=None, lon=None, dwd_station_id=None, wmo_station_id=None,
         source_id=None, observation_types=None, max_dist=50000,
         ignore_type=False, date=None, last_date=None):
+    kwargs = dict(
+        lat=lat, lon=lon, dwd_station_id=dwd_station_id,
+        wmo_station_id=wmo_station_id, source_id=source_id,
+        observation_types=observation_types, max_dist=max_dist,
+        ignore_type=ignore_type)
+    use_index = (
+        settings.SOURCES_INDEX and lat is not None and lon is not None and
+        source_id is None and dwd_station_id is None and
+        wmo_station_id is None)
+    with timed('sources'):
+        if use_index:
+            rows = _sources_cache.get_index().find(
+                lat, lon, max_dist=max_dist,
+                observation_types=observation_types, ignore_type=ignore_type,
+                date=date, last_date=last_date)
+        elif _sources_cache.enabled:
+            rows = _cached_sources(**kwargs)
+            rows = [
+                dict(row) for row in rows
+                if (date is None or (
+                    row['last_record'] is not None and
+                    row['last_record'] >= date)) and
+                (last_date is None or (
+                    row['first_record'] is not None and
+                    row['first_record'] <= last_date))
+            ]
+        else:
+            sql, order_by, params = _sources_query(
+                date=date, last_date=last_date, **kwargs)
+            rows = _make_dicts(fetch(
+                f"{sql} ORDER BY {order_by}", params, read_only=True))
+    if not rows:
+        raise LookupError("No sources match your criteria")
+    return {'sources': rows}
+
+
+def _cached_sources(lat=None, lon=None, **kwargs):
+    grid = settings.SOURCES_CACHE_GRID
+    by_location = lat is not None and lon is not None and all(
+        kwargs[key] is None
+        for key in ('source_id', 'dwd_station_id', 'wmo_station_id'))
+    if not grid or not by_location:
+        return _sources_cache.get(
+            _sources_cache_key(lat, lon, kwargs),
+            lambda: _fetch_sources(lat=lat, lon=lon, **kwargs))
+    # Cache the sources around the grid cell's center, extending the
+    # distance by more than the distance from anywhere within the cell
+    cell_lat = round(round(lat / grid) * grid, 6)
+    cell_lon = round(round(lon / grid) * grid, 6)
+    margin = math.ceil(
+        grid * spatial.RADIANS_PER_DEGREE * spatial.EARTH_RADIUS)
+    cell_rows = _sources_cache.get(
+        _sources_cache_key(cell_lat, cell_lon, kwargs),
+        lambda: _fetch_sources(
+            lat=cell_lat, lon=cell_lon,
+            **{**kwargs, 'max_dist': kwargs['max_dist'] + margin}))
+    return _within_distance(
+        cell_rows, lat, lon, kwargs['max_dist'], kwargs['ignore_type'])
+
+
+def _sources_cache_key(lat, lon, kwargs):
+    return (lat, lon) + tuple(
+        tuple(v) if isinstance(v, list) else v
+        for _, v in sorted(kwargs.items()))
+
+
+def _fetch_sources(**kwargs):
+    sql, order_by, params = _sources_query(**kwargs)
+    return _make_dicts(fetch(
+        f"{sql} ORDER BY {order_by}", params, read_only=True))
+
+
+def _within_distance(rows, lat, lon, max_dist, ignore_type):
+    """
+    Return the given sources, ordered like by `_sources_query()`, that are
+    within `max_dist` of the given location, with their distance to it.
+    """
+    point = spatial.ll_to_earth(lat, lon)
+    # The order of the observation types within the given rows
+    type_ranks = {}
+    matches = []
+    for row in rows:
+        type_rank = type_ranks.setdefault(
+            row['observation_type'], len(type_ranks))
+        # Same (single precision) coordinates as in the database
+        source_lat, source_lon = array('f', [row['lat'], row['lon']])
+        distance = spatial.earth_distance(
+            point, spatial.ll_to_earth(source_lat, source_lon))
+        if distance < max_dist:
+            matches.append((
+                0 if ignore_type else type_rank, float(round(distance)),
+                row['id'], row))
+    matches.sort(key=lambda m: m[:3])
+    return [{**row, 'distance': distance} for _, distance, _, row in matches]
+
+
+def _sources_query(
+        lat=None, lon=None, dwd_station_id=None, wmo_station_id=None,
+        source_id=None, observation_types=None, max_dist=50000,
+        ignore_type=False, date=None, last_date=None):
     select = "*"
     order_by = "observation_type"
     params = {
@@ -259,9 +1698,5 @@ def sources(
         SELECT {select}
         FROM sources
         WHERE {where}
-        ORDER BY {order_by}
         """
-    rows = fetch(sql, params)
-    if not rows:
-        raise LookupError("No sources match your criteria")
-    return {'sources': _make_dicts(rows)}
+    return sql, order_by, params
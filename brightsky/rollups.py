@@ -0,0 +1,244 @@
+import datetime
+import logging
+
+from dateutil.tz import tzutc
+
+from brightsky.db import get_connection
+
+
+logger = logging.getLogger(__name__)
+
+
+CONDITIONS = ['dry', 'fog', 'rain', 'sleet', 'snow', 'hail', 'thunderstorm']
+
+# Partial aggregates of the hourly records per field, from which the
+# aggregates over any number of days can be computed (see `AGGREGATES`).
+# Every field additionally has a `<field>_count` column holding its number of
+# non-null hours.
+PARTIALS = {
+    'cloud_cover': {
+        'cloud_cover_sum': 'sum(cloud_cover)::numeric',
+    },
+    'condition': {
+        f'condition_{c}': f"count(*) FILTER (WHERE condition = '{c}')"
+        for c in CONDITIONS
+    },
+    'dew_point': {
+        'dew_point_sum': 'sum(dew_point::text::numeric)',
+    },
+    'precipitation': {
+        'precipitation_sum': 'sum(precipitation::text::numeric)',
+    },
+    'pressure_msl': {
+        'pressure_msl_sum': 'sum(pressure_msl)::numeric',
+    },
+    'relative_humidity': {
+        'relative_humidity_sum': 'sum(relative_humidity)::numeric',
+    },
+    'sunshine': {
+        'sunshine_sum': 'sum(sunshine)::numeric',
+    },
+    'temperature': {
+        'temperature_sum': 'sum(temperature::text::numeric)',
+        'temperature_min': 'min(temperature)',
+        'temperature_max': 'max(temperature)',
+    },
+    'visibility': {
+        'visibility_sum': 'sum(visibility)::numeric',
+    },
+    'wind_direction': {
+        'wind_direction_sin': 'sum(sind(wind_direction))',
+        'wind_direction_cos': 'sum(cosd(wind_direction))',
+    },
+    'wind_speed': {
+        'wind_speed_sum': 'sum(wind_speed::text::numeric)',
+    },
+    'wind_gust_speed': {
+        'wind_gust_speed_max': 'max(wind_gust_speed)',
+        'wind_gust_direction': (
+            '(array_agg(wind_gust_direction '
+            'ORDER BY wind_gust_speed DESC NULLS LAST))[1]'),
+    },
+}
+
+# Same aggregates as `query.AGGREGATES`, computed from the partials
+AGGREGATES = {
+    'precipitation': 'sum(precipitation_sum)::float8',
+    'pressure_msl': (
+        'round(sum(pressure_msl_sum) / sum(pressure_msl_count))::int'),
+    'sunshine': 'sum(sunshine_sum)::int',
+    'temperature': (
+        'round(sum(temperature_sum) / sum(temperature_count), 2)::float8'),
+    'temperature_min': 'min(temperature_min)',
+    'temperature_max': 'max(temperature_max)',
+    'wind_direction': (
+        '(round(atan2d('
+        'sum(wind_direction_sin) / sum(wind_direction_count), '
+        'sum(wind_direction_cos) / sum(wind_direction_count)'
+        '))::int + 360) %% 360'),
+    'wind_speed': (
+        'round(sum(wind_speed_sum) / sum(wind_speed_count), 1)::float8'),
+    'cloud_cover': 'round(sum(cloud_cover_sum) / sum(cloud_cover_count))::int',
+    'dew_point': (
+        'round(sum(dew_point_sum) / sum(dew_point_count), 2)::float8'),
+    'relative_humidity': (
+        'round(sum(relative_humidity_sum) / '
+        'sum(relative_humidity_count))::int'),
+    'visibility': 'round(sum(visibility_sum) / sum(visibility_count))::int',
+    'wind_gust_direction': (
+        '(array_agg(wind_gust_direction '
+        'ORDER BY wind_gust_speed_max DESC NULLS LAST))[1]'),
+    'wind_gust_speed': 'max(wind_gust_speed_max)',
+    # Most frequent condition, ties go to the first one like in mode()
+    'condition': f"""(
+        SELECT c
+        FROM unnest(
+            enum_range(NULL::weather_condition),
+            array[{', '.join(f'sum(condition_{c})' for c in CONDITIONS)}]
+        ) AS condition_hours(c, n)
+        WHERE n > 0
+        ORDER BY n DESC, c
+        LIMIT 1
+    )""",
+}
+
+
+def partial_columns():
+    """
+    Return the columns of the daily rollups, mapped to the SQL computing them
+    from hourly records.
+    """
+    columns = {'hours': 'count(*)'}
+    for field, partials in PARTIALS.items():
+        columns.update(partials)
+        columns[f'{field}_count'] = f'count({field})'
+    return columns
+
+
+def _upsert_sql(source_id, day, from_sql):
+    columns = partial_columns()
+    return f"""
+        INSERT INTO weather_daily (source_id, day, {', '.join(columns)})
+        SELECT
+            {source_id},
+            {day},
+            {', '.join(columns.values())}
+        {from_sql}
+        GROUP BY 1, 2
+        ON CONFLICT ON CONSTRAINT weather_daily_key DO UPDATE SET
+            {', '.join(f'{c} = EXCLUDED.{c}' for c in columns)}
+    """
+
+
+def utc_day(timestamp):
+    if timestamp.tzinfo is None:
+        return timestamp.date()
+    return timestamp.astimezone(tzutc()).date()
+
+
+def update_weather_daily(conn, pairs):
+    """
+    Rebuild the rollups of the given `(source_id, day)` pairs from the hourly
+    records in the weather table.
+    """
+    if not pairs:
+        return
+    source_ids, days = zip(*sorted(set(pairs)))
+    params = {'source_ids': list(source_ids), 'days': list(days)}
+    touched = """
+        unnest(%(source_ids)s::int[], %(days)s::date[])
+            AS touched(source_id, day)
+    """
+    with conn.cursor() as cur:
+        # Days may have lost all their records
+        cur.execute(
+            f"""
+            DELETE FROM weather_daily USING {touched}
+            WHERE
+                weather_daily.source_id = touched.source_id AND
+                weather_daily.day = touched.day
+            """,
+            params)
+        cur.execute(
+            _upsert_sql(
+                'touched.source_id', 'touched.day',
+                f"""
+                FROM {touched}
+                JOIN weather ON
+                    weather.source_id = touched.source_id AND
+                    weather.timestamp >=
+                        touched.day::timestamp AT TIME ZONE 'UTC' AND
+                    weather.timestamp <
+                        (touched.day + 1)::timestamp AT TIME ZONE 'UTC'
+                """),
+            params)
+    logger.debug("Updated %d daily weather rollups", len(source_ids))
+
+
+def prune_weather_daily(conn, source_ids, before):
+    """
+    Update the rollups after the hourly records of the given sources prior to
+    `before` were deleted.
+    """
+    if not source_ids:
+        return
+    day = utc_day(before)
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            DELETE FROM weather_daily
+            WHERE source_id = ANY(%s) AND day < %s
+            """,
+            (list(source_ids), day))
+    update_weather_daily(conn, [(source_id, day) for source_id in source_ids])
+
+
+def backfill_weather_daily(first_day=None, last_day=None, chunk_days=31):
+    """
+    Build the rollups for all hourly records between the given UTC days
+    (inclusive), defaulting to the full range of the weather table.
+    """
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT
+                    (min(timestamp) AT TIME ZONE 'UTC')::date AS first_day,
+                    (max(timestamp) AT TIME ZONE 'UTC')::date AS last_day
+                FROM weather
+                """)
+            row = cur.fetchone()
+            first_day = first_day or row['first_day']
+            last_day = last_day or row['last_day']
+            if first_day is None or last_day is None:
+                logger.info('No weather records to build rollups for')
+                return
+            day = first_day
+            while day <= last_day:
+                chunk_last_day = min(
+                    day + datetime.timedelta(days=chunk_days - 1), last_day)
+                params = {'first_day': day, 'last_day': chunk_last_day}
+                cur.execute(
+                    """
+                    DELETE FROM weather_daily
+                    WHERE day BETWEEN %(first_day)s AND %(last_day)s
+                    """,
+                    params)
+                cur.execute(
+                    _upsert_sql(
+                        'source_id', "(timestamp AT TIME ZONE 'UTC')::date",
+                        """
+                        FROM weather
+                        WHERE
+                            timestamp >=
+                                %(first_day)s::timestamp AT TIME ZONE 'UTC'
+                            AND timestamp <
+                                (%(last_day)s + 1)::timestamp
+                                AT TIME ZONE 'UTC'
+                        """),
+                    params)
+                conn.commit()
+                logger.info(
+                    'Built %d daily weather rollups from %s to %s',
+                    cur.rowcount, day, chunk_last_day)
+                day = chunk_last_day + datetime.timedelta(days=1)
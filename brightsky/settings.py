@@ -6,6 +6,8 @@ from dateutil.tz import tzutc
 from brightsky.utils import load_dotenv
 
 
+COMPRESSION_ENCODINGS = ['br', 'zstd', 'gzip']
+COMPRESSION_MIN_SIZE = 1024
 CORS_ALLOWED_ORIGINS = []
 CORS_ALLOWED_HEADERS = []
 DATABASE_URL = 'postgres://localhost'
@@ -17,8 +19,39 @@ IGNORED_CURRENT_OBSERVATIONS_STATIONS = ['K386']
 KEEP_DOWNLOADS = False
 MIN_DATE = datetime.datetime(2010, 1, 1, tzinfo=tzutc())
 MAX_DATE = None
+METRICS = False
+METRICS_WORKER_PORT = 0
 POLLING_CRONTAB_MINUTE = '*'
+PROFILE_DIR = ''
+PROFILE_INTERVAL = 0.005
+PROFILE_RATE = 0.
+PROFILE_TOKEN = ''
+READ_DATABASE_SELECTION = 'round_robin'
+READ_DATABASE_URL = []
+READ_YOUR_WRITES_WINDOW = 0.
 REDIS_URL = 'redis://localhost'
+RESPONSE_CACHE = False
+RESPONSE_CACHE_TTL_CURRENT = 300
+RESPONSE_CACHE_TTL_HISTORICAL = 86400
+RESPONSE_CACHE_TTL_RECENT = 900
+SERVER_TIMING = True
+SLOW_REQUEST_THRESHOLD = 0.
+SOURCES_CACHE_CHECK_INTERVAL = 5.
+SOURCES_CACHE_GRID = 0.
+SOURCES_CACHE_SIZE = 0
+SOURCES_INDEX = False
+SQL_EXPLAIN_THRESHOLD = 0.
+SQL_STATS = False
+SQL_STATS_FLUSH_INTERVAL = 10.
+SQL_STATS_WINDOW = 86400
+SUN_TABLE_SIZE = 1000
+WEATHER_AGGREGATE_ROLLUPS = False
+WEATHER_BATCH_MAX_LOCATIONS = 500
+WEATHER_SQL_JSON = False
+WEATHER_STREAMING_CHUNK_SIZE = 1000
+WEATHER_STREAMING_THRESHOLD = 0
+WEB_THREADS = 1
+WEB_WORKERS = 0
 
 
 def _make_bool(bool_str):
@@ -41,6 +74,7 @@ _SETTING_PARSERS = {
     bool: _make_bool,
     datetime.datetime: _make_date,
     float: float,
+    int: int,
     list: _make_list,
 }
 
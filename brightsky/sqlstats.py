@@ -0,0 +1,320 @@
+import atexit
+import hashlib
+import logging
+import math
+import re
+import sys
+import threading
+import time
+from collections import Counter, OrderedDict
+
+import psycopg2
+import redis
+from psycopg2.extras import DictCursor
+
+from brightsky.cache import get_redis
+from brightsky.settings import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+KEY_PREFIX = 'brightsky:sql:'
+# Upper bounds of the duration histogram buckets, in seconds
+BUCKETS = (.001, .005, .01, .05, .1, .5, 1., 5., math.inf)
+# Number of statements kept in memory per process
+MAX_STATEMENTS = 1000
+# Statistics are stored in Redis in buckets of this many seconds
+PERIOD = 3600
+
+_NORMALIZATIONS = [
+    # Literals and placeholders
+    (re.compile(r"'(?:[^']|'')*'"), '?'),
+    (re.compile(r'%\(\w+\)s|%s'), '?'),
+    (re.compile(r'\b\d+(?:\.\d+)?\b'), '?'),
+    (re.compile(r'(?<!IS )(?<!NOT )\bNULL\b', re.IGNORECASE), '?'),
+    # Lists of values, e.g. from `execute_values()`
+    (re.compile(r'\?(?:\s*,\s*\?)+'), '?, ...'),
+    (re.compile(r'\(\?(?:, \.\.\.)?\)(?:\s*,\s*\(\?(?:, \.\.\.)?\))+'),
+     '(?, ...), ...'),
+    (re.compile(r'\s+'), ' '),
+]
+_SKIPPED_MODULES = ('brightsky.db', 'brightsky.sqlstats', 'contextlib')
+
+
+def normalize(statement):
+    """Return the fingerprint of a statement, i.e. without any values."""
+    for pattern, replacement in _NORMALIZATIONS:
+        statement = pattern.sub(replacement, statement)
+    return statement.strip()
+
+
+def is_explainable(statement):
+    """Return whether running a statement again has no side effects."""
+    return bool(
+        re.match(r'\s*(SELECT|WITH)\b', statement, re.IGNORECASE) and
+        not re.search(
+            r'\b(INSERT|UPDATE|DELETE|REFRESH)\b', statement, re.IGNORECASE))
+
+
+def caller():
+    """Return the function that issued the statement being executed."""
+    frame = sys._getframe(1)
+    while frame is not None:
+        module = frame.f_globals.get('__name__', '')
+        if not module.startswith(('psycopg2', *_SKIPPED_MODULES)):
+            return f'{module}.{frame.f_code.co_name}'
+        frame = frame.f_back
+    return None
+
+
+class StatementStats:
+
+    def __init__(self, statement):
+        self.statement = statement
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+        self.rows = 0
+        self.buckets = [0] * len(BUCKETS)
+        self.callers = Counter()
+        self.plan = None
+
+    def add(self, duration, rows, caller):
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+        self.rows += rows
+        self.buckets[next(
+            i for i, bound in enumerate(BUCKETS) if duration <= bound)] += 1
+        self.callers[caller] += 1
+
+
+class SQLStats:
+    """
+    Per-process statistics of the executed statements, grouped by their
+    fingerprints. Holds the statistics since the last flush, which merges
+    them into the statistics of all processes in Redis. These are kept per
+    `PERIOD`, so that `report()` can cover the last `SQL_STATS_WINDOW`
+    seconds.
+    """
+
+    def __init__(self):
+        self.statements = OrderedDict()
+        self.explained = set()
+        self.lock = threading.Lock()
+        self.last_flush = time.monotonic()
+
+    def clear(self):
+        with self.lock:
+            self.statements.clear()
+            self.explained.clear()
+
+    def record(self, fingerprint, duration, rows, caller):
+        with self.lock:
+            stats = self.statements.get(fingerprint)
+            if stats is None:
+                stats = self.statements[fingerprint] = StatementStats(
+                    fingerprint)
+                while len(self.statements) > MAX_STATEMENTS:
+                    self.statements.popitem(last=False)
+            else:
+                self.statements.move_to_end(fingerprint)
+            stats.add(duration, rows, caller)
+
+    def flush_due(self):
+        return time.monotonic() - self.last_flush >= (
+            settings.SQL_STATS_FLUSH_INTERVAL)
+
+    def should_explain(self, fingerprint):
+        """Return whether a slow statement's plan is yet to be captured."""
+        with self.lock:
+            if fingerprint in self.explained:
+                return False
+            self.explained.add(fingerprint)
+            return True
+
+    def set_plan(self, fingerprint, plan):
+        with self.lock:
+            if (stats := self.statements.get(fingerprint)) is not None:
+                stats.plan = plan
+
+    def flush(self):
+        with self.lock:
+            statements = list(self.statements.values())
+            self.statements.clear()
+            self.last_flush = time.monotonic()
+        if not statements:
+            return
+        period = current_period()
+        # Keep the period until it has left the window
+        ttl = settings.SQL_STATS_WINDOW + PERIOD
+        pipe = get_redis().pipeline()
+        for stats in statements:
+            key = statement_key(stats.statement, period)
+            pipe.hsetnx(key, 'statement', stats.statement)
+            pipe.hsetnx(key, 'period', period)
+            pipe.hincrby(key, 'count', stats.count)
+            pipe.hincrbyfloat(key, 'total', stats.total)
+            pipe.hincrby(key, 'rows', stats.rows)
+            for bound, count in zip(BUCKETS, stats.buckets):
+                if count:
+                    pipe.hincrby(key, f'le:{bound}', count)
+            for caller, count in stats.callers.items():
+                pipe.hincrby(key, f'caller:{caller}', count)
+            if stats.plan is not None:
+                pipe.hset(key, 'plan', stats.plan)
+            pipe.eval(_SET_MAX_SCRIPT, 1, key, stats.max)
+            pipe.expire(key, ttl)
+            pipe.sadd(statements_key(period), key)
+        pipe.expire(statements_key(period), ttl)
+        try:
+            pipe.execute()
+        except redis.RedisError:
+            logger.exception("Failed to store SQL statistics")
+
+
+_SET_MAX_SCRIPT = """
+local max = tonumber(redis.call('HGET', KEYS[1], 'max') or '0')
+if tonumber(ARGV[1]) > max then
+    redis.call('HSET', KEYS[1], 'max', ARGV[1])
+end
+"""
+
+sql_stats = SQLStats()
+atexit.register(lambda: settings.SQL_STATS and sql_stats.flush())
+
+
+def current_period():
+    return int(time.time() // PERIOD)
+
+
+def statements_key(period):
+    return f'{KEY_PREFIX}{period}:statements'
+
+
+def statement_key(statement, period):
+    digest = hashlib.sha1(statement.encode()).hexdigest()[:16]
+    return f'{KEY_PREFIX}{period}:statement:{digest}'
+
+
+class TimingCursor(DictCursor):
+    """
+    Cursor recording the fingerprint, duration, row count and caller of each
+    executed statement when `SQL_STATS` is enabled. Read-only statements
+    slower than `SQL_EXPLAIN_THRESHOLD` seconds are explained (once per
+    statement and process).
+    """
+
+    def execute(self, query, vars=None):
+        if not settings.SQL_STATS:
+            return super().execute(query, vars)
+        start = time.perf_counter()
+        result = super().execute(query, vars)
+        self._record(query, vars, time.perf_counter() - start)
+        return result
+
+    def _record(self, query, vars, duration):
+        if isinstance(query, bytes):
+            query = query.decode()
+        elif not isinstance(query, str):
+            query = query.as_string(self.connection)
+        fingerprint = normalize(query)
+        sql_stats.record(
+            fingerprint, duration, max(self.rowcount, 0), caller())
+        threshold = settings.SQL_EXPLAIN_THRESHOLD
+        if (threshold and duration >= threshold and self.name is None and
+                is_explainable(query) and
+                sql_stats.should_explain(fingerprint)):
+            sql_stats.set_plan(fingerprint, self._explain(query, vars))
+        if sql_stats.flush_due():
+            sql_stats.flush()
+
+    def _explain(self, query, vars):
+        # Use a plain cursor, and a savepoint so a failure won't abort the
+        # caller's transaction
+        with self.connection.cursor(
+                cursor_factory=psycopg2.extensions.cursor) as cur:
+            cur.execute('SAVEPOINT explain')
+            try:
+                cur.execute(f'EXPLAIN (ANALYZE, BUFFERS) {query}', vars)
+                plan = '\n'.join(row[0] for row in cur.fetchall())
+            except psycopg2.Error as e:
+                cur.execute('ROLLBACK TO SAVEPOINT explain')
+                plan = f'EXPLAIN failed: {e}'
+            cur.execute('RELEASE SAVEPOINT explain')
+        return plan
+
+
+def _quantile(buckets, count, q):
+    seen = 0
+    for bound, bucket_count in zip(BUCKETS, buckets):
+        seen += bucket_count
+        if seen >= q * count:
+            return bound
+    return math.inf
+
+
+def report(sort='total', limit=20):
+    """
+    Return the statistics of all processes' statements over the last
+    `SQL_STATS_WINDOW` seconds, sorted in descending order by the given key
+    (`total`, `mean`, `max`, `count` or `p95`).
+    """
+    client = get_redis()
+    last_period = current_period()
+    periods = range(
+        last_period - math.ceil(settings.SQL_STATS_WINDOW / PERIOD) + 1,
+        last_period + 1)
+    pipe = client.pipeline()
+    for period in periods:
+        pipe.smembers(statements_key(period))
+    keys = sorted(set().union(*pipe.execute()))
+    for key in keys:
+        pipe.hgetall(key)
+    merged = {}
+    # Periods in ascending order, so that the latest plan wins
+    results = sorted(pipe.execute(), key=lambda f: int(f.get(b'period', 0)))
+    for fields in results:
+        if not fields:
+            # Expired
+            continue
+        fields = {k.decode(): v.decode() for k, v in fields.items()}
+        stats = merged.get(fields['statement'])
+        if stats is None:
+            stats = merged[fields['statement']] = StatementStats(
+                fields['statement'])
+        stats.count += int(fields['count'])
+        stats.total += float(fields['total'])
+        stats.max = max(stats.max, float(fields.get('max', 0.)))
+        stats.rows += int(fields['rows'])
+        for i, bound in enumerate(BUCKETS):
+            stats.buckets[i] += int(fields.get(f'le:{bound}', 0))
+        for name, value in fields.items():
+            if name.startswith('caller:'):
+                stats.callers[name.split(':', 1)[1]] += int(value)
+        stats.plan = fields.get('plan', stats.plan)
+    rows = [
+        {
+            'statement': stats.statement,
+            'count': stats.count,
+            'total': stats.total,
+            'mean': stats.total / stats.count,
+            'p95': _quantile(stats.buckets, stats.count, .95),
+            'max': stats.max,
+            'rows': stats.rows,
+            'callers': [name for name, _ in stats.callers.most_common()],
+            'plan': stats.plan,
+        }
+        for stats in merged.values()
+    ]
+    rows.sort(key=lambda row: row[sort], reverse=True)
+    return rows[:limit]
+
+
+def reset():
+    client = get_redis()
+    keys = client.keys(f'{KEY_PREFIX}*')
+    if keys:
+        client.delete(*keys)
+    sql_stats.clear()
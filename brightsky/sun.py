@@ -0,0 +1,82 @@
+import datetime
+import math
+import threading
+from array import array
+from collections import OrderedDict
+
+from astral import Observer
+from astral.sun import daylight, elevation, noon
+
+from brightsky.settings import settings
+
+
+def sunrise_sunset(lat, lon, day):
+    """
+    Return the sunrise and sunset of the given day as POSIX timestamps. On
+    days the sun doesn't set, sunrise is -inf and sunset is inf, on days it
+    doesn't rise it's the other way around. This way, `sunrise <= t <=
+    sunset` is true exactly for daytime timestamps `t`.
+    """
+    observer = Observer(lat, lon)
+    try:
+        sunrise, sunset = daylight(observer, day)
+    except ValueError:
+        if elevation(observer, noon(observer, day)) > 0:
+            return -math.inf, math.inf
+        return math.inf, -math.inf
+    return sunrise.timestamp(), sunset.timestamp()
+
+
+class SunTable:
+    """
+    Per-process table of the sunrise and sunset times of each source and day,
+    computed on first use. Days are held in one array per source and year,
+    indexed by the day of the year. At most `SUN_TABLE_SIZE` source-years are
+    kept, dropping the least recently used ones.
+    """
+
+    def __init__(self):
+        self.years = OrderedDict()
+        self.lock = threading.Lock()
+
+    def clear(self):
+        with self.lock:
+            self.years.clear()
+
+    def _year(self, source_id, year):
+        key = (source_id, year)
+        with self.lock:
+            days = self.years.get(key)
+            if days is not None:
+                self.years.move_to_end(key)
+                return days
+            # Sunrises and sunsets, NaN for days that were not computed yet
+            days = array('d', [math.nan]) * (2 * 366)
+            self.years[key] = days
+            while len(self.years) > max(settings.SUN_TABLE_SIZE, 1):
+                self.years.popitem(last=False)
+        return days
+
+    def sunrise_sunset(self, source, day):
+        """
+        Return the sunrise and sunset of the given source's location and day,
+        as described in `sunrise_sunset()`.
+        """
+        days = self._year(source['id'], day.year)
+        i = 2 * (day.timetuple().tm_yday - 1)
+        if days[i] != days[i]:
+            days[i], days[i+1] = sunrise_sunset(
+                source['lat'], source['lon'], day)
+        return days[i], days[i+1]
+
+    def is_daytime(self, source, timestamp):
+        """
+        Return whether the given timestamp is between the sunrise and sunset
+        of its UTC day.
+        """
+        sunrise, sunset = self.sunrise_sunset(
+            source, timestamp.astimezone(datetime.timezone.utc).date())
+        return sunrise <= timestamp.timestamp() <= sunset
+
+
+sun_table = SunTable()
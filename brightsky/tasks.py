@@ -1,9 +1,12 @@
 import logging
 import os
 
+from brightsky import metrics
 from brightsky.db import get_connection
+from brightsky.export import touch_sources
 from brightsky.parsers import get_parser
 from brightsky.polling import DWDPoller
+from brightsky.rollups import prune_weather_daily
 from brightsky.utils import dwd_fingerprint
 from brightsky.worker import huey, process
 
@@ -16,19 +19,23 @@ def parse(path=None, url=None, export=False):
         raise ValueError('Please provide either path or url')
     parser_cls = get_parser(os.path.basename(path or url))
     parser = parser_cls(path=path, url=url)
-    if url:
-        parser.download()
-        fingerprint = {
-            'url': url,
-            **dwd_fingerprint(parser.path),
-        }
-    else:
-        fingerprint = None
-    records = list(parser.parse())
+    parser_name = parser_cls.__name__
+    with metrics.PARSE_DURATION.labels(parser_name).time():
+        if url:
+            parser.download()
+            fingerprint = {
+                'url': url,
+                **dwd_fingerprint(parser.path),
+            }
+        else:
+            fingerprint = None
+        records = list(parser.parse())
     parser.cleanup()
+    metrics.PARSED_RECORDS.labels(parser_name).inc(len(records))
     if export:
         exporter = parser.exporter()
-        exporter.export(records, fingerprint=fingerprint)
+        with metrics.EXPORT_DURATION.labels(parser_name).time():
+            exporter.export(records, fingerprint=fingerprint)
     return records
 
 
@@ -106,26 +113,43 @@ def clean():
                     WHERE source_id = %s AND timestamp < %s
                     """,
                     (row['id'], row['threshold']))
+                if cur.rowcount:
+                    touch_sources(conn, [row['id']])
+                prune_weather_daily(conn, [row['id']], row['threshold'])
             conn.commit()
             logger.info(
                 'Deleting expired weather records: %s', expiry_intervals)
             for table, table_expires in expiry_intervals.items():
                 for observation_type, interval in table_expires.items():
+                    cur.execute(
+                        """
+                        SELECT
+                            array_agg(id) AS source_ids,
+                            current_timestamp - %s::interval AS threshold
+                        FROM sources
+                        WHERE observation_type = %s
+                        """,
+                        (interval, observation_type))
+                    row = cur.fetchone()
                     cur.execute(
                         f"""
                         DELETE FROM {table} WHERE
-                            source_id IN (
-                                SELECT id FROM sources
-                                WHERE observation_type = %s) AND
-                            timestamp < current_timestamp - %s::interval;
+                            source_id = ANY(%s) AND
+                            timestamp < %s;
                         """,
-                        (observation_type, interval),
+                        (row['source_ids'] or [], row['threshold']),
                     )
+                    deleted = cur.rowcount
+                    if deleted:
+                        touch_sources(conn, row['source_ids'])
+                    if table == 'weather':
+                        prune_weather_daily(
+                            conn, row['source_ids'], row['threshold'])
                     conn.commit()
-                    if cur.rowcount:
+                    if deleted:
                         logger.info(
                             'Deleted %d outdated %s weather records from %s',
-                            cur.rowcount, observation_type, table)
+                            deleted, observation_type, table)
                 cur.execute(
                     f"""
                     UPDATE sources SET
@@ -0,0 +1,92 @@
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from brightsky.settings import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+_local = threading.local()
+
+
+class Timer:
+    """Durations of the named phases of a request, in seconds."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = {}
+
+    def add(self, name, duration):
+        self.phases[name] = self.phases.get(name, 0.) + duration
+
+    def total(self):
+        return time.perf_counter() - self.start
+
+
+def current_timer():
+    return getattr(_local, 'timer', None)
+
+
+@contextmanager
+def timed(name):
+    """
+    Add the duration of the block to the given phase of the current request.
+    Phases that occur multiple times are summed up. Does nothing outside of
+    requests, e.g. while streaming responses.
+    """
+    timer = current_timer()
+    if timer is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer.add(name, time.perf_counter() - start)
+
+
+def server_timing(phases):
+    """Return the `Server-Timing` header value of the given durations."""
+    return ', '.join(
+        f'{name};dur={duration * 1000:.1f}'
+        for name, duration in phases.items())
+
+
+class TimingMiddleware:
+    """
+    Middleware timing the phases of each request (see `timed()`), reporting
+    them in the `Server-Timing` header if `SERVER_TIMING` is set, and logging
+    requests that took longer than `SLOW_REQUEST_THRESHOLD` seconds.
+
+    Must be listed before the other middleware, so that its timer covers
+    theirs.
+    """
+
+    def process_request(self, req, resp):
+        if settings.SERVER_TIMING or settings.SLOW_REQUEST_THRESHOLD:
+            _local.timer = req.context.timer = Timer()
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        timer = getattr(req.context, 'timer', None)
+        _local.timer = None
+        if timer is None:
+            return
+        phases = {**timer.phases, 'total': timer.total()}
+        if settings.SERVER_TIMING:
+            resp.set_header('Server-Timing', server_timing(phases))
+        threshold = settings.SLOW_REQUEST_THRESHOLD
+        if threshold and phases['total'] >= threshold:
+            logger.warning('Slow request: %s', json.dumps({
+                'method': req.method,
+                'path': req.path,
+                'query': req.query_string,
+                'status': int(resp.status[:3]),
+                'streamed': resp.stream is not None,
+                'phases': {
+                    name: round(duration * 1000, 1)
+                    for name, duration in phases.items()},
+            }))
@@ -129,30 +129,100 @@ CURRENT_OBSERVATIONS_CONDITION_MAP = {
 }
 
 
-def _find(mapping, code):
-    if code is None:
-        return
+def _compile(mapping):
+    """
+    Expand a condition map into a list indexed by code, holding the value of
+    the largest mapped code not above each code. Codes from the largest
+    mapped code onwards have no condition.
+    """
+    table = [None] * max(mapping)
     value = None
-    for k, v in mapping.items():
-        if k > code:
-            return value
-        value = v
+    for code in range(len(table)):
+        value = mapping.get(code, value)
+        table[code] = value
+    return table
+
+
+SYNOP_CURRENT_CONDITION_TABLE = _compile(SYNOP_CURRENT_CONDITION_MAP)
+SYNOP_PAST_CONDITION_TABLE = _compile(SYNOP_PAST_CONDITION_MAP)
+SYNOP_FORM_OF_PRECIPITATION_CONDITION_TABLE = _compile(
+    SYNOP_FORM_OF_PRECIPITATION_CONDITION_MAP)
+CURRENT_OBSERVATIONS_CONDITION_TABLE = _compile(
+    CURRENT_OBSERVATIONS_CONDITION_MAP)
+
+
+def _find(table, code):
+    # Also rejects None and NaN
+    if code is None or not 0 <= code < len(table):
+        return
+    return table[int(code)]
+
+
+def _find_column(table, codes):
+    size = len(table)
+    return [
+        table[int(code)] if code is not None and 0 <= code < size else None
+        for code in codes]
 
 
 def synop_current_weather_code_to_condition(code):
-    return _find(SYNOP_CURRENT_CONDITION_MAP, code)
+    return _find(SYNOP_CURRENT_CONDITION_TABLE, code)
 
 
 def synop_past_weather_code_to_condition(code):
-    return _find(SYNOP_PAST_CONDITION_MAP, code)
+    return _find(SYNOP_PAST_CONDITION_TABLE, code)
 
 
 def synop_form_of_precipitation_code_to_condition(code):
-    return _find(SYNOP_FORM_OF_PRECIPITATION_CONDITION_MAP, code)
+    return _find(SYNOP_FORM_OF_PRECIPITATION_CONDITION_TABLE, code)
 
 
 def current_observations_weather_code_to_condition(code):
-    return _find(CURRENT_OBSERVATIONS_CONDITION_MAP, code)
+    return _find(CURRENT_OBSERVATIONS_CONDITION_TABLE, code)
+
+
+# Column equivalents of the condition converters above, taking any iterable of
+# codes and looking them up without a function call per value. All other
+# converters are applied to each value by `convert_column()`.
+COLUMN_CONVERTERS = {
+    synop_current_weather_code_to_condition: lambda values: _find_column(
+        SYNOP_CURRENT_CONDITION_TABLE, values),
+    synop_past_weather_code_to_condition: lambda values: _find_column(
+        SYNOP_PAST_CONDITION_TABLE, values),
+    synop_form_of_precipitation_code_to_condition: lambda values: (
+        _find_column(SYNOP_FORM_OF_PRECIPITATION_CONDITION_TABLE, values)),
+    current_observations_weather_code_to_condition: lambda values: (
+        _find_column(CURRENT_OBSERVATIONS_CONDITION_TABLE, values)),
+}
+
+
+def convert_column(values, converter):
+    """
+    Apply the given converter function to a whole column of values, keeping
+    None values.
+    """
+    column_converter = COLUMN_CONVERTERS.get(converter)
+    if column_converter is None:
+        return [None if v is None else converter(v) for v in values]
+    return column_converter(values)
+
+
+def convert_fields(records, converters):
+    """
+    Convert the fields of the given records in place, one column at a time.
+    `converters` maps field names to converter functions.
+    """
+    if not records:
+        return
+    present = set().union(*records)
+    for field, converter in converters.items():
+        if field not in present:
+            continue
+        column = convert_column(
+            [record.get(field) for record in records], converter)
+        for record, value in zip(records, column):
+            if field in record:
+                record[field] = value
 
 
 CONVERTERS = {
@@ -164,6 +234,8 @@ CONVERTERS = {
         'sunshine_30': seconds_to_minutes,
         'sunshine_60': seconds_to_minutes,
         'temperature': kelvin_to_celsius,
+        'temperature_min': kelvin_to_celsius,
+        'temperature_max': kelvin_to_celsius,
         'wind_speed': ms_to_kmh,
         'wind_speed_10': ms_to_kmh,
         'wind_speed_30': ms_to_kmh,
@@ -177,6 +249,25 @@ CONVERTERS = {
 
 
 def convert_record(record, units):
+    convert_fields([record], CONVERTERS[units])
+
+
+def convert_records(records, units):
+    convert_fields(records, CONVERTERS[units])
+
+
+def convert_columns(columns, units):
     for field, converter in CONVERTERS[units].items():
-        if record.get(field) is not None:
-            record[field] = converter(record[field])
+        if field in columns:
+            columns[field] = convert_column(columns[field], converter)
+
+
+# SQL expressions producing the same values as the converter functions above.
+# Real columns are cast through text so that we work with the same (shortest)
+# decimal representation that psycopg2 hands to the Python converters.
+SQL_CONVERTERS = {
+    kelvin_to_celsius: 'round({}::text::numeric - 273.15, 2)::float8',
+    ms_to_kmh: 'round({}::text::numeric * 3.6, 1)::float8',
+    pa_to_hpa: '({}::numeric / 100)::float8',
+    seconds_to_minutes: '({}::numeric / 60)::float8',
+}
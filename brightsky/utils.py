@@ -4,12 +4,9 @@ import threading
 import time
 import os
 from contextlib import suppress
-from functools import lru_cache
 
 import coloredlogs
 import dateutil.parser
-from astral import Observer
-from astral.sun import daylight
 from dateutil.tz import tzlocal, tzutc
 from parsel import Selector
 
@@ -96,11 +93,6 @@ def parse_date(date_str):
     return d
 
 
-@lru_cache
-def sunrise_sunset(lat, lon, date):
-    return daylight(Observer(lat, lon), date)
-
-
 class StationIDConverter:
 
     STATION_LIST_URL = (
@@ -1,19 +1,26 @@
+import datetime
+import hashlib
 import importlib
 import sys
 from contextlib import contextmanager
 
 import falcon
 import falcon_cors
-from dateutil.tz import gettz
+from dateutil.tz import gettz, tzutc
 from falcon.errors import HTTPInvalidParam
 from gunicorn.app.base import BaseApplication
 from gunicorn.util import import_app
 
 import brightsky
-from brightsky import query
+from brightsky import formats, icons, query
+from brightsky.cache import cache_stats, cache_ttl, not_modified, ResponseCache
+from brightsky.compression import CompressionMiddleware
+from brightsky.metrics import MetricsMiddleware, MetricsResource
+from brightsky.profiling import ProfilingMiddleware
 from brightsky.settings import settings
-from brightsky.units import convert_record, CONVERTERS
-from brightsky.utils import parse_date, sunrise_sunset
+from brightsky.timing import timed, TimingMiddleware
+from brightsky.units import convert_columns, convert_records, CONVERTERS
+from brightsky.utils import parse_date
 
 
 @contextmanager
@@ -30,6 +37,8 @@ class BrightskyResource:
 
     ALLOWED_UNITS = ['si'] + list(CONVERTERS)
 
+    cache_responses = True
+
     def parse_location(self, req, required=False):
         lat = req.get_param_as_float(
             'lat', required=required, min_value=-90, max_value=90)
@@ -88,12 +97,86 @@ class BrightskyResource:
                 description="'units' must be in %s" % (self.ALLOWED_UNITS,))
         return units
 
+    def parse_format(self, req, resp):
+        with convert_exceptions():
+            format_ = formats.negotiate(req)
+        resp.vary = ['Accept']
+        return format_
+
+    def set_media(self, req, resp, result, format_):
+        resp.content_type = formats.FORMATS[format_]
+        if format_ in formats.TABULAR_FORMATS:
+            columns, sources = self.tabulate(result)
+            result = {
+                'columns': columns,
+                'sources': sources,
+                'timezone': req.get_param('tz'),
+            }
+        resp.media = result
+        # Serialize right away rather than after the responder returned, so
+        # that encoding is timed as part of the request
+        with timed('encode'):
+            resp.data
+
+    def tabulate(self, result):
+        """
+        Return the table and the sources for the tabular formats, which can
+        only hold a single table.
+        """
+        weather = result['weather']
+        if isinstance(weather, list):
+            weather = formats.to_columns(weather)
+        return weather, result['sources']
+
+    def check_not_modified(self, req, resp, sources, modified=None):
+        """
+        Set the validators and the Cache-Control header for a response built
+        from the given sources, and answer with 304 Not Modified if the
+        client's copy is still current. `modified` is looked up with
+        `query.sources_modified()` unless given.
+        """
+        if modified is None:
+            modified = query.sources_modified(sources)
+        if not modified:
+            return False
+        validator = repr((
+            req.path, sorted(req.params.items()), req.accept,
+            sorted(modified.items())))
+        etag = hashlib.sha1(validator.encode()).hexdigest()
+        last_modified = max(modified.values()).astimezone(tzutc()).replace(
+            tzinfo=None, microsecond=0)
+        resp.etag = etag
+        resp.last_modified = last_modified
+        resp.cache_control = [f'max-age={cache_ttl(sources)}']
+        if not_modified(req, etag, last_modified):
+            resp.status = falcon.HTTP_NOT_MODIFIED
+            return True
+        return False
+
+    def is_conditional(self, req):
+        return (
+            req.if_none_match is not None or
+            req.if_modified_since is not None)
+
+    def set_validators(self, req, resp, result):
+        """
+        Set the validators from the `candidate_sources` and `modified` of the
+        query result, unless they were set for a conditional request already.
+        """
+        sources = result.pop('candidate_sources')
+        modified = result.pop('modified')
+        if not self.is_conditional(req):
+            self.check_not_modified(req, resp, sources, modified)
+
     def process_timestamp(self, row, key, timezone):
         if not row[key]:
             return
+        row[key] = self.format_timestamp(row[key], timezone)
+
+    def format_timestamp(self, timestamp, timezone):
         if timezone:
-            row[key] = row[key].astimezone(timezone)
-        row[key] = row[key].isoformat()
+            timestamp = timestamp.astimezone(timezone)
+        return timestamp.isoformat()
 
     def process_sources(self, sources, timezone=None):
         for source in sources:
@@ -103,9 +186,13 @@ class BrightskyResource:
 
 class WeatherResource(BrightskyResource):
 
+    ALLOWED_LAYOUTS = ['rows', 'columns']
+    FIELDS = query.WEATHER_FIELDS
     PRECIPITATION_FIELD = 'precipitation'
     WIND_SPEED_FIELD = 'wind_speed'
 
+    json_handler = falcon.media.JSONHandler()
+
     def on_get(self, req, resp):
         date, last_date = self.parse_date_range(req)
         lat, lon = self.parse_location(req)
@@ -116,6 +203,121 @@ class WeatherResource(BrightskyResource):
         max_dist = self.parse_max_dist(req)
         timezone = self.parse_timezone(req)
         units = self.parse_units(req)
+        fields = self.parse_fields(req)
+        layout = self.parse_layout(req)
+        format_ = self.parse_format(req, resp)
+        date, last_date, timezone = self.localize_date_range(
+            date, last_date, timezone)
+        # Only conditional requests need the sources and validators before
+        # the records are queried. Otherwise, they are selected along with
+        # the records.
+        sources = None
+        if self.is_conditional(req):
+            with convert_exceptions():
+                sources = self.query_sources(
+                    date, last_date=last_date, lat=lat, lon=lon,
+                    dwd_station_id=dwd_station_id,
+                    wmo_station_id=wmo_station_id, source_id=source_id,
+                    max_dist=max_dist)
+            if self.check_not_modified(req, resp, sources):
+                return
+        tabular = format_ in formats.TABULAR_FORMATS
+        if self.query_columns and (layout == 'columns' or tabular):
+            with convert_exceptions():
+                result = self.query_columns(
+                    date, last_date=last_date, lat=lat, lon=lon,
+                    dwd_station_id=dwd_station_id,
+                    wmo_station_id=wmo_station_id, source_id=source_id,
+                    max_dist=max_dist, fields=self.query_fields(fields),
+                    sources_rows=sources)
+            self.set_validators(req, resp, result)
+            self.process_sources(result['sources'])
+            resp.context.sources = result['sources']
+            source_map = {s['id']: s for s in result['sources']}
+            self.process_columns(
+                result['weather'], units, timezone, source_map, fields,
+                keep_datetimes=format_ in formats.DATETIME_FORMATS)
+            self.set_media(req, resp, result, format_)
+            return
+        # Streaming and in-database serialization only produce JSON
+        is_json = format_ == 'json'
+        if is_json and self.query_stream and self.should_stream(
+                date, last_date):
+            with convert_exceptions():
+                result = self.query_stream(
+                    date, last_date=last_date, lat=lat, lon=lon,
+                    dwd_station_id=dwd_station_id,
+                    wmo_station_id=wmo_station_id, source_id=source_id,
+                    max_dist=max_dist,
+                    chunk_size=settings.WEATHER_STREAMING_CHUNK_SIZE,
+                    fields=self.query_fields(fields), sources_rows=sources)
+            self.set_validators(req, resp, result)
+            resp.content_type = falcon.MEDIA_JSON
+            resp.stream = self.stream_result(result, units, timezone, fields)
+            return
+        # Time zones that Postgres can't express are handled in Python
+        if is_json and settings.WEATHER_SQL_JSON and self.query_json and (
+                timezone is None or query.sql_timezone(timezone)):
+            with convert_exceptions():
+                result = self.query_json(
+                    date, last_date=last_date, lat=lat, lon=lon,
+                    dwd_station_id=dwd_station_id,
+                    wmo_station_id=wmo_station_id, source_id=source_id,
+                    max_dist=max_dist, units=units,
+                    timezone=timezone, fields=fields,
+                    sources_rows=sources)
+            self.set_validators(req, resp, result)
+            self.process_sources(result['sources'])
+            resp.context.sources = result['sources']
+            with timed('encode'):
+                resp.data = b'{"weather": %s, "sources": %s}' % (
+                    result['weather'].encode(),
+                    self.json_handler.serialize(result['sources'], None))
+            return
+        with convert_exceptions():
+            result = self.query(
+                date, last_date=last_date, lat=lat, lon=lon,
+                dwd_station_id=dwd_station_id, wmo_station_id=wmo_station_id,
+                source_id=source_id, max_dist=max_dist,
+                fields=self.query_fields(fields), sources_rows=sources)
+        self.set_validators(req, resp, result)
+        self.process_sources(result['sources'])
+        resp.context.sources = result['sources']
+        source_map = {s['id']: s for s in result['sources']}
+        self.process_rows(
+            result['weather'], units, timezone, source_map, fields,
+            keep_datetimes=format_ in formats.DATETIME_FORMATS)
+        self.set_media(req, resp, result, format_)
+
+    def parse_fields(self, req):
+        fields = req.get_param_as_list('fields')
+        if fields is None or self.FIELDS is None:
+            return None
+        unknown = set(fields) - {*self.FIELDS, 'icon'}
+        if unknown:
+            raise HTTPInvalidParam(
+                f"Unknown fields: {', '.join(sorted(unknown))}", 'fields')
+        return fields
+
+    def parse_layout(self, req):
+        layout = req.get_param('layout', default='rows').lower()
+        if layout not in self.ALLOWED_LAYOUTS:
+            raise falcon.HTTPBadRequest(
+                description="'layout' must be in %s" % (
+                    self.ALLOWED_LAYOUTS,))
+        return layout
+
+    def query_fields(self, fields):
+        """Return the fields to query for the requested output fields."""
+        if fields is None:
+            return None
+        if 'icon' in fields:
+            fields = {
+                *fields, 'cloud_cover', 'condition', self.PRECIPITATION_FIELD,
+                self.WIND_SPEED_FIELD}
+        return [f for f in self.FIELDS if f in fields]
+
+    def localize_date_range(self, date, last_date, timezone):
         if timezone:
             if not date.tzinfo:
                 date = date.replace(tzinfo=timezone)
@@ -123,59 +325,288 @@ class WeatherResource(BrightskyResource):
                 last_date = last_date.replace(tzinfo=timezone)
         elif date.tzinfo:
             timezone = date.tzinfo
-        with convert_exceptions():
-            result = self.query(
-                date, last_date=last_date, lat=lat, lon=lon,
-                dwd_station_id=dwd_station_id, wmo_station_id=wmo_station_id,
-                source_id=source_id, max_dist=max_dist)
-        self.process_sources(result['sources'])
+        return date, last_date, timezone
+
+    def should_stream(self, date, last_date):
+        threshold = settings.WEATHER_STREAMING_THRESHOLD
+        if not threshold:
+            return False
+        if not last_date:
+            last_date = date + datetime.timedelta(days=1)
+        span = last_date.replace(tzinfo=None) - date.replace(tzinfo=None)
+        return span > datetime.timedelta(hours=threshold)
+
+    def stream_result(self, result, units, timezone, fields=None):
         source_map = {s['id']: s for s in result['sources']}
-        for row in result['weather']:
-            self.process_row(row, units, timezone, source_map)
-        resp.media = result
+        used_source_ids = set()
+        separator = b''
+        yield b'{"weather": ['
+        for chunk in result['weather']:
+            for row in chunk:
+                used_source_ids.add(row['source_id'])
+                used_source_ids.update(
+                    row.get('fallback_source_ids', {}).values())
+            self.process_rows(chunk, units, timezone, source_map, fields)
+            yield separator + b', '.join(
+                self.json_handler.serialize(row, None) for row in chunk)
+            separator = b', '
+        sources = [s for s in result['sources'] if s['id'] in used_source_ids]
+        self.process_sources(sources)
+        yield b'], "sources": %s}' % self.json_handler.serialize(sources, None)
 
     def query(self, *args, **kwargs):
         return query.weather(*args, **kwargs)
 
-    def process_row(self, row, units, timezone, source_map):
-        row['icon'] = self.get_icon(row, source_map)
+    def query_sources(self, *args, **kwargs):
+        return query.weather_sources(*args, **kwargs)
+
+    def query_columns(self, *args, **kwargs):
+        return query.weather_columns(*args, **kwargs)
+
+    def query_json(self, *args, **kwargs):
+        return query.weather_json(*args, **kwargs)
+
+    def query_stream(self, *args, **kwargs):
+        return query.weather_stream(*args, **kwargs)
+
+    def process_rows(
+            self, rows, units, timezone, source_map, fields=None,
+            keep_datetimes=False):
+        if fields is None or 'icon' in fields:
+            with timed('icons'):
+                row_icons = self.get_icons(
+                    {
+                        name: [row.get(name) for row in rows]
+                        for name in [
+                            *self.icon_columns(), 'icon',
+                            'fallback_source_ids']
+                    },
+                    source_map)
+        else:
+            row_icons = [None] * len(rows)
+        for row, icon in zip(rows, row_icons):
+            # Always list the icon last
+            row.pop('icon', None)
+            if icon is not None:
+                row['icon'] = icon
+            if fields is not None:
+                self.trim_row(row, fields)
+            if not keep_datetimes:
+                self.process_timestamp(row, 'timestamp', timezone)
         if units != 'si':
-            convert_record(row, units)
-        self.process_timestamp(row, 'timestamp', timezone)
-
-    def get_icon(self, row, source_map):
-        if row['condition'] in (
-                'fog', 'sleet', 'snow', 'hail', 'thunderstorm'):
-            return row['condition']
-        precipitation = row[self.PRECIPITATION_FIELD]
-        wind_speed = row[self.WIND_SPEED_FIELD]
-        # Don't show 'rain' icon for little precipitation, and do show 'rain'
-        # icon when condition is None but there is significant precipitation
-        is_rainy = (
-            row['condition'] == 'rain' and precipitation is None) or (
-            (precipitation or 0) > settings.ICON_RAIN_THRESHOLD)
-        if is_rainy:
-            return 'rain'
-        elif (wind_speed or 0) > settings.ICON_WIND_THRESHOLD:
-            return 'wind'
-        elif (row['cloud_cover'] or 0) >= settings.ICON_CLOUDY_THRESHOLD:
-            return 'cloudy'
-        source = source_map[row['source_id']]
+            with timed('units'):
+                convert_records(rows, units)
+
+    def process_columns(
+            self, columns, units, timezone, source_map, fields=None,
+            keep_datetimes=False):
+        stored_icons = columns.pop('icon', None)
+        if fields is None or 'icon' in fields:
+            with timed('icons'):
+                columns['icon'] = self.get_icons(
+                    {**columns, 'icon': stored_icons}, source_map)
+        if fields is not None:
+            for field in self.FIELDS:
+                if field not in fields:
+                    columns.pop(field, None)
+            columns['fallback_source_ids'] = [
+                fallback_source_ids and {
+                    field: source_id
+                    for field, source_id in fallback_source_ids.items()
+                    if field in fields} or None
+                for fallback_source_ids in columns['fallback_source_ids']]
+        if units != 'si':
+            with timed('units'):
+                convert_columns(columns, units)
+        if not keep_datetimes:
+            columns['timestamp'] = [
+                self.format_timestamp(timestamp, timezone)
+                for timestamp in columns['timestamp']]
+
+    def trim_row(self, row, fields):
+        # Drop the fields that were only queried for the icon
+        for field in self.FIELDS:
+            if field not in fields:
+                row.pop(field, None)
+        fallback_source_ids = {
+            field: source_id
+            for field, source_id in row.pop('fallback_source_ids', {}).items()
+            if field in fields}
+        if fallback_source_ids:
+            row['fallback_source_ids'] = fallback_source_ids
+
+    def icon_columns(self):
+        return icons.icon_columns(
+            self.PRECIPITATION_FIELD, self.WIND_SPEED_FIELD)
+
+    def get_icons(self, columns, source_map):
+        """
+        Return the icons of the records given as columns (see
+        `icon_columns()`), preferring those stored at ingestion.
+        """
+        return icons.complete_icons(
+            columns, source_map, self.PRECIPITATION_FIELD,
+            self.WIND_SPEED_FIELD)
+
+
+class WeatherAggregateResource(WeatherResource):
+
+    def on_get(self, req, resp):
+        date, last_date = self.parse_date_range(req)
+        lat, lon = self.parse_location(req)
+        source_id, dwd_station_id, wmo_station_id = self.parse_source_ids(req)
+        max_dist = self.parse_max_dist(req)
+        timezone = self.parse_timezone(req)
+        units = self.parse_units(req)
+        resolution = req.get_param('resolution', default='day').lower()
+        format_ = self.parse_format(req, resp)
+        date, last_date, timezone = self.localize_date_range(
+            date, last_date, timezone)
+        with convert_exceptions():
+            result = query.weather_aggregate(
+                date, last_date=last_date, lat=lat, lon=lon,
+                dwd_station_id=dwd_station_id, wmo_station_id=wmo_station_id,
+                source_id=source_id, max_dist=max_dist, resolution=resolution,
+                timezone=timezone)
+        self.process_sources(result['sources'])
+        resp.context.sources = result['sources']
+        if format_ not in formats.DATETIME_FORMATS:
+            for row in result['weather']:
+                self.process_timestamp(row, 'timestamp', timezone)
+        if units != 'si':
+            with timed('units'):
+                convert_records(result['weather'], units)
+        self.set_media(req, resp, result, format_)
+
+
+class WeatherBatchResource(WeatherResource):
+
+    def on_get(self, req, resp):
+        date, last_date = self.parse_date_range(req)
+        locations = self.parse_locations(req)
+        max_dist = self.parse_max_dist(req)
+        timezone = self.parse_timezone(req)
+        units = self.parse_units(req)
+        format_ = self.parse_format(req, resp)
+        date, last_date, timezone = self.localize_date_range(
+            date, last_date, timezone)
+        with convert_exceptions():
+            results = query.weather_batch(
+                locations, date, last_date=last_date, max_dist=max_dist)
+        resp.context.sources = []
+        for (lat, lon), result in zip(locations, results):
+            self.process_sources(result['sources'])
+            resp.context.sources.extend(result['sources'])
+            source_map = {s['id']: s for s in result['sources']}
+            self.process_rows(
+                result['weather'], units, timezone, source_map,
+                keep_datetimes=format_ in formats.DATETIME_FORMATS)
+            result.update({'lat': lat, 'lon': lon})
+        self.set_media(req, resp, {'locations': results}, format_)
+
+    def tabulate(self, result):
+        # One row per location and record
+        weather = formats.to_columns([
+            {'lat': location['lat'], 'lon': location['lon'], **row}
+            for location in result['locations']
+            for row in location['weather']])
+        sources = {
+            source['id']: source
+            for location in result['locations']
+            for source in location['sources']}
+        return weather, list(sources.values())
+
+    def on_post(self, req, resp):
+        # Accept the same parameters as a JSON object
+        body = req.media
+        if not isinstance(body, dict):
+            raise falcon.HTTPBadRequest(
+                description='Please supply parameters as a JSON object')
+        for k, v in body.items():
+            if isinstance(v, list):
+                req.params[k] = [str(x) for x in v]
+            else:
+                req.params[k] = str(v)
+        self.on_get(req, resp)
+
+    def parse_locations(self, req):
+        lats = req.get_param_as_list('lat', transform=float, required=True)
+        lons = req.get_param_as_list('lon', transform=float, required=True)
+        if len(lats) != len(lons):
+            raise falcon.HTTPBadRequest(
+                description="Please supply as many 'lat' as 'lon' values")
+        if len(lats) > settings.WEATHER_BATCH_MAX_LOCATIONS:
+            raise falcon.HTTPBadRequest(
+                description='Please supply at most %d locations' % (
+                    settings.WEATHER_BATCH_MAX_LOCATIONS))
+        for name, values, limit in [('lat', lats, 90), ('lon', lons, 180)]:
+            # Also catches NaN
+            if not all(-limit <= v <= limit for v in values):
+                raise HTTPInvalidParam(
+                    f'The value must be between {-limit} and {limit}', name)
+        return list(zip(lats, lons))
+
+
+class WeatherSnapshotResource(BrightskyResource):
+
+    def on_get(self, req, resp):
+        bbox = self.parse_bbox(req)
+        date_str = req.get_param('date')
         try:
-            sunrise, sunset = sunrise_sunset(
-                source['lat'], source['lon'], row['timestamp'].date())
-        except ValueError as e:
-            daytime = 'day' if 'above' in e.args[0] else 'night'
-        else:
-            daytime = (
-                'day' if sunrise <= row['timestamp'] <= sunset else 'night')
-        if (row['cloud_cover'] or 0) >= settings.ICON_PARTLY_CLOUDY_THRESHOLD:
-            return f'partly-cloudy-{daytime}'
-        return f'clear-{daytime}'
+            date = parse_date(date_str) if date_str else None
+        except ValueError:
+            raise falcon.HTTPBadRequest(
+                description='Please supply dates in ISO 8601 format')
+        fields = req.get_param_as_list('fields')
+        timezone = self.parse_timezone(req)
+        units = self.parse_units(req)
+        format_ = self.parse_format(req, resp)
+        if date:
+            if not date.tzinfo:
+                date = date.replace(tzinfo=timezone or tzutc())
+            elif not timezone:
+                timezone = date.tzinfo
+            # Records are hourly
+            date = date.astimezone(tzutc()).replace(
+                minute=0, second=0, microsecond=0)
+        with convert_exceptions():
+            result = query.weather_snapshot(bbox, date=date, fields=fields)
+        weather = result['weather']
+        if units != 'si':
+            convert_columns(weather, units)
+        if format_ not in formats.DATETIME_FORMATS:
+            weather['timestamp'] = [
+                self.format_timestamp(timestamp, timezone)
+                for timestamp in weather['timestamp']]
+        sources = result['sources']
+        resp.context.sources = [
+            {'id': source_id, 'observation_type': observation_type}
+            for source_id, observation_type in zip(
+                sources['id'], sources['observation_type'])]
+        self.set_media(req, resp, result, format_)
+
+    def tabulate(self, result):
+        # Weather and sources columns are aligned already
+        sources = {k: v for k, v in result['sources'].items() if k != 'id'}
+        return {**result['weather'], **sources}, None
+
+    def parse_bbox(self, req):
+        bbox = req.get_param_as_list('bbox', transform=float, required=True)
+        if len(bbox) != 4:
+            raise HTTPInvalidParam(
+                'The value must contain four numbers: west, south, east, '
+                'north', 'bbox')
+        for i, limit in enumerate([180, 90, 180, 90]):
+            # Also catches NaN
+            if not -limit <= bbox[i] <= limit:
+                raise HTTPInvalidParam(
+                    'The value contains out of range coordinates', 'bbox')
+        return bbox
 
 
 class CurrentWeatherResource(WeatherResource):
 
+    FIELDS = query.CURRENT_WEATHER_FIELDS
     PRECIPITATION_FIELD = 'precipitation_10'
     WIND_SPEED_FIELD = 'wind_speed_10'
 
@@ -185,28 +616,62 @@ class CurrentWeatherResource(WeatherResource):
         max_dist = self.parse_max_dist(req)
         timezone = self.parse_timezone(req)
         units = self.parse_units(req)
+        fields = self.parse_fields(req)
+        format_ = self.parse_format(req, resp)
+        sources = None
+        if self.is_conditional(req):
+            with convert_exceptions():
+                sources = query.sources(
+                    lat=lat, lon=lon, dwd_station_id=dwd_station_id,
+                    wmo_station_id=wmo_station_id, source_id=source_id,
+                    observation_types=['synop'], max_dist=max_dist)['sources']
+            if self.check_not_modified(req, resp, sources):
+                return
         with convert_exceptions():
             result = query.current_weather(
                 lat=lat, lon=lon, dwd_station_id=dwd_station_id,
                 wmo_station_id=wmo_station_id, source_id=source_id,
-                max_dist=max_dist)
+                max_dist=max_dist, fields=self.query_fields(fields),
+                sources_rows=sources)
+        self.set_validators(req, resp, result)
         self.process_sources(result['sources'])
+        resp.context.sources = result['sources']
         source_map = {s['id']: s for s in result['sources']}
-        self.process_row(result['weather'], units, timezone, source_map)
-        resp.media = result
+        self.process_rows(
+            [result['weather']], units, timezone, source_map, fields,
+            keep_datetimes=format_ in formats.DATETIME_FORMATS)
+        self.set_media(req, resp, result, format_)
+
+    def tabulate(self, result):
+        return formats.to_columns(result['weather']), result['sources']
 
 
 class SynopResource(WeatherResource):
 
+    ALLOWED_LAYOUTS = ['rows']
+    FIELDS = None
     PRECIPITATION_FIELD = 'precipitation_10'
     WIND_SPEED_FIELD = 'wind_speed_10'
 
+    query_columns = None
+    query_json = None
+    query_stream = None
+
     def query(self, *args, **kwargs):
+        return query.synop(*args, **self.synop_kwargs(kwargs))
+
+    def query_sources(self, date, last_date=None, **kwargs):
+        return query.sources(
+            observation_types=['synop'],
+            **self.synop_kwargs(kwargs))['sources']
+
+    def synop_kwargs(self, kwargs):
         kwargs.pop('max_dist')
+        kwargs.pop('fields', None)
         if any(kwargs.pop(param) for param in ['lat', 'lon']):
             raise falcon.HTTPBadRequest(
                 "Querying by lat/lon is not supported for the synop endpoint")
-        return query.synop(*args, **kwargs)
+        return kwargs
 
 
 class SourcesResource(BrightskyResource):
@@ -215,13 +680,20 @@ class SourcesResource(BrightskyResource):
         lat, lon = self.parse_location(req)
         max_dist = self.parse_max_dist(req)
         source_id, dwd_station_id, wmo_station_id = self.parse_source_ids(req)
+        format_ = self.parse_format(req, resp)
         with convert_exceptions():
             result = query.sources(
                 lat=lat, lon=lon, dwd_station_id=dwd_station_id,
                 wmo_station_id=wmo_station_id, source_id=source_id,
                 max_dist=max_dist, ignore_type=True)
+        if self.check_not_modified(req, resp, result.get('sources', [])):
+            return
         self.process_sources(result.get('sources', []))
-        resp.media = result
+        resp.context.sources = result.get('sources', [])
+        self.set_media(req, resp, result, format_)
+
+    def tabulate(self, result):
+        return formats.to_columns(result.get('sources', [])), None
 
 
 class StatusResource:
@@ -232,6 +704,8 @@ class StatusResource:
             'version': brightsky.__version__,
             'status': 'ok',
         }
+        if settings.RESPONSE_CACHE:
+            resp.media['cache'] = cache_stats()
 
     def on_head(self, req, resp):
         pass
@@ -242,11 +716,18 @@ cors = falcon_cors.CORS(
     allow_headers_list=settings.CORS_ALLOWED_HEADERS,
     allow_all_methods=True)
 
-app = falcon.API(middleware=[cors.middleware])
+app = falcon.API(middleware=[
+    cors.middleware, MetricsMiddleware(), ProfilingMiddleware(),
+    TimingMiddleware(), ResponseCache(), CompressionMiddleware()])
 app.req_options.auto_parse_qs_csv = True
+app.resp_options.media_handlers.update(formats.media_handlers())
 
 app.add_route('/', StatusResource())
+app.add_route('/metrics', MetricsResource())
 app.add_route('/weather', WeatherResource())
+app.add_route('/weather/aggregate', WeatherAggregateResource())
+app.add_route('/weather/batch', WeatherBatchResource())
+app.add_route('/weather/snapshot', WeatherSnapshotResource())
 app.add_route('/current_weather', CurrentWeatherResource())
 app.add_route('/synop', SynopResource())
 app.add_route('/sources', SourcesResource())
@@ -1,10 +1,11 @@
+import os
 import time
 
 from huey import crontab, PriorityRedisHuey
 from huey.api import TaskLock as TaskLock_
 from huey.exceptions import TaskLockedException
 
-from brightsky import tasks
+from brightsky import profiling, tasks
 from brightsky.settings import settings
 
 
@@ -47,7 +48,8 @@ huey = ExpiringLocksHuey(
 @huey.task()
 def process(url):
     with huey.lock_task(url):
-        tasks.parse(url=url, export=True)
+        with profiling.profile(f'process-{os.path.basename(url)}'):
+            tasks.parse(url=url, export=True)
 
 
 @huey.periodic_task(
@@ -0,0 +1,18 @@
+CREATE TABLE sources_version (
+  version bigint NOT NULL
+);
+
+INSERT INTO sources_version (version) VALUES (0);
+
+-- Bumped within the modifying transaction, so that readers never see the new
+-- version before they can see the new sources
+CREATE FUNCTION bump_sources_version() RETURNS trigger AS $$
+BEGIN
+  UPDATE sources_version SET version = version + 1;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER sources_version_trigger
+  AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON sources
+  FOR EACH STATEMENT EXECUTE PROCEDURE bump_sources_version();
@@ -0,0 +1,44 @@
+-- Partial aggregates of the hourly weather records per source and UTC day,
+-- maintained by the exporter. They can be combined into aggregates over any
+-- number of days, see `brightsky.rollups`.
+CREATE TABLE weather_daily (
+  source_id                 int NOT NULL REFERENCES sources(id) ON DELETE CASCADE,
+  day                       date NOT NULL,
+  hours                     smallint NOT NULL,
+  cloud_cover_sum           numeric,
+  cloud_cover_count         smallint NOT NULL,
+  condition_dry             smallint NOT NULL,
+  condition_fog             smallint NOT NULL,
+  condition_rain            smallint NOT NULL,
+  condition_sleet           smallint NOT NULL,
+  condition_snow            smallint NOT NULL,
+  condition_hail            smallint NOT NULL,
+  condition_thunderstorm    smallint NOT NULL,
+  condition_count           smallint NOT NULL,
+  dew_point_sum             numeric,
+  dew_point_count           smallint NOT NULL,
+  precipitation_sum         numeric,
+  precipitation_count       smallint NOT NULL,
+  pressure_msl_sum          numeric,
+  pressure_msl_count        smallint NOT NULL,
+  relative_humidity_sum     numeric,
+  relative_humidity_count   smallint NOT NULL,
+  sunshine_sum              numeric,
+  sunshine_count            smallint NOT NULL,
+  temperature_sum           numeric,
+  temperature_min           real,
+  temperature_max           real,
+  temperature_count         smallint NOT NULL,
+  visibility_sum            numeric,
+  visibility_count          smallint NOT NULL,
+  wind_direction_sin        double precision,
+  wind_direction_cos        double precision,
+  wind_direction_count      smallint NOT NULL,
+  wind_speed_sum            numeric,
+  wind_speed_count          smallint NOT NULL,
+  wind_gust_speed_max       real,
+  wind_gust_direction       smallint,
+  wind_gust_speed_count     smallint NOT NULL,
+
+  CONSTRAINT weather_daily_key PRIMARY KEY (source_id, day)
+);
@@ -0,0 +1,23 @@
+-- Bit i is set if the i-th field of `query.NOT_NULL_MASK_FIELDS` is not null.
+-- Adding the stored column rewrites the whole table under an exclusive lock.
+ALTER TABLE weather ADD COLUMN not_null_mask int GENERATED ALWAYS AS (
+  (cloud_cover IS NOT NULL)::int * 1 +
+  (condition IS NOT NULL)::int * 2 +
+  (dew_point IS NOT NULL)::int * 4 +
+  (precipitation IS NOT NULL)::int * 8 +
+  (pressure_msl IS NOT NULL)::int * 16 +
+  (relative_humidity IS NOT NULL)::int * 32 +
+  (sunshine IS NOT NULL)::int * 64 +
+  (temperature IS NOT NULL)::int * 128 +
+  (visibility IS NOT NULL)::int * 256 +
+  (wind_direction IS NOT NULL)::int * 512 +
+  (wind_speed IS NOT NULL)::int * 1024 +
+  (wind_gust_direction IS NOT NULL)::int * 2048 +
+  (wind_gust_speed IS NOT NULL)::int * 4096
+) STORED;
+
+-- Allows checking the mask of fallback candidates within index-only scans
+ALTER TABLE weather
+  DROP CONSTRAINT weather_key,
+  ADD CONSTRAINT weather_key UNIQUE (source_id, timestamp)
+    INCLUDE (not_null_mask);
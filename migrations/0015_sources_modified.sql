@@ -0,0 +1,8 @@
+-- Last time the records of each source were changed, for HTTP validators.
+-- Kept apart from the sources table so that it doesn't leak into the API.
+CREATE TABLE sources_modified (
+  source_id      int PRIMARY KEY REFERENCES sources(id) ON DELETE CASCADE,
+  last_modified  timestamptz NOT NULL DEFAULT current_timestamp
+);
+
+INSERT INTO sources_modified (source_id) SELECT id FROM sources;
@@ -0,0 +1,2 @@
+-- Supports bounding box lookups, see `query.weather_snapshot()`
+CREATE INDEX sources_position ON sources USING gist (point(lon, lat));
@@ -0,0 +1,16 @@
+-- Only bump the version for rows that actually changed. The exporters' upsert
+-- into sources runs on every export, mostly without changing anything.
+DROP TRIGGER sources_version_trigger ON sources;
+
+CREATE TRIGGER sources_version_insert_delete_trigger
+  AFTER INSERT OR DELETE ON sources
+  FOR EACH ROW EXECUTE PROCEDURE bump_sources_version();
+
+CREATE TRIGGER sources_version_update_trigger
+  AFTER UPDATE ON sources
+  FOR EACH ROW WHEN (OLD.* IS DISTINCT FROM NEW.*)
+  EXECUTE PROCEDURE bump_sources_version();
+
+CREATE TRIGGER sources_version_truncate_trigger
+  AFTER TRUNCATE ON sources
+  FOR EACH STATEMENT EXECUTE PROCEDURE bump_sources_version();
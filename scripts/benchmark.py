@@ -11,6 +11,7 @@ from functools import lru_cache
 from multiprocessing import cpu_count
 
 import click
+import falcon
 import psycopg2
 from dateutil.tz import tzutc
 from falcon.testing import TestClient
@@ -128,18 +129,22 @@ def _query_parallel(path, kwargs_list, **base_kwargs):
                 client.simulate_get, path, params={**base_kwargs, **kwargs})
 
 
-@cli.command('query', help='Query records from database')
-def query_():
-    # Generate 50 random locations within Germany's bounding box. Locations
-    # and sources will be the same across different runs since we hard-code the
+def _random_locations(n=100):
+    # Generate random locations within Germany's bounding box. Locations and
+    # sources will be the same across different runs since we hard-code the
     # PRNG seed.
     random.seed(1)
-    location_kwargs = [
+    return [
         {
             'lat': random.uniform(47.30, 54.98),
             'lon': random.uniform(5.99, 15.02),
         }
-        for _ in range(100)]
+        for _ in range(n)]
+
+
+@cli.command('query', help='Query records from database')
+def query_():
+    location_kwargs = _random_locations()
     with db.get_connection() as conn:
         with conn.cursor() as cur:
             cur.execute(
@@ -215,6 +220,31 @@ def query_():
         _query_parallel('/current_weather', station_kwargs)
 
 
+@cli.command(help='Compare row and column layout of weather responses')
+def layout():
+    client = get_client()
+    json_handler = falcon.media.JSONHandler()
+    location_kwargs = _random_locations()
+    for layout_ in ['rows', 'columns']:
+        click.echo(f'Layout {layout_!r}:')
+        size = 0
+        bodies = []
+        with _time('  100 one-week queries, sequential', precision=2):
+            for kwargs in location_kwargs:
+                resp = client.simulate_get('/weather', params={
+                    'date': '2020-02-14',
+                    'last_date': '2020-02-21',
+                    'layout': layout_,
+                    **kwargs,
+                })
+                size += len(resp.content)
+                bodies.append(resp.json)
+        with _time('  100 one-week responses, serialized', precision=2):
+            for body in bodies:
+                json_handler.serialize(body, None)
+        click.echo(f'  Total payload size:          {size / 1024:8.0f} kB\n')
+
+
 if __name__ == '__main__':
     configure_logging()
     cli()
@@ -36,9 +36,15 @@ setup(
         'gunicorn',
         'huey[redis]',
         'parsel',
+        'prometheus-client',
         'psycopg2-binary',
         'python-dateutil',
         'requests',
         'sentry-sdk',
     ],
+    extras_require={
+        'arrow': ['pyarrow'],
+        'compression': ['brotli', 'zstandard'],
+        'msgpack': ['msgpack'],
+    },
 )
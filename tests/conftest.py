@@ -85,6 +85,28 @@ def db(_database):
             """)
 
 
+@pytest.fixture
+def response_cache():
+    if not os.getenv('BRIGHTSKY_TEST_REDIS_URL'):
+        pytest.skip('See README for running Redis-based tests.')
+    from brightsky.cache import get_redis, KEY_PREFIX
+    from brightsky.settings import settings
+    overrides = {
+        'REDIS_URL': os.getenv('BRIGHTSKY_TEST_REDIS_URL'),
+        'RESPONSE_CACHE': True,
+    }
+    original = {k: settings[k] for k in overrides}
+    settings.update(overrides)
+    client = get_redis()
+    try:
+        yield client
+    finally:
+        keys = client.keys(f'{KEY_PREFIX}*')
+        if keys:
+            client.delete(*keys)
+        settings.update(original)
+
+
 @pytest.fixture(scope='session')
 def api():
     from brightsky.web import app
@@ -0,0 +1,109 @@
+import datetime
+import gzip
+import json
+
+from dateutil.tz import tzutc
+
+from brightsky.cache import cache_ttl
+from brightsky.export import DBExporter, SYNOPExporter
+
+from .test_web import FORECAST_RECORDS, RECENT_RECORDS, SYNOP_RECORDS
+from .utils import settings
+
+
+def test_cache_ttl():
+    now = datetime.datetime(2020, 8, 20, 12, 45, tzinfo=tzutc())
+    sources = [
+        {'observation_type': t}
+        for t in ['historical', 'recent', 'current', 'forecast']]
+    with settings(
+            RESPONSE_CACHE_TTL_HISTORICAL=86400,
+            RESPONSE_CACHE_TTL_RECENT=900,
+            RESPONSE_CACHE_TTL_CURRENT=300):
+        assert cache_ttl(sources[:1], now=now) == 86400
+        assert cache_ttl(sources[:2], now=now) == 900
+        assert cache_ttl(sources[:3], now=now) == 300
+        assert cache_ttl(sources[3:], now=now) == 900
+        assert cache_ttl(sources, now=now) == 300
+        assert cache_ttl([], now=now) is None
+
+
+def test_response_cache(db, api, response_cache):
+    DBExporter().export(RECENT_RECORDS + FORECAST_RECORDS)
+    path = '/weather?lat=52&lon=7.6&date=2020-08-20'
+    expected = api.simulate_get(path)
+    assert api.simulate_get('/').json['cache'] == {'hits': 0, 'misses': 1}
+    with db.cursor() as cur:
+        cur.execute("UPDATE weather SET temperature = 300")
+    db.commit()
+    resp = api.simulate_get(path)
+    assert resp.status_code == 200
+    assert resp.headers['Content-Type'] == expected.headers['Content-Type']
+    assert resp.json == expected.json
+    assert api.simulate_get('/').json['cache'] == {'hits': 1, 'misses': 1}
+    # Unrelated sources leave the cached response alone
+    SYNOPExporter().export(SYNOP_RECORDS)
+    assert api.simulate_get(path).json == expected.json
+    DBExporter().export(RECENT_RECORDS[-1:])
+    resp = api.simulate_get(path)
+    assert resp.json != expected.json
+    assert resp.json['weather'][0]['temperature'] == 26.85
+
+
+def test_response_cache_skips_errors(db, api, response_cache):
+    assert api.simulate_get('/sources?lat=52&lon=7.6').status_code == 404
+    assert not response_cache.keys('*response*')
+    assert api.simulate_get('/sources?lat=52&lon=7.6').status_code == 404
+    assert api.simulate_get('/').json['cache'] == {'hits': 0, 'misses': 2}
+
+
+def test_response_cache_conditional_get(db, api, response_cache):
+    DBExporter().export(RECENT_RECORDS)
+    path = '/weather?lat=52&lon=7.6&date=2020-08-20'
+    expected = api.simulate_get(path)
+    resp = api.simulate_get(path)
+    assert api.simulate_get('/').json['cache'] == {'hits': 1, 'misses': 1}
+    for header in ['ETag', 'Last-Modified', 'Content-Type']:
+        assert resp.headers[header] == expected.headers[header]
+    assert resp.headers['Cache-Control'].startswith('max-age=')
+    resp = api.simulate_get(
+        path, headers={'If-None-Match': expected.headers['ETag']})
+    assert resp.status_code == 304
+    assert not resp.content
+    assert api.simulate_get('/').json['cache'] == {'hits': 2, 'misses': 1}
+
+
+def test_response_cache_compressed(db, api, response_cache):
+    DBExporter().export(RECENT_RECORDS)
+    path = '/weather?lat=52&lon=7.6&date=2020-08-20'
+    headers = {'Accept-Encoding': 'gzip'}
+    expected = api.simulate_get(path, headers=headers)
+    assert expected.headers['Content-Encoding'] == 'gzip'
+    resp = api.simulate_get(path, headers=headers)
+    assert api.simulate_get('/').json['cache'] == {'hits': 1, 'misses': 1}
+    # The compressed body is stored and served as is
+    assert resp.content == expected.content
+    for header in ['Content-Encoding', 'ETag', 'Vary']:
+        assert resp.headers[header] == expected.headers[header]
+    resp = api.simulate_get(
+        path, headers={**headers, 'If-None-Match': expected.headers['ETag']})
+    assert resp.status_code == 304
+    assert 'Content-Encoding' not in resp.headers
+    assert resp.headers['ETag'] == expected.headers['ETag']
+    # Uncompressed responses are cached separately
+    resp = api.simulate_get(path)
+    assert 'Content-Encoding' not in resp.headers
+    assert resp.json == json.loads(gzip.decompress(expected.content))
+    assert api.simulate_get('/').json['cache'] == {'hits': 2, 'misses': 2}
+
+
+def test_response_cache_redis_down(db, api):
+    DBExporter().export(RECENT_RECORDS)
+    # Nothing listens on port 1
+    with settings(RESPONSE_CACHE=True, REDIS_URL='redis://localhost:1'):
+        resp = api.simulate_get('/')
+        assert resp.status_code == 200
+        assert resp.json['cache'] is None
+        resp = api.simulate_get('/weather?lat=52&lon=7.6&date=2020-08-20')
+        assert resp.status_code == 200
+        assert resp.json['weather']
@@ -0,0 +1,103 @@
+import gzip
+import json
+
+import falcon
+import pytest
+from falcon.testing import create_environ
+
+from brightsky.compression import (
+    compress, compress_stream, encoding_etag, negotiate, strip_etag_encoding)
+from brightsky.export import DBExporter
+
+from .test_web import RECENT_RECORDS
+from .utils import settings
+
+
+def _decompress(data, encoding):
+    if encoding == 'gzip':
+        return gzip.decompress(data)
+    elif encoding == 'br':
+        return pytest.importorskip('brotli').decompress(data)
+    elif encoding == 'zstd':
+        zstandard = pytest.importorskip('zstandard')
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+
+
+@pytest.mark.parametrize('accept_encoding, expected', [
+    (None, None),
+    ('identity', None),
+    ('gzip', 'gzip'),
+    ('GZIP;q=0.5', 'gzip'),
+    ('gzip;q=0', None),
+    ('gzip, deflate, br, zstd', 'br'),
+    ('gzip, br;q=0.9', 'gzip'),
+    ('*', 'br'),
+    ('*;q=0.5, br;q=0', 'zstd'),
+])
+def test_negotiate(accept_encoding, expected):
+    pytest.importorskip('brotli')
+    pytest.importorskip('zstandard')
+    headers = {'Accept-Encoding': accept_encoding} if accept_encoding else {}
+    req = falcon.Request(create_environ(headers=headers))
+    assert negotiate(req) == expected
+    with settings(COMPRESSION_ENCODINGS=['gzip']):
+        assert negotiate(req) == (expected and 'gzip')
+
+
+@pytest.mark.parametrize('encoding', ['gzip', 'br', 'zstd'])
+def test_compress(encoding):
+    data = b'{"weather": [%s]}' % b', '.join([b'{"temperature": 12.3}'] * 100)
+    compressed = compress(data, encoding)
+    assert len(compressed) < len(data)
+    assert _decompress(compressed, encoding) == data
+    chunks = [data[i:i+100] for i in range(0, len(data), 100)]
+    streamed = b''.join(compress_stream(iter(chunks), encoding))
+    assert _decompress(streamed, encoding) == data
+
+
+def test_etag_encoding():
+    assert encoding_etag('abc', 'gzip') == 'abc-gzip'
+    assert encoding_etag('abc-br', 'gzip') == 'abc-gzip'
+    assert strip_etag_encoding('abc-gzip') == 'abc'
+    assert strip_etag_encoding('abc') == 'abc'
+    assert strip_etag_encoding('abc-def') == 'abc-def'
+
+
+@pytest.mark.parametrize('config', [
+    {},
+    {'WEATHER_SQL_JSON': True},
+    {'WEATHER_STREAMING_THRESHOLD': 1, 'WEATHER_STREAMING_CHUNK_SIZE': 5},
+])
+def test_compressed_response(db, api, config):
+    DBExporter().export(RECENT_RECORDS)
+    path = '/weather?lat=52&lon=7.6&date=2020-08-20'
+    with settings(**config):
+        expected = api.simulate_get(path)
+        resp = api.simulate_get(path, headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in expected.headers
+    assert expected.headers['Vary'] == 'Accept, Accept-Encoding'
+    assert resp.headers['Content-Encoding'] == 'gzip'
+    assert resp.headers['Vary'] == 'Accept, Accept-Encoding'
+    assert json.loads(gzip.decompress(resp.content)) == expected.json
+    assert resp.headers['ETag'] == '"%s-gzip"' % (
+        expected.headers['ETag'].strip('"'))
+    # Both entity tags validate both representations
+    for etag in [expected.headers['ETag'], resp.headers['ETag']]:
+        resp = api.simulate_get(
+            path, headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+        assert resp.status_code == 304
+        assert resp.headers['ETag'] == '"%s-gzip"' % (
+            expected.headers['ETag'].strip('"'))
+
+
+def test_compression_min_size(db, api):
+    DBExporter().export(RECENT_RECORDS)
+    path = '/weather?lat=52&lon=7.6&date=2020-08-20'
+    with settings(COMPRESSION_MIN_SIZE=10**9):
+        resp = api.simulate_get(path, headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in resp.headers
+    assert resp.json['weather']
+    with settings(COMPRESSION_ENCODINGS=[]):
+        resp = api.simulate_get(path, headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in resp.headers
+    assert resp.headers['Vary'] == 'Accept'
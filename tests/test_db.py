@@ -1,5 +1,116 @@
 import os
+import threading
+import time
+
+import psycopg2
+import pytest
+
+from brightsky import db as bs_db
+from brightsky.db import _create_pool, _get_read_pool, fetch, get_connection
+
+from .utils import settings
 
 
 def test_migrate(db):
     assert len(db.table('migrations')) == len(os.listdir('migrations'))
+
+
+@pytest.fixture
+def replicas(db):
+    urls = [os.getenv('BRIGHTSKY_DATABASE_URL')] * 2
+    with settings(READ_DATABASE_URL=urls):
+        yield
+        if hasattr(get_connection, '_read_pools'):
+            for pool in get_connection._read_pools:
+                pool.closeall()
+            del get_connection._read_pools
+            del get_connection._read_urls
+
+
+def test_fetch_uses_read_replicas(replicas):
+    assert fetch('SELECT 1 AS x', read_only=True)[0]['x'] == 1
+    pools = get_connection._read_pools
+    assert len(pools) == 2
+    used_pools = [_get_read_pool() for _ in range(4)]
+    assert used_pools in ([*pools, *pools], [*pools[::-1], *pools[::-1]])
+
+
+def test_random_read_replica_selection(replicas, monkeypatch):
+    choices = []
+
+    def choice(pools):
+        choices.append(pools)
+        return pools[-1]
+
+    monkeypatch.setattr(bs_db.random, 'choice', choice)
+    with settings(READ_DATABASE_SELECTION='random'):
+        assert fetch('SELECT 1 AS x', read_only=True)[0]['x'] == 1
+        assert _get_read_pool() is get_connection._read_pools[-1]
+    assert choices == [get_connection._read_pools] * 2
+
+
+def _is_read_only(read_only=True):
+    rows = fetch('SHOW default_transaction_read_only', read_only=read_only)
+    return rows[0][0] == 'on'
+
+
+def test_read_replica_connections_are_read_only(replicas):
+    assert _is_read_only()
+    with pytest.raises(psycopg2.errors.ReadOnlySqlTransaction):
+        fetch('CREATE TABLE forbidden (id int)', read_only=True)
+
+
+def test_fetch_uses_primary_by_default(replicas):
+    # Workers must see their own writes, e.g. the poller the parsed files
+    assert not _is_read_only(read_only=False)
+    assert fetch('SELECT 1 AS x')[0]['x'] == 1
+    assert not hasattr(get_connection, '_read_pools')
+
+
+def test_read_your_writes_window(replicas):
+    with settings(READ_YOUR_WRITES_WINDOW=60.):
+        with get_connection():
+            pass
+        assert not _is_read_only()
+    assert _is_read_only()
+
+
+def test_connection_pool_size(db, monkeypatch):
+    url = os.getenv('BRIGHTSKY_DATABASE_URL')
+    monkeypatch.setenv('SERVER_SOFTWARE', 'gunicorn/20.0.4')
+    for threads, maxconn in [(1, 1), (8, 8)]:
+        with settings(WEB_THREADS=threads):
+            pool = _create_pool(url)
+        assert (pool.minconn, pool.maxconn) == (1, maxconn)
+        pool.closeall()
+
+
+def test_pool_is_created_once_by_concurrent_threads(db, monkeypatch):
+    created = []
+
+    def create_pool(url, **kwargs):
+        # Widen the window for a race
+        time.sleep(.05)
+        pool = _create_pool(url, **kwargs)
+        created.append(pool)
+        return pool
+
+    # The previous pool is restored after the test
+    monkeypatch.delattr(get_connection, '_pool', raising=False)
+    monkeypatch.setattr(bs_db, '_create_pool', create_pool)
+    barrier = threading.Barrier(4)
+    used_pools = []
+
+    def connect():
+        barrier.wait()
+        with get_connection():
+            used_pools.append(get_connection._pool)
+
+    threads = [threading.Thread(target=connect) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    created[0].closeall()
+    assert len(created) == 1
+    assert used_pools == created * 4
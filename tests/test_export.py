@@ -4,6 +4,8 @@ from dateutil.tz import tzutc
 import pytest
 
 from brightsky.export import DBExporter, SYNOPExporter
+from brightsky.icons import TABLES as ICON_TABLES
+from brightsky.query import _not_null_mask, NOT_NULL_MASK_FIELDS
 
 
 SOURCES = [
@@ -103,6 +105,19 @@ def test_db_exporter_reuses_existing_sources(db, exporter):
     assert db_sources[2]['id'] == db_sources[0]['id'] + 2
 
 
+def test_db_exporter_bumps_sources_version_on_changes(db, exporter):
+    def version():
+        return db.fetch("SELECT version FROM sources_version")[0]['version']
+
+    initial_version = version()
+    # Same sources and records
+    exporter.export([{**SOURCES[0], **RECORDS[0]}])
+    assert version() == initial_version
+    # Extends the source's records
+    exporter.export([{**SOURCES[0], **RECORDS[2]}])
+    assert version() > initial_version
+
+
 def test_db_exporter_creates_new_records(db, exporter):
     db_records = _query_records(db)
     for record, source, row in zip(RECORDS[:2], SOURCES[:2], db_records):
@@ -122,6 +137,73 @@ def test_db_exporter_updates_existing_records(db, exporter):
         assert db_records[0][k] == v
 
 
+def test_db_exporter_maintains_not_null_mask(db, exporter):
+    assert [r['not_null_mask'] for r in _query_records(db)] == [
+        _not_null_mask(['precipitation', 'temperature'])] * 2
+    # Every element field must have its own bit
+    exporter.export([{
+        **SOURCES[0],
+        **RECORDS[0],
+        **{f: 1 for f in NOT_NULL_MASK_FIELDS},
+        'condition': 'dry',
+    }])
+    assert _query_records(db)[0]['not_null_mask'] == (
+        2 ** len(NOT_NULL_MASK_FIELDS) - 1)
+    assert sorted(NOT_NULL_MASK_FIELDS) == sorted(DBExporter.ELEMENT_FIELDS)
+
+
+def test_db_exporter_stores_icons(db, exporter):
+    exporter.export([{**SOURCES[0], **RECORDS[0], 'cloud_cover': 100}])
+    assert _query_records(db)[0]['icon'] == 'cloudy'
+    # Icons are derived from the records as stored, i.e. merged with the
+    # fields of earlier exports
+    exporter.export([{
+        **SOURCES[0],
+        'timestamp': RECORDS[0]['timestamp'],
+        'temperature': 280.15,
+    }])
+    assert _query_records(db)[0]['icon'] == 'cloudy'
+    exporter.export([{
+        **SOURCES[0],
+        'timestamp': RECORDS[0]['timestamp'],
+        'wind_speed': 15.,
+    }])
+    assert _query_records(db)[0]['icon'] == 'wind'
+
+
+@pytest.mark.parametrize('exporter_class', [DBExporter, SYNOPExporter])
+def test_db_exporter_updates_only_merged_icons(
+        db, monkeypatch, exporter_class):
+    updated = []
+    monkeypatch.setattr(
+        'brightsky.export.update_icons',
+        lambda conn, table, rows, source_map: updated.extend(rows))
+    exporter = exporter_class()
+    table = exporter.WEATHER_TABLE
+    precipitation, wind_speed = ICON_TABLES[table]
+    timestamp = RECORDS[0]['timestamp']
+    record = {
+        **SOURCES[0],
+        'timestamp': timestamp,
+        'cloud_cover': 100,
+        'condition': 'dry',
+        precipitation: 0.,
+        wind_speed: 1.,
+    }
+    exporter.export([record.copy()])
+    assert _query_records(db, table=table)[0]['icon'] == 'cloudy'
+    exporter.export([{**record, wind_speed: 15.}])
+    assert _query_records(db, table=table)[0]['icon'] == 'wind'
+    # Records without any of the icon inputs leave the stored icon be
+    exporter.export([{**SOURCES[0], 'timestamp': timestamp, 'temperature': 1}])
+    assert _query_records(db, table=table)[0]['icon'] == 'wind'
+    assert updated == []
+    # Icon inputs merged with the stored ones
+    exporter.export([
+        {**SOURCES[0], 'timestamp': timestamp, 'cloud_cover': 0}])
+    assert [row[1] for row in updated] == [timestamp]
+
+
 def test_db_exporter_updates_parsed_files(db, exporter):
     parsed_files = db.fetch("SELECT * FROM parsed_files")
     assert len(parsed_files) == 1
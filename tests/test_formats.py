@@ -0,0 +1,99 @@
+import csv
+import datetime
+import io
+
+import falcon
+import pytest
+from dateutil.tz import tzoffset, tzutc
+from falcon.testing import create_environ
+
+from brightsky.formats import (
+    ArrowHandler, CSVHandler, negotiate, to_columns)
+
+
+TABLE = {
+    'columns': {
+        'timestamp': [
+            '2020-08-20T00:00:00+02:00', '2020-08-20T01:00:00+02:00'],
+        'source_id': [1, 2],
+        'temperature': [18.5, None],
+        'cloud_cover': [50, 100],
+        'condition': ['dry', 'rain'],
+        'fallback_source_ids': [None, {'temperature': 3}],
+    },
+    'sources': [{'id': 1}, {'id': 2}],
+    'timezone': 'Europe/Berlin',
+}
+
+
+@pytest.mark.parametrize('query_string, accept, expected', [
+    ('', None, 'json'),
+    ('', '*/*', 'json'),
+    ('', 'text/csv', 'csv'),
+    ('', 'application/msgpack, */*;q=0.1', 'msgpack'),
+    ('', 'application/vnd.apache.arrow.stream', 'arrow'),
+    ('', 'image/png', 'json'),
+    ('format=CSV', 'application/msgpack', 'csv'),
+])
+def test_negotiate(query_string, accept, expected):
+    headers = {'Accept': accept} if accept else {}
+    req = falcon.Request(
+        create_environ(query_string=query_string, headers=headers))
+    assert negotiate(req) == expected
+
+
+def test_negotiate_invalid_format():
+    with pytest.raises(ValueError):
+        negotiate(falcon.Request(create_environ(query_string='format=xml')))
+
+
+def test_to_columns():
+    assert to_columns([{'a': 1}, {'a': 2, 'b': 3}]) == {
+        'a': [1, 2], 'b': [None, 3]}
+    assert to_columns({'a': 1}) == {'a': [1]}
+    assert to_columns([]) == {}
+
+
+def test_csv_handler():
+    data = CSVHandler().serialize(TABLE, None)
+    rows = list(csv.reader(io.StringIO(data.decode())))
+    assert rows == [
+        list(TABLE['columns']),
+        ['2020-08-20T00:00:00+02:00', '1', '18.5', '50', 'dry', ''],
+        [
+            '2020-08-20T01:00:00+02:00', '2', '', '100', 'rain',
+            '{"temperature":3}',
+        ],
+    ]
+
+
+@pytest.mark.parametrize('timestamps', [
+    None,
+    [
+        datetime.datetime(2020, 8, 19, 22, tzinfo=tzutc()),
+        datetime.datetime(2020, 8, 20, 1, tzinfo=tzoffset(None, 7200)),
+    ],
+])
+def test_arrow_handler(timestamps):
+    pa = pytest.importorskip('pyarrow')
+    media = TABLE
+    if timestamps:
+        media = {
+            **TABLE, 'columns': {**TABLE['columns'], 'timestamp': timestamps}}
+    data = ArrowHandler().serialize(media, None)
+    table = pa.ipc.open_stream(data).read_all()
+    schema = table.schema
+    assert schema.field('timestamp').type == pa.timestamp(
+        's', tz='Europe/Berlin')
+    assert schema.field('source_id').type == pa.int32()
+    assert schema.field('temperature').type == pa.float32()
+    assert schema.field('cloud_cover').type == pa.int16()
+    assert pa.types.is_dictionary(schema.field('condition').type)
+    assert schema.metadata[b'sources'] == b'[{"id": 1}, {"id": 2}]'
+    records = table.to_pylist()
+    assert records[0]['timestamp'].isoformat() == '2020-08-20T00:00:00+02:00'
+    assert records[1]['timestamp'].isoformat() == '2020-08-20T01:00:00+02:00'
+    assert records[0]['temperature'] == 18.5
+    assert records[1]['temperature'] is None
+    assert records[1]['condition'] == 'rain'
+    assert records[1]['fallback_source_ids'] == [('temperature', 3)]
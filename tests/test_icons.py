@@ -0,0 +1,81 @@
+import datetime
+
+from dateutil.tz import tzutc
+
+from brightsky.export import DBExporter, SYNOPExporter
+from brightsky.icons import complete_icons, derive_icons, rederive_icons
+
+from .utils import settings
+
+
+SOURCE = {
+    'observation_type': 'historical',
+    'lat': 52,
+    'lon': 7.6,
+    'height': 60,
+    'wmo_station_id': '10315',
+    'dwd_station_id': '01766',
+    'station_name': 'Münster',
+}
+NOON = datetime.datetime(2020, 8, 18, 12, tzinfo=tzutc())
+MIDNIGHT = datetime.datetime(2020, 8, 18, tzinfo=tzutc())
+
+
+def _columns(**columns):
+    n = len(next(iter(columns.values())))
+    return {
+        'source_id': [1] * n,
+        'timestamp': [NOON] * n,
+        'condition': [None] * n,
+        'precipitation': [None] * n,
+        'wind_speed': [None] * n,
+        'cloud_cover': [None] * n,
+        **columns,
+    }
+
+
+def test_derive_icons():
+    source_map = {1: {'id': 1, 'lat': 52, 'lon': 7.6}}
+    columns = _columns(
+        timestamp=[NOON, MIDNIGHT, NOON, NOON, NOON, NOON, MIDNIGHT],
+        condition=['snow', 'rain', 'rain', None, 'dry', None, None],
+        precipitation=[None, None, 0.1, 2., None, None, None],
+        wind_speed=[None, None, None, None, 12., None, None],
+        cloud_cover=[None, None, 50, None, None, 90, 30])
+    assert derive_icons(columns, source_map) == [
+        'snow', 'rain', 'partly-cloudy-day', 'rain', 'wind', 'cloudy',
+        'partly-cloudy-night']
+    with settings(ICON_CLOUDY_THRESHOLD=95):
+        assert derive_icons(columns, source_map)[5] == 'partly-cloudy-day'
+
+
+def test_complete_icons():
+    source_map = {1: {'id': 1, 'lat': 52, 'lon': 7.6}}
+    columns = _columns(
+        cloud_cover=[100, 100, 100, 100],
+        icon=['fog', None, 'fog', 'fog'],
+        fallback_source_ids=[
+            None, None, {'cloud_cover': 2}, {'temperature': 2}])
+    assert complete_icons(columns, source_map) == [
+        'fog', 'cloudy', 'cloudy', 'fog']
+    del columns['icon']
+    assert complete_icons(columns, source_map) == ['cloudy'] * 4
+
+
+def test_rederive_icons(db):
+    DBExporter().export([
+        {**SOURCE, 'timestamp': NOON + datetime.timedelta(hours=i),
+         'cloud_cover': 50}
+        for i in range(3)
+    ])
+    now = datetime.datetime.utcnow().replace(
+        minute=0, second=0, microsecond=0, tzinfo=tzutc())
+    SYNOPExporter().export([{
+        **SOURCE, 'observation_type': 'synop', 'timestamp': now,
+        'condition': 'dry', 'cloud_cover': 50, 'precipitation_10': 0.,
+        'wind_speed_10': 1.,
+    }])
+    with settings(ICON_CLOUDY_THRESHOLD=40):
+        rederive_icons(chunk_size=2)
+    for table in ['weather', 'synop', 'current_weather']:
+        assert {row['icon'] for row in db.table(table)} == {'cloudy'}
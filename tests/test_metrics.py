@@ -0,0 +1,118 @@
+import shutil
+
+import pytest
+from prometheus_client import CollectorRegistry, generate_latest
+from psycopg2.pool import PoolError
+
+from brightsky import metrics
+from brightsky.db import get_connection
+from brightsky.export import DBExporter, SYNOPExporter
+from brightsky.metrics import HueyCollector
+from brightsky.tasks import parse
+
+from .test_web import RECENT_RECORDS
+from .utils import settings
+
+
+def _value(name, **labels):
+    return metrics.REGISTRY.get_sample_value(name, labels) or 0
+
+
+def test_request_metrics(db, api):
+    DBExporter().export(RECENT_RECORDS)
+    labels = {'resource': 'WeatherResource', 'method': 'GET'}
+    ok = _value('brightsky_requests_total', status='200', **labels)
+    bad = _value('brightsky_requests_total', status='400', **labels)
+    observed = _value(
+        'brightsky_request_duration_seconds_count',
+        resource='WeatherResource')
+    checkouts = _value('brightsky_db_checkouts_total', pool='primary')
+    api.simulate_get('/weather?lat=52&lon=7.6&date=2020-08-20')
+    api.simulate_get('/weather?lat=52&lon=7.6')
+    assert _value('brightsky_requests_total', status='200', **labels) == (
+        ok + 1)
+    assert _value('brightsky_requests_total', status='400', **labels) == (
+        bad + 1)
+    assert _value(
+        'brightsky_request_duration_seconds_count',
+        resource='WeatherResource') == observed + 2
+    assert _value('brightsky_db_checkouts_total', pool='primary') > checkouts
+
+
+def test_db_pool_exhausted_metrics(db, monkeypatch):
+    exhausted = _value('brightsky_db_pool_exhausted_total', pool='primary')
+
+    def getconn(*args, **kwargs):
+        raise PoolError('connection pool exhausted')
+
+    with get_connection():
+        pool = get_connection._pool
+    monkeypatch.setattr(pool, 'getconn', getconn)
+    with pytest.raises(PoolError):
+        with get_connection():
+            pass
+    assert _value('brightsky_db_pool_exhausted_total', pool='primary') == (
+        exhausted + 1)
+
+
+def test_metrics_endpoint(api):
+    assert api.simulate_get('/metrics').status_code == 404
+    with settings(METRICS=True):
+        api.simulate_get('/')
+        resp = api.simulate_get('/metrics')
+    assert resp.status_code == 200
+    assert resp.headers['Content-Type'].startswith('text/plain')
+    assert (
+        'brightsky_requests_total{method="GET",resource="StatusResource",'
+        'status="200"}') in resp.text
+
+
+def test_metrics_endpoint_multiprocess(api, monkeypatch, tmp_path):
+    monkeypatch.setenv('PROMETHEUS_MULTIPROC_DIR', str(tmp_path))
+    with settings(METRICS=True):
+        resp = api.simulate_get('/metrics')
+    assert resp.status_code == 200
+    # Only reads the metrics files of the workers
+    assert 'brightsky_requests_total' not in resp.text
+
+
+def test_parse_metrics(db, data_dir, tmp_path):
+    path = tmp_path / 'stundenwerte_TU_01766_akt.zip'
+    shutil.copy(data_dir / 'observations_recent_TU_akt.zip', path)
+    labels = {'parser': 'TemperatureObservationsParser'}
+    parsed = _value('brightsky_parsed_records_total', **labels)
+    records = parse(path=str(path), export=True)
+    assert _value('brightsky_parsed_records_total', **labels) == (
+        parsed + len(records))
+    assert _value('brightsky_parse_duration_seconds_count', **labels) >= 1
+    assert _value('brightsky_export_duration_seconds_count', **labels) >= 1
+
+
+def test_current_weather_refresh_metrics(db):
+    name = 'brightsky_current_weather_refresh_duration_seconds_count'
+    refreshes = _value(name)
+    SYNOPExporter().export([{
+        **RECENT_RECORDS[0], 'observation_type': 'synop', 'temperature': 290.,
+    }])
+    assert _value(name) == refreshes + 1
+
+
+class HueyStub:
+
+    name = 'brightsky'
+
+    class storage:
+
+        def result_items():
+            return {b'brightsky.lock.a': b'1', b'brightsky.lock.b': b'1'}
+
+    def pending_count(self):
+        return 3
+
+
+def test_huey_collector():
+    registry = CollectorRegistry()
+    registry.register(HueyCollector(HueyStub()))
+    assert registry.get_sample_value('brightsky_queue_depth') == 3
+    assert registry.get_sample_value('brightsky_task_locks') == 2
+    assert b'brightsky_queue_depth 3.0' in generate_latest(registry)
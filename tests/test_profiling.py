@@ -0,0 +1,99 @@
+import os
+import time
+
+import pytest
+
+from brightsky import profiling
+from brightsky.profiling import profile, Profiler
+from brightsky.settings import settings as bs_settings
+
+from .utils import settings
+
+
+@pytest.fixture(autouse=True)
+def load_settings():
+    # Overrides are lost if the settings are only loaded within them
+    bs_settings.PROFILE_DIR
+
+
+def busy_loop(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+def _read_profiles(path):
+    profiles = {}
+    for filename in sorted(os.listdir(path)):
+        with open(path / filename) as f:
+            profiles[filename] = {
+                stack: int(count)
+                for stack, count in (
+                    line.rsplit(' ', 1) for line in f.read().splitlines())
+            }
+    return profiles
+
+
+def test_profile(tmp_path):
+    with settings(PROFILE_DIR=str(tmp_path), PROFILE_INTERVAL=0.001):
+        with profile('busy loop/1'):
+            busy_loop(0.01)
+        with settings(PROFILE_RATE=1.):
+            with profile('busy loop/2'):
+                busy_loop(0.1)
+    [(filename, stacks)] = _read_profiles(tmp_path).items()
+    assert filename.endswith(f'-{os.getpid()}-busy_loop_2.folded')
+    busy_stacks = [stack for stack in stacks if 'busy_loop' in stack]
+    assert busy_stacks
+    # Outermost function first
+    assert all(
+        stack.index('tests.test_profiling:test_profile') <
+        stack.index('tests.test_profiling:busy_loop')
+        for stack in busy_stacks)
+    assert sum(stacks[stack] for stack in busy_stacks) >= 10
+
+
+def test_profile_disabled(tmp_path):
+    with settings(PROFILE_RATE=1.):
+        with profile('disabled', forced=True):
+            busy_loop(0.01)
+    with settings(PROFILE_DIR=str(tmp_path)):
+        with profile('forced', forced=True):
+            busy_loop(0.01)
+    assert [f.split('-', 2)[2] for f in os.listdir(tmp_path)] == [
+        'forced.folded']
+
+
+def test_profile_one_at_a_time(tmp_path):
+    with settings(PROFILE_DIR=str(tmp_path), PROFILE_RATE=1.):
+        other = Profiler('other')
+        assert other.start()
+        with profile('skipped'):
+            busy_loop(0.01)
+        assert other.stop()
+        assert not profiling._active.locked()
+    assert len(os.listdir(tmp_path)) == 1
+
+
+def test_profiling_middleware(api, tmp_path):
+    with settings(PROFILE_DIR=str(tmp_path), PROFILE_TOKEN='secret'):
+        for token in ['nope', 'é']:
+            resp = api.simulate_get(
+                '/', headers={'X-Brightsky-Profile': token})
+            assert resp.status_code == 200
+            assert 'X-Brightsky-Profile' not in resp.headers
+        assert not os.listdir(tmp_path)
+        resp = api.simulate_get(
+            '/', headers={'X-Brightsky-Profile': 'secret'})
+        filename = resp.headers['X-Brightsky-Profile']
+        assert os.listdir(tmp_path) == [filename]
+        assert filename.endswith('-GET-.folded')
+        with settings(PROFILE_RATE=1.):
+            resp = api.simulate_get('/')
+        # Sampled requests are not told about their profile
+        assert 'X-Brightsky-Profile' not in resp.headers
+        assert len(os.listdir(tmp_path)) == 2
+    with settings(PROFILE_RATE=1., PROFILE_TOKEN='secret'):
+        resp = api.simulate_get(
+            '/', headers={'X-Brightsky-Profile': 'secret'})
+        assert 'X-Brightsky-Profile' not in resp.headers
@@ -0,0 +1,71 @@
+import datetime
+
+from dateutil.tz import tzutc
+
+from brightsky.export import DBExporter
+from brightsky.rollups import backfill_weather_daily
+
+
+SOURCE = {
+    'observation_type': 'historical',
+    'lat': 10.1,
+    'lon': 20.2,
+    'height': 30.3,
+    'wmo_station_id': '10001',
+    'dwd_station_id': 'XYZ',
+    'station_name': 'Münster',
+}
+
+
+def _records(hours, **fields):
+    return [
+        {
+            **SOURCE,
+            'timestamp': datetime.datetime(2020, 8, 18, tzinfo=tzutc()) + (
+                datetime.timedelta(hours=i)),
+            **fields,
+        }
+        for i in range(hours)
+    ]
+
+
+def _query_rollups(db):
+    return db.fetch('SELECT * FROM weather_daily ORDER BY day')
+
+
+def _clear_rollups(db):
+    with db.cursor() as cur:
+        cur.execute('DELETE FROM weather_daily')
+    db.commit()
+
+
+def test_export_updates_touched_days(db):
+    DBExporter().export(_records(30, temperature=280.5, precipitation=0.1))
+    rows = _query_rollups(db)
+    assert [r['day'] for r in rows] == [
+        datetime.date(2020, 8, 18), datetime.date(2020, 8, 19)]
+    assert [r['hours'] for r in rows] == [24, 6]
+    assert rows[0]['temperature_count'] == 24
+    assert float(rows[0]['temperature_sum']) == 24 * 280.5
+    assert float(rows[0]['precipitation_sum']) == 2.4
+    assert rows[0]['sunshine_count'] == 0
+    assert rows[0]['sunshine_sum'] is None
+    # Merging another parameter into existing records
+    DBExporter().export(_records(2, sunshine=600))
+    rows = _query_rollups(db)
+    assert rows[0]['hours'] == 24
+    assert rows[0]['sunshine_count'] == 2
+    assert rows[0]['sunshine_sum'] == 1200
+    assert rows[1]['sunshine_count'] == 0
+
+
+def test_backfill_weather_daily(db):
+    DBExporter().export(
+        _records(72, temperature=280.5, condition='dry', wind_speed=3.5))
+    expected = _query_rollups(db)
+    _clear_rollups(db)
+    backfill_weather_daily(chunk_days=2)
+    assert _query_rollups(db) == expected
+    _clear_rollups(db)
+    backfill_weather_daily(first_day=datetime.date(2020, 8, 19))
+    assert _query_rollups(db) == expected[1:]
@@ -0,0 +1,72 @@
+import datetime
+import random
+
+import pytest
+from dateutil.tz import tzutc
+
+from brightsky.query import _sources_cache, sources
+
+from .utils import settings
+
+
+@pytest.fixture
+def random_sources(db):
+    rnd = random.Random(0)
+    first_record = datetime.datetime(2020, 1, 1, tzinfo=tzutc())
+    db.insert('sources', [
+        {
+            'observation_type': rnd.choice(
+                ['historical', 'recent', 'current', 'forecast']),
+            'lat': rnd.uniform(47, 55),
+            'lon': rnd.uniform(5, 15),
+            'height': rnd.uniform(0, 1000),
+            'station_name': f'Station {i}',
+            'wmo_station_id': f'{i:05}',
+            'dwd_station_id': f'{i:05}',
+            'first_record': first_record,
+            'last_record': first_record + datetime.timedelta(
+                days=rnd.randint(0, 365)),
+        }
+        for i in range(1000)
+    ])
+    _sources_cache.clear()
+    yield rnd
+    _sources_cache.clear()
+
+
+def _sources(**kwargs):
+    try:
+        return sources(**kwargs)['sources']
+    except LookupError:
+        return []
+
+
+def test_sources_index_matches_sql(random_sources):
+    rnd = random_sources
+    date = datetime.datetime(2020, 6, 1, tzinfo=tzutc())
+    for _ in range(200):
+        kwargs = {
+            'lat': rnd.uniform(46, 56),
+            'lon': rnd.uniform(4, 16),
+            'max_dist': rnd.choice([5000, 25000, 50000, 200000]),
+            'observation_types': rnd.choice(
+                [None, ['recent', 'forecast']]),
+            'ignore_type': rnd.choice([False, True]),
+            'date': rnd.choice([None, date]),
+        }
+        expected = _sources(**kwargs)
+        with settings(SOURCES_INDEX=True):
+            assert _sources(**kwargs) == expected
+
+
+def test_sources_index_rebuild(random_sources, db):
+    with settings(SOURCES_INDEX=True, SOURCES_CACHE_CHECK_INTERVAL=0):
+        rows = _sources(lat=50, lon=10, max_dist=100000)
+        index = _sources_cache.index
+        assert _sources(lat=50, lon=10, max_dist=100000) == rows
+        assert _sources_cache.index is index
+        with db.cursor() as cur:
+            cur.execute("DELETE FROM sources WHERE id = %s", (rows[0]['id'],))
+        db.commit()
+        assert _sources(lat=50, lon=10, max_dist=100000) == rows[1:]
+        assert _sources_cache.index is not index
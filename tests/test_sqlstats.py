@@ -0,0 +1,117 @@
+import pytest
+
+from brightsky.db import fetch, get_connection
+from brightsky import sqlstats
+from brightsky.sqlstats import (
+    is_explainable, normalize, PERIOD, report, reset, sql_stats)
+
+from .utils import settings
+
+
+@pytest.fixture
+def stats():
+    sql_stats.clear()
+    with settings(SQL_STATS=True, SQL_STATS_FLUSH_INTERVAL=3600):
+        yield sql_stats.statements
+    sql_stats.clear()
+
+
+def test_normalize():
+    assert normalize(
+        "SELECT *\n  FROM weather WHERE source_id = ANY(%(ids)s) AND "
+        "timestamp > '2020-01-01' AND temperature < 3.5 AND x IS NULL"
+    ) == (
+        "SELECT * FROM weather WHERE source_id = ANY(?) AND timestamp > ? "
+        "AND temperature < ? AND x IS NULL")
+    assert normalize(
+        "INSERT INTO synop (precipitation_10, x) VALUES "
+        "(1, 'a'), (2, NULL), (3, 'it''s')"
+    ) == "INSERT INTO synop (precipitation_10, x) VALUES (?, ...), ..."
+    assert normalize('SELECT %s') == normalize('SELECT 1')
+
+
+def test_is_explainable():
+    assert is_explainable('SELECT 1')
+    assert is_explainable(' with x AS (SELECT 1) SELECT * FROM x')
+    assert not is_explainable('WITH x AS (DELETE FROM y) SELECT 1')
+    assert not is_explainable('UPDATE weather SET icon = NULL')
+    assert not is_explainable('REFRESH MATERIALIZED VIEW current_weather')
+
+
+def test_timing_cursor(db, stats):
+    fetch('SELECT * FROM sources WHERE id = %s', (1,))
+    fetch('SELECT * FROM sources WHERE id = %s', (2,))
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute('SELECT 1 AS one')
+            assert cur.fetchone()['one'] == 1
+    with settings(SQL_STATS=False):
+        fetch('SELECT 2')
+    assert list(stats) == [
+        'SELECT * FROM sources WHERE id = ?', 'SELECT ? AS one']
+    fetch_stats = stats['SELECT * FROM sources WHERE id = ?']
+    assert fetch_stats.count == 2
+    assert fetch_stats.total >= fetch_stats.max > 0
+    assert sum(fetch_stats.buckets) == 2
+    assert dict(fetch_stats.callers) == {
+        'tests.test_sqlstats.test_timing_cursor': 2}
+    assert stats['SELECT ? AS one'].rows == 1
+    assert all(s.plan is None for s in stats.values())
+
+
+def test_explain(db, stats):
+    with settings(SQL_EXPLAIN_THRESHOLD=1e-9):
+        with get_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute('SELECT * FROM sources WHERE id = %s', (1,))
+                cur.execute('SELECT * FROM sources WHERE id = %s', (2,))
+                # Not run again
+                cur.execute('DELETE FROM sources WHERE id = %s', (1,))
+                cur.execute('SELECT 1 AS one')
+                assert cur.fetchone()['one'] == 1
+    plan = stats['SELECT * FROM sources WHERE id = ?'].plan
+    assert 'Buffers' in plan and 'actual time' in plan
+    assert stats['DELETE FROM sources WHERE id = ?'].plan is None
+
+
+def test_report(db, stats, response_cache, monkeypatch):
+    period = sqlstats.current_period()
+    try:
+        # Statistics of different periods are merged as long as they are
+        # within the window
+        with settings(SQL_STATS_WINDOW=2 * PERIOD):
+            monkeypatch.setattr(
+                sqlstats, 'current_period', lambda: period - 2)
+            fetch('SELECT * FROM sources WHERE id = %s', (1,))
+            fetch('SELECT 2')
+            sql_stats.flush()
+            monkeypatch.setattr(
+                sqlstats, 'current_period', lambda: period - 1)
+            fetch('SELECT * FROM sources WHERE id = %s', (1,))
+            sql_stats.flush()
+            monkeypatch.setattr(sqlstats, 'current_period', lambda: period)
+            fetch('SELECT * FROM sources WHERE id = %s', (2,))
+            fetch('SELECT 1')
+            sql_stats.flush()
+            assert not stats
+            # Keys expire once they left the window, even if they're updated
+            for key in response_cache.keys(f'{sqlstats.KEY_PREFIX}*'):
+                assert 0 < response_cache.ttl(key) <= 3 * PERIOD
+            rows = {row['statement']: row for row in report(sort='count')}
+        row = rows['SELECT * FROM sources WHERE id = ?']
+        assert row['count'] == 2
+        assert row['mean'] == row['total'] / 2
+        assert row['total'] >= row['max'] > 0
+        assert row['p95'] >= row['max']
+        assert row['rows'] == 0
+        assert row['callers'] == ['tests.test_sqlstats.test_report']
+        assert rows['SELECT ?']['rows'] == 1
+        assert rows['SELECT ?']['count'] == 1
+        with settings(SQL_STATS_WINDOW=2 * PERIOD):
+            assert report(sort='count', limit=1) == [row]
+        rows = {row['statement']: row for row in report(sort='count')}
+        assert rows['SELECT * FROM sources WHERE id = ?']['count'] == 3
+        assert rows['SELECT ?']['count'] == 2
+    finally:
+        reset()
+    assert report() == []
@@ -0,0 +1,50 @@
+import datetime
+import math
+
+from astral import Observer
+from astral.sun import daylight
+from dateutil.tz import tzutc
+
+from brightsky.sun import sunrise_sunset, SunTable
+
+from .utils import settings
+
+
+def test_sunrise_sunset():
+    day = datetime.date(2020, 8, 18)
+    sunrise, sunset = sunrise_sunset(52, 7.6, day)
+    expected = daylight(Observer(52, 7.6), day)
+    assert (sunrise, sunset) == tuple(d.timestamp() for d in expected)
+
+
+def test_sunrise_sunset_polar():
+    assert sunrise_sunset(78, 15, datetime.date(2020, 6, 21)) == (
+        -math.inf, math.inf)
+    assert sunrise_sunset(78, 15, datetime.date(2020, 12, 21)) == (
+        math.inf, -math.inf)
+    assert sunrise_sunset(-78, 15, datetime.date(2020, 6, 21)) == (
+        math.inf, -math.inf)
+
+
+def test_sun_table_is_daytime():
+    table = SunTable()
+    source = {'id': 1, 'lat': 52, 'lon': 7.6}
+    polar = {'id': 2, 'lat': 78, 'lon': 15}
+    for hour, expected in [(3, False), (12, True), (21, False)]:
+        timestamp = datetime.datetime(2020, 8, 18, hour, tzinfo=tzutc())
+        assert table.is_daytime(source, timestamp) == expected
+    summer = datetime.datetime(2020, 6, 21, 0, tzinfo=tzutc())
+    winter = datetime.datetime(2020, 12, 21, 12, tzinfo=tzutc())
+    assert table.is_daytime(polar, summer)
+    assert not table.is_daytime(polar, winter)
+
+
+def test_sun_table_size():
+    table = SunTable()
+    sources = [{'id': i, 'lat': 52, 'lon': 7.6} for i in range(3)]
+    day = datetime.date(2020, 8, 18)
+    with settings(SUN_TABLE_SIZE=2):
+        for source in sources:
+            table.sunrise_sunset(source, day)
+        table.sunrise_sunset(sources[1], datetime.date(2021, 1, 1))
+    assert list(table.years) == [(2, 2020), (1, 2021)]
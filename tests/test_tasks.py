@@ -137,3 +137,23 @@ def test_clean_deletes_expired_recent_records(db):
     assert len(db.table('weather')) == 2
     rows = db.fetch('SELECT temperature FROM weather ORDER BY temperature')
     assert [r['temperature'] for r in rows] == [10., 30.]
+
+
+def test_clean_updates_daily_rollups(db):
+    now = datetime.datetime.utcnow().replace(
+        minute=0, second=0, microsecond=0, tzinfo=tzutc())
+    records = [
+        {
+            'observation_type': 'forecast',
+            'timestamp': now + datetime.timedelta(hours=i),
+            **PLACE,
+            'temperature': 10.,
+        }
+        for i in range(-72, 24)
+    ]
+    DBExporter().export(records)
+    clean()
+    rows = db.fetch('SELECT day, hours FROM weather_daily ORDER BY day')
+    first_record = db.fetch('SELECT min(timestamp) AS t FROM weather')[0]['t']
+    assert rows[0]['day'] == first_record.astimezone(tzutc()).date()
+    assert sum(r['hours'] for r in rows) == len(db.table('weather'))
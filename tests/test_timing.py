@@ -0,0 +1,94 @@
+import json
+import logging
+import re
+import time
+
+import pytest
+
+from brightsky.export import DBExporter
+from brightsky.timing import current_timer, server_timing, timed, Timer
+
+from .test_web import RECENT_RECORDS
+from .utils import settings
+
+
+def _phases(resp):
+    return {
+        name: float(duration)
+        for name, duration in re.findall(
+            r'(\w+);dur=([\d.]+)', resp.headers['Server-Timing'])
+    }
+
+
+def test_timed(monkeypatch):
+    with timed('query'):
+        pass
+    assert current_timer() is None
+    timer = Timer()
+    monkeypatch.setattr('brightsky.timing._local.timer', timer, raising=False)
+    for _ in range(2):
+        with timed('query'):
+            time.sleep(0.01)
+    with pytest.raises(ValueError):
+        with timed('icons'):
+            raise ValueError
+    assert list(timer.phases) == ['query', 'icons']
+    assert timer.phases['query'] >= 0.02
+    assert timer.total() >= timer.phases['query']
+
+
+def test_server_timing():
+    assert server_timing({'query': 0.01234, 'total': 0.1}) == (
+        'query;dur=12.3, total;dur=100.0')
+
+
+@pytest.mark.parametrize('config, phases', [
+    # Sources are resolved within the weather query
+    ({}, {'query', 'icons', 'units', 'encode', 'total'}),
+    ({'WEATHER_SQL_JSON': True}, {'sources', 'query', 'encode', 'total'}),
+    (
+        {'WEATHER_STREAMING_THRESHOLD': 1},
+        {'sources', 'query', 'total'},
+    ),
+])
+def test_server_timing_header(db, api, config, phases):
+    DBExporter().export(RECENT_RECORDS)
+    with settings(**config):
+        resp = api.simulate_get('/weather?lat=52&lon=7.6&date=2020-08-20')
+    assert resp.json['weather']
+    assert set(_phases(resp)) == phases
+    assert _phases(resp)['total'] >= _phases(resp)['query']
+    # The timer is not left behind for the streamed body
+    assert current_timer() is None
+    with settings(SERVER_TIMING=False):
+        resp = api.simulate_get('/weather?lat=52&lon=7.6&date=2020-08-20')
+    assert 'Server-Timing' not in resp.headers
+
+
+def test_server_timing_current_weather(db, api):
+    DBExporter().export(RECENT_RECORDS)
+    resp = api.simulate_get('/current_weather?lat=52&lon=7.6')
+    assert resp.status_code == 404
+    assert set(_phases(resp)) == {'sources', 'total'}
+
+
+def test_slow_request_log(db, api, caplog):
+    DBExporter().export(RECENT_RECORDS)
+    path = '/weather?lat=52&lon=7.6&date=2020-08-20'
+    caplog.set_level(logging.WARNING, logger='brightsky.timing')
+    with settings(SLOW_REQUEST_THRESHOLD=60.):
+        api.simulate_get(path)
+    assert not caplog.records
+    with settings(SERVER_TIMING=False, SLOW_REQUEST_THRESHOLD=1e-6):
+        resp = api.simulate_get(path)
+    assert 'Server-Timing' not in resp.headers
+    [record] = caplog.records
+    message = record.getMessage()
+    assert message.startswith('Slow request: ')
+    log = json.loads(message.split(': ', 1)[1])
+    assert log['method'] == 'GET'
+    assert log['path'] == '/weather'
+    assert log['query'] == 'lat=52&lon=7.6&date=2020-08-20'
+    assert log['status'] == 200
+    assert log['streamed'] is False
+    assert {'query', 'total'} <= set(log['phases'])
@@ -1,5 +1,22 @@
+import math
+
+import pytest
+
+from brightsky import units
 from brightsky.units import (
-    convert_record, synop_current_weather_code_to_condition)
+    COLUMN_CONVERTERS, convert_column, convert_columns, convert_record,
+    convert_records, synop_current_weather_code_to_condition)
+
+
+def _scan(mapping, code):
+    # Linear scan over the condition map, as the dense tables replace it
+    if code is None:
+        return
+    value = None
+    for k, v in mapping.items():
+        if k > code:
+            return value
+        value = v
 
 
 def test_synop_current_weather_code_to_condition():
@@ -60,3 +77,72 @@ def test_convert_record():
     }
     convert_record(record, 'dwd')
     assert record == expected
+
+
+@pytest.mark.parametrize('mapping, function', [
+    (
+        units.SYNOP_CURRENT_CONDITION_MAP,
+        units.synop_current_weather_code_to_condition,
+    ),
+    (
+        units.SYNOP_PAST_CONDITION_MAP,
+        units.synop_past_weather_code_to_condition,
+    ),
+    (
+        units.SYNOP_FORM_OF_PRECIPITATION_CONDITION_MAP,
+        units.synop_form_of_precipitation_code_to_condition,
+    ),
+    (
+        units.CURRENT_OBSERVATIONS_CONDITION_MAP,
+        units.current_observations_weather_code_to_condition,
+    ),
+])
+def test_condition_tables(mapping, function):
+    codes = [None, math.nan, *range(-3, 210)]
+    codes += [code + .5 for code in range(-3, 210)]
+    expected = [_scan(mapping, code) for code in codes]
+    assert [function(code) for code in codes] == expected
+    assert convert_column(codes, function) == expected
+
+
+@pytest.mark.parametrize('converter', [
+    *COLUMN_CONVERTERS,
+    *dict.fromkeys(units.CONVERTERS['dwd'].values()),
+])
+def test_convert_column(converter):
+    values = [None, 0, 1, 12.34, 88.8, 273.15, 1013.25, 3599.9, None, 200]
+    assert convert_column(values, converter) == [
+        None if v is None else converter(v) for v in values]
+    assert convert_column(iter(values), converter) == convert_column(
+        values, converter)
+    assert convert_column([], converter) == []
+
+
+def test_convert_records():
+    records = [
+        {'temperature': 290.15, 'wind_speed': None, 'icon': 'cloudy'},
+        {'temperature': None, 'wind_speed': 2.5, 'sunshine': 1800},
+        {'pressure_msl': 101325, 'dew_point': 285.96},
+        {},
+    ]
+    convert_records(records, 'dwd')
+    assert records == [
+        {'temperature': 17.0, 'wind_speed': None, 'icon': 'cloudy'},
+        {'temperature': None, 'wind_speed': 9.0, 'sunshine': 30.0},
+        {'pressure_msl': 1013.25, 'dew_point': 12.81},
+        {},
+    ]
+
+
+def test_convert_columns():
+    columns = {
+        'temperature': [290.15, None],
+        'wind_speed_10': [None, 2.5],
+        'condition': ['dry', None],
+    }
+    convert_columns(columns, 'dwd')
+    assert columns == {
+        'temperature': [17.0, None],
+        'wind_speed_10': [None, 9.0],
+        'condition': ['dry', None],
+    }
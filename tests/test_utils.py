@@ -3,8 +3,7 @@ import os
 import tempfile
 from dateutil.tz import tzoffset, tzutc
 
-from brightsky.utils import (
-    dwd_fingerprint, parse_date, StationIDConverter, sunrise_sunset)
+from brightsky.utils import dwd_fingerprint, parse_date, StationIDConverter
 
 
 def test_dwd_fingerprint(data_dir):
@@ -40,10 +39,3 @@ def test_station_id_converter(data_dir):
     assert c.convert_to_dwd('10315') == '01766'
     # Always use the last row for duplicated DWD IDs
     assert c.convert_to_wmo('05745') == 'F263'
-
-
-def test_sunrise_sunset():
-    sunrise, sunset = sunrise_sunset(52, 7.6, datetime.date(2020, 8, 18))
-    assert sunrise < sunset
-    assert sunrise.utcoffset().total_seconds() == 0
-    assert sunset.utcoffset().total_seconds() == 0
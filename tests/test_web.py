@@ -1,10 +1,18 @@
+import csv
 import datetime
+import io
+import json
+import math
 
 import pytest
-from dateutil.tz import tzutc
+from dateutil.tz import gettz, tzutc
 
 import brightsky
 from brightsky.export import DBExporter, SYNOPExporter
+from brightsky.query import _sources_cache, WEATHER_FIELDS
+from brightsky.sun import sun_table
+
+from .utils import settings
 
 
 SOURCES = [
@@ -194,6 +202,30 @@ SYNOP_RECORDS = [
 ]
 
 
+FALLBACK_SOURCE = {
+    'observation_type': 'recent',
+    'lat': 52.3,
+    'lon': 7.8,
+    'height': 50,
+    'station_name': 'Fallback',
+    'dwd_station_id': 'XXX',
+    'wmo_station_id': '01028',
+}
+FALLBACK_RECORDS = [
+    {
+        'timestamp': (
+            datetime.datetime(2020, 8, 20, tzinfo=tzutc())
+            + datetime.timedelta(hours=i)),
+        **source,
+        **ALL_FIELDS_RECORD,
+        'pressure_msl': (
+            None if source is SOURCES[2] and not i % 3 else 100000 + i),
+    }
+    for source in [SOURCES[2], FALLBACK_SOURCE]
+    for i in range(25)
+]
+
+
 @pytest.fixture
 def data(db):
     records = RECENT_RECORDS + CURRENT_RECORDS + FORECAST_RECORDS
@@ -205,6 +237,11 @@ def synop_data(db):
     SYNOPExporter().export(SYNOP_RECORDS)
 
 
+@pytest.fixture
+def fallback_data(db):
+    DBExporter().export(FALLBACK_RECORDS)
+
+
 def test_sources_required_parameters(data, api):
     assert api.simulate_get('/sources').status_code == 400
     assert api.simulate_get('/sources?lat=52').status_code == 400
@@ -364,6 +401,632 @@ def test_weather_icon(data, api):
         assert record['icon'] == condition['_expected_icon']
 
 
+def _clear_stored_icons(db):
+    with db.cursor() as cur:
+        cur.execute(
+            """
+            UPDATE weather SET icon = NULL;
+            UPDATE synop SET icon = NULL;
+            REFRESH MATERIALIZED VIEW current_weather;
+            """)
+    db.commit()
+
+
+@pytest.mark.parametrize('path', [
+    '/weather?lat=52&lon=7.6&date=2020-08-20',
+    '/weather?lat=52&lon=7.6&date=2020-08-20&layout=columns',
+    '/current_weather?lat=52&lon=7.6',
+    f'/synop?wmo_station_id=10315&date={SYNOP_NOW.date()}',
+])
+def test_weather_icon_stored(data, synop_data, api, db, path):
+    expected = api.simulate_get(path).json
+    _clear_stored_icons(db)
+    assert api.simulate_get(path).json == expected
+
+
+@pytest.mark.parametrize('config', [
+    {},
+    {'WEATHER_SQL_JSON': True},
+    {'WEATHER_STREAMING_THRESHOLD': 1, 'WEATHER_STREAMING_CHUNK_SIZE': 5},
+])
+def test_weather_icon_fallback(db, api, config):
+    # Stored icons of the primary source don't account for the cloud cover
+    # filled from the fallback source
+    timestamp = datetime.datetime(2020, 8, 20, 12, tzinfo=tzutc())
+    DBExporter().export([
+        {'timestamp': timestamp, **SOURCES[2], 'temperature': 290},
+        {
+            'timestamp': timestamp,
+            **FALLBACK_SOURCE,
+            **ALL_FIELDS_RECORD,
+            'condition': 'dry',
+            'precipitation': 0.,
+            'wind_speed': 1.,
+            'cloud_cover': 100,
+        },
+    ])
+    with settings(**config):
+        resp = api.simulate_get(
+            '/weather?lat=52&lon=7.6&date=2020-08-20T12:00%2b00:00'
+            '&last_date=2020-08-20T12:00%2b00:00')
+    assert resp.json['weather'][0]['fallback_source_ids']['cloud_cover'] == (
+        resp.json['sources'][1]['id'])
+    assert resp.json['weather'][0]['icon'] == 'cloudy'
+
+
+def test_weather_fallback(fallback_data, api):
+    resp = api.simulate_get('/weather?lat=52&lon=7.6&date=2020-08-20')
+    assert len(resp.json['sources']) == 2
+    primary_id, fallback_id = [s['id'] for s in resp.json['sources']]
+    for i, w in enumerate(resp.json['weather']):
+        assert w['source_id'] == primary_id
+        assert w['pressure_msl'] == (100000 + i) / 100
+        if i % 3:
+            assert 'fallback_source_ids' not in w
+        else:
+            assert w['fallback_source_ids'] == {'pressure_msl': fallback_id}
+
+
+@pytest.mark.parametrize('params', [
+    'lat=52&lon=7.6&date=2020-08-20',
+    'lat=52&lon=7.6&date=2020-08-20&units=si',
+    'lat=52&lon=7.6&date=2020-08-19&last_date=2020-08-23',
+    'lat=52&lon=7.6&date=2020-08-20&tz=Europe/Berlin',
+    'lat=52&lon=7.6&date=2020-08-20&tz=/usr/share/zoneinfo/Europe/Berlin',
+    'lat=52&lon=7.6&date=2020-08-20&tz=UTC%2b3',
+    'lat=52&lon=7.6&date=2020-08-20&tz=Etc/GMT%2b3',
+    'lat=52&lon=7.6&date=2020-08-20&tz=EST5EDT,M3.2.0,M11.1.0',
+    'lat=52&lon=7.6&date=2020-08-20T00:00:00%2b02:00&last_date=2020-08-22',
+    'lat=52&lon=7.6&date=2020-08-20T00:00:00-04:30',
+    'dwd_station_id=01766&date=2020-08-20',
+    'lat=52&lon=7.6&date=2019-08-20',
+])
+def test_weather_sql_json(data, fallback_data, api, params):
+    expected = api.simulate_get(f'/weather?{params}')
+    with settings(WEATHER_SQL_JSON=True):
+        resp = api.simulate_get(f'/weather?{params}')
+    assert resp.status_code == expected.status_code
+    # Including the number formatting, e.g. 30.0 rather than 30
+    assert resp.content == expected.content
+
+
+@pytest.mark.parametrize('path', [
+    '/weather?lat=52&lon=7.6&date=2020-08-20',
+    '/weather/aggregate?lat=52&lon=7.6&date=2020-08-19',
+])
+def test_timezone_unknown_to_postgres(data, api, path):
+    # Accepted by dateutil, but not by Postgres
+    if gettz('posixrules') is None:
+        pytest.skip('posixrules is not in the time zone database')
+    with settings(WEATHER_SQL_JSON=True):
+        resp = api.simulate_get(f'{path}&tz=posixrules')
+    assert resp.status_code == 400
+
+
+def test_weather_sql_json_icons_by_utc_day(db, api, monkeypatch):
+    # Daytime all day on even UTC days, nighttime all day on odd ones
+    def sunrise_sunset(source, day):
+        if day.toordinal() % 2:
+            return math.inf, -math.inf
+        return -math.inf, math.inf
+
+    monkeypatch.setattr(sun_table, 'sunrise_sunset', sunrise_sunset)
+    # Independent of the database session's time zone
+    fetch = brightsky.query.fetch
+    monkeypatch.setattr(
+        brightsky.query, 'fetch',
+        lambda sql, *args, **kwargs: fetch(
+            f"SET LOCAL TIME ZONE 'Europe/Berlin'; {sql}", *args, **kwargs))
+    start = datetime.datetime(2020, 8, 20, tzinfo=tzutc())
+    # Icons are derived from the fallback source's cloud cover
+    DBExporter().export([
+        {
+            'timestamp': start + datetime.timedelta(hours=i),
+            **source,
+            **ALL_FIELDS_RECORD,
+            'condition': 'dry',
+            'precipitation': 0.,
+            'wind_speed': 1.,
+            'cloud_cover': None if source is SOURCES[2] else 0,
+        }
+        for source in [SOURCES[2], FALLBACK_SOURCE]
+        for i in range(36)
+    ])
+    params = (
+        'lat=52&lon=7.6&date=2020-08-20T12:00&last_date=2020-08-21T06:00'
+        '&tz=Europe/Berlin')
+    expected = api.simulate_get(f'/weather?{params}')
+    assert {r['icon'] for r in expected.json['weather']} == {
+        'clear-day', 'clear-night'}
+    with settings(WEATHER_SQL_JSON=True):
+        resp = api.simulate_get(f'/weather?{params}')
+    assert resp.content == expected.content
+
+
+def _project(record, fields):
+    projected = {
+        k: v for k, v in record.items()
+        if k in ['timestamp', 'source_id', *fields]}
+    fallback_source_ids = {
+        k: v for k, v in record.get('fallback_source_ids', {}).items()
+        if k in fields}
+    if fallback_source_ids:
+        projected['fallback_source_ids'] = fallback_source_ids
+    return projected
+
+
+@pytest.mark.parametrize('fields', [
+    'temperature',
+    'icon',
+    'temperature,icon,wind_gust_speed',
+    'pressure_msl,condition,relative_humidity',
+])
+@pytest.mark.parametrize('config', [
+    {},
+    {'WEATHER_SQL_JSON': True},
+    {'WEATHER_STREAMING_THRESHOLD': 1, 'WEATHER_STREAMING_CHUNK_SIZE': 5},
+])
+def test_weather_fields(data, fallback_data, api, fields, config):
+    params = 'lat=52&lon=7.6&date=2020-08-20&tz=Europe/Berlin'
+    expected = api.simulate_get(f'/weather?{params}').json['weather']
+    with settings(**config):
+        resp = api.simulate_get(f'/weather?{params}&fields={fields}')
+    assert resp.status_code == 200
+    fields = fields.split(',')
+    assert resp.json['weather'] == [_project(r, fields) for r in expected]
+
+
+def test_weather_fields_invalid(data, api):
+    resp = api.simulate_get(
+        '/weather?lat=52&lon=7.6&date=2020-08-20&fields=temperature,temp')
+    assert resp.status_code == 400
+    resp = api.simulate_get(
+        '/current_weather?lat=52&lon=7.6&fields=precipitation')
+    assert resp.status_code == 400
+
+
+@pytest.mark.parametrize('params', [
+    'lat=52&lon=7.6&date=2020-08-20',
+    'lat=52&lon=7.6&date=2020-08-19&last_date=2020-08-23&units=si',
+    'dwd_station_id=01766&date=2020-08-20&tz=Europe/Berlin',
+    'lat=52&lon=7.6&date=2020-08-20&fields=temperature,icon',
+])
+def test_weather_columns(data, fallback_data, api, params):
+    expected = api.simulate_get(f'/weather?{params}').json
+    resp = api.simulate_get(f'/weather?{params}&layout=columns')
+    assert resp.status_code == 200
+    assert resp.json['sources'] == expected['sources']
+    columns = resp.json['weather']
+    assert set(columns) == {
+        'fallback_source_ids',
+        *(k for row in expected['weather'] for k in row)}
+    for i, row in enumerate(expected['weather']):
+        assert {k: v[i] for k, v in columns.items()} == {
+            'fallback_source_ids': None, **row}
+
+
+def test_weather_columns_parameters(data, api):
+    resp = api.simulate_get(
+        '/weather?lat=52&lon=7.6&date=2020-08-20&layout=grid')
+    assert resp.status_code == 400
+    resp = api.simulate_get(
+        f"/synop?wmo_station_id={SYNOP_SOURCE['wmo_station_id']}&"
+        f"date=2020-08-20&layout=columns")
+    assert resp.status_code == 400
+
+
+@pytest.mark.parametrize('path', [
+    '/weather?lat=52&lon=7.6&date=2020-08-20&tz=Europe/Berlin',
+    '/weather?lat=52&lon=7.6&date=2020-08-20&fields=temperature,icon',
+    '/weather/aggregate?lat=52&lon=7.6&date=2020-08-19&last_date=2020-08-22',
+    '/current_weather?lat=52&lon=7.6',
+    f"/synop?wmo_station_id={SYNOP_SOURCE['wmo_station_id']}&date=2020-08-20",
+    '/sources?lat=52&lon=7.6',
+])
+def test_formats(data, fallback_data, synop_data, api, path):
+    msgpack = pytest.importorskip('msgpack')
+    expected = api.simulate_get(path).json
+    if 'sources' in path:
+        rows = expected['sources']
+    elif isinstance(expected['weather'], dict):
+        rows = [expected['weather']]
+    else:
+        rows = expected['weather']
+    resp = api.simulate_get(path, headers={'Accept': 'application/msgpack'})
+    assert resp.status_code == 200
+    assert resp.headers['Content-Type'] == 'application/msgpack'
+    assert resp.headers['Vary'] == 'Accept, Accept-Encoding'
+    assert msgpack.unpackb(resp.content) == expected
+    resp = api.simulate_get(f'{path}&format=csv')
+    assert resp.status_code == 200
+    assert resp.headers['Content-Type'].startswith('text/csv')
+    records = list(csv.DictReader(io.StringIO(resp.text)))
+    assert len(records) == len(rows)
+    for record, row in zip(records, rows):
+        assert record['timestamp' if 'timestamp' in row else 'id'] == str(
+            row.get('timestamp', row.get('id')))
+
+
+def test_formats_arrow(data, fallback_data, api):
+    pa = pytest.importorskip('pyarrow')
+    path = '/weather?lat=52&lon=7.6&date=2020-08-20&tz=Europe/Berlin'
+    expected = api.simulate_get(path).json
+    resp = api.simulate_get(
+        path, headers={'Accept': 'application/vnd.apache.arrow.stream'})
+    assert resp.status_code == 200
+    table = pa.ipc.open_stream(resp.content).read_all()
+    assert table.schema.field('timestamp').type == pa.timestamp(
+        's', tz='Europe/Berlin')
+    assert table.schema.field('temperature').type == pa.float32()
+    assert table.schema.field('wind_direction').type == pa.int16()
+    assert pa.types.is_dictionary(table.schema.field('icon').type)
+    assert json.loads(table.schema.metadata[b'sources']) == (
+        expected['sources'])
+    assert table.num_rows == len(expected['weather'])
+    for record, row in zip(table.to_pylist(), expected['weather']):
+        assert record['timestamp'].isoformat() == row['timestamp']
+        assert record['source_id'] == row['source_id']
+        assert record['icon'] == row['icon']
+        assert record['temperature'] == pytest.approx(row['temperature'])
+
+
+@pytest.mark.parametrize('path', [
+    '/weather/aggregate?lat=52&lon=7.6&date=2020-08-19&tz=Europe/Berlin',
+    '/weather/batch?lat=52&lon=7.6&date=2020-08-20',
+    '/current_weather?lat=52&lon=7.6',
+])
+def test_formats_arrow_timestamps(data, synop_data, api, path):
+    pa = pytest.importorskip('pyarrow')
+    expected = api.simulate_get(f'{path}&format=csv')
+    resp = api.simulate_get(f'{path}&format=arrow')
+    assert resp.status_code == 200
+    table = pa.ipc.open_stream(resp.content).read_all()
+    timestamps = [
+        record['timestamp']
+        for record in csv.DictReader(io.StringIO(expected.text))]
+    assert timestamps
+    assert [
+        timestamp.isoformat()
+        for timestamp in table.column('timestamp').to_pylist()
+    ] == timestamps
+
+
+def test_formats_parameters(data, api):
+    resp = api.simulate_get(
+        '/weather?lat=52&lon=7.6&date=2020-08-20&format=xml')
+    assert resp.status_code == 400
+    # Unsupported formats fall back to JSON
+    resp = api.simulate_get(
+        '/weather?lat=52&lon=7.6&date=2020-08-20',
+        headers={'Accept': 'image/png'})
+    assert resp.status_code == 200
+    assert resp.json['weather']
+
+
+@pytest.fixture
+def sources_cache():
+    _sources_cache.clear()
+    with settings(SOURCES_CACHE_SIZE=100, SOURCES_CACHE_CHECK_INTERVAL=0):
+        yield _sources_cache
+    _sources_cache.clear()
+
+
+@pytest.mark.parametrize('path', [
+    '/sources?lat=52&lon=7.6',
+    '/sources?lat=52&lon=7.6&max_dist=5000',
+    '/sources?dwd_station_id=01766',
+    '/sources?lat=0&lon=0',
+    '/weather?lat=52&lon=7.6&date=2020-08-20',
+    '/weather?lat=52&lon=7.6&date=2020-08-19&last_date=2020-08-23',
+    '/weather?dwd_station_id=01766&date=2020-08-20',
+    '/weather?lat=52&lon=7.6&date=2019-08-20',
+])
+def test_sources_cache(data, fallback_data, api, sources_cache, path):
+    with settings(SOURCES_CACHE_SIZE=0):
+        expected = api.simulate_get(path)
+    for _ in range(2):
+        resp = api.simulate_get(path)
+        assert resp.status_code == expected.status_code
+        assert resp.json == expected.json
+    assert len(sources_cache.entries) == 1
+
+
+@pytest.mark.parametrize('path', [
+    '/sources?lat=52.04&lon=7.61',
+    # Only some of the sources within the extended distance of the cell
+    '/sources?lat=52.04&lon=7.61&max_dist=16000',
+    '/sources?lat=52.24&lon=7.74&max_dist=16000',
+    '/weather?lat=52.04&lon=7.61&date=2020-08-20&max_dist=16000',
+])
+def test_sources_cache_grid(data, fallback_data, api, sources_cache, path):
+    expected = api.simulate_get(path)
+    with settings(SOURCES_CACHE_GRID=0.5):
+        resp = api.simulate_get(path)
+    assert resp.status_code == expected.status_code
+    assert resp.json == expected.json
+
+
+def test_sources_cache_invalidation(data, api, sources_cache):
+    resp = api.simulate_get('/sources?lat=52&lon=7.6')
+    assert len(resp.json['sources']) == 3
+    with settings(SOURCES_CACHE_CHECK_INTERVAL=3600):
+        DBExporter().export(FALLBACK_RECORDS)
+        resp = api.simulate_get('/sources?lat=52&lon=7.6')
+        assert len(resp.json['sources']) == 3
+    resp = api.simulate_get('/sources?lat=52&lon=7.6')
+    assert len(resp.json['sources']) == 4
+
+
+@pytest.mark.parametrize('path', [
+    '/sources?lat=52&lon=7.6',
+    '/weather?lat=52&lon=7.6&date=2020-08-19&last_date=2020-08-23',
+])
+def test_sources_index(data, fallback_data, api, path):
+    expected = api.simulate_get(path)
+    _sources_cache.clear()
+    with settings(SOURCES_INDEX=True):
+        resp = api.simulate_get(path)
+    _sources_cache.clear()
+    assert resp.json == expected.json
+
+
+@pytest.mark.parametrize('params', [
+    'date=2020-08-20',
+    'date=2020-08-19&last_date=2020-08-23&units=si',
+    'date=2020-08-20&tz=Europe/Berlin&max_dist=20000',
+    'date=2019-08-20',
+])
+def test_weather_batch(data, fallback_data, api, params):
+    locations = [(52, 7.6), (52.3, 7.8), (52.1, 7.65), (0, 0)]
+    lats = ','.join(str(lat) for lat, _ in locations)
+    lons = ','.join(str(lon) for _, lon in locations)
+    resp = api.simulate_get(f'/weather/batch?lat={lats}&lon={lons}&{params}')
+    assert resp.status_code == 200
+    results = resp.json['locations']
+    assert len(results) == len(locations)
+    for (lat, lon), result in zip(locations, results):
+        assert (result['lat'], result['lon']) == (lat, lon)
+        expected = api.simulate_get(f'/weather?lat={lat}&lon={lon}&{params}')
+        if expected.status_code == 404:
+            assert result['weather'] == result['sources'] == []
+        else:
+            assert result['weather'] == expected.json['weather']
+            assert result['sources'] == expected.json['sources']
+    with settings(SOURCES_INDEX=True):
+        indexed = api.simulate_get(
+            f'/weather/batch?lat={lats}&lon={lons}&{params}')
+    _sources_cache.clear()
+    assert indexed.json == resp.json
+
+
+def test_weather_batch_post(data, api):
+    resp = api.simulate_get(
+        '/weather/batch?lat=52&lat=52.1&lon=7.6&lon=7.7&date=2020-08-20')
+    post_resp = api.simulate_post('/weather/batch', json={
+        'lat': [52, 52.1],
+        'lon': [7.6, 7.7],
+        'date': '2020-08-20',
+    })
+    assert post_resp.status_code == 200
+    assert post_resp.json == resp.json
+    assert api.simulate_post('/weather/batch', json=[]).status_code == 400
+
+
+def test_weather_batch_required_parameters(data, api):
+    path = '/weather/batch?date=2020-08-20'
+    assert api.simulate_get(path).status_code == 400
+    assert api.simulate_get(f'{path}&lat=52').status_code == 400
+    assert api.simulate_get(f'{path}&lat=52&lon=7.6,7.7').status_code == 400
+    assert api.simulate_get(f'{path}&lat=91&lon=7.6').status_code == 400
+    assert api.simulate_get(f'{path}&lat=nan&lon=7.6').status_code == 400
+    with settings(WEATHER_BATCH_MAX_LOCATIONS=1):
+        assert api.simulate_get(
+            f'{path}&lat=52,52&lon=7.6,7.6').status_code == 400
+
+
+@pytest.mark.parametrize('params', [
+    'lat=52&lon=7.6&date=2020-08-20',
+    'lat=52&lon=7.6&date=2020-08-19&last_date=2020-08-23&units=si',
+    'lat=52&lon=7.6&date=2020-08-20&tz=Europe/Berlin',
+    'dwd_station_id=01766&date=2020-08-20',
+])
+def test_weather_streaming(data, fallback_data, api, params):
+    expected = api.simulate_get(f'/weather?{params}')
+    with settings(
+            WEATHER_STREAMING_THRESHOLD=1, WEATHER_STREAMING_CHUNK_SIZE=5):
+        resp = api.simulate_get(f'/weather?{params}')
+    assert resp.status_code == 200
+    assert resp.json == expected.json
+
+
+def test_weather_streaming_no_sources(data, api):
+    with settings(WEATHER_STREAMING_THRESHOLD=1):
+        resp = api.simulate_get('/weather?lat=0&lon=0&date=2020-08-20')
+    assert resp.status_code == 404
+
+
+@pytest.mark.parametrize('tz', [None, 'Europe/Berlin', 'UTC%2b3'])
+def test_weather_aggregate(data, fallback_data, api, tz):
+    params = 'lat=52&lon=7.6&date=2020-08-19&last_date=2020-08-22&units=si'
+    if tz:
+        params += f'&tz={tz}'
+    resp = api.simulate_get(f'/weather/aggregate?{params}')
+    assert resp.status_code == 200
+    hourly_resp = api.simulate_get(f'/weather?{params}')
+    hourly = hourly_resp.json['weather'][:-1]
+    days = {}
+    for record in hourly:
+        days.setdefault(record['timestamp'][:10], []).append(record)
+    assert [r['timestamp'][:10] for r in resp.json['weather']] == list(days)
+    for record, day in zip(resp.json['weather'], days.values()):
+        assert record['timestamp'][11:19] == '00:00:00'
+        temperatures = [r['temperature'] for r in day]
+        assert record['temperature_min'] == min(temperatures)
+        assert record['temperature_max'] == max(temperatures)
+        assert record['temperature'] == pytest.approx(
+            sum(temperatures) / len(temperatures), abs=0.01)
+        precipitation = [
+            r['precipitation'] for r in day if r['precipitation'] is not None]
+        if precipitation:
+            assert record['precipitation'] == pytest.approx(
+                sum(precipitation))
+    assert resp.json['sources'] == hourly_resp.json['sources']
+
+
+def test_weather_aggregate_semantics(db, api):
+    records = [
+        {
+            'timestamp': datetime.datetime(2020, 8, 20, tzinfo=tzutc()) + (
+                datetime.timedelta(hours=i)),
+            **SOURCES[2],
+            'wind_direction': [350, 10, 20][i % 3],
+            'wind_gust_speed': float(i),
+            'wind_gust_direction': i,
+            'condition': 'rain' if i < 10 else 'dry',
+            'sunshine': 600,
+        }
+        for i in range(48)
+    ]
+    DBExporter().export(records)
+    resp = api.simulate_get(
+        '/weather/aggregate?lat=52&lon=7.6&date=2020-08-01&resolution=month')
+    assert len(resp.json['weather']) == 1
+    record = resp.json['weather'][0]
+    assert record['timestamp'] == '2020-08-01T00:00:00+00:00'
+    assert record['wind_direction'] == 7
+    assert record['wind_gust_speed'] == 169.2
+    assert record['wind_gust_direction'] == 47
+    assert record['condition'] == 'dry'
+    assert record['sunshine'] == 48 * 10
+    assert api.simulate_get(
+        '/weather/aggregate?lat=52&lon=7.6&date=2020-08-01&resolution=year'
+    ).status_code == 400
+
+
+@pytest.mark.parametrize('resolution', ['day', 'month'])
+def test_weather_aggregate_rollups(db, api, resolution):
+    records = [
+        {
+            'timestamp': datetime.datetime(2020, 8, 20, tzinfo=tzutc()) + (
+                datetime.timedelta(hours=i)),
+            **SOURCES[2],
+            'temperature': 280. + (i * 7 % 13) / 4,
+            'precipitation': None if i % 5 else i / 10,
+            'pressure_msl': 100000 + 10 * i,
+            'wind_direction': [350, 10, 20][i % 3],
+            'wind_gust_speed': float(i * 7 % 72),
+            'wind_gust_direction': i,
+            'condition': ['rain', 'dry', 'fog'][i % 24 // 8],
+            'sunshine': 600,
+        }
+        for i in range(72)
+    ]
+    DBExporter().export(records)
+    params = (
+        f'lat=52&lon=7.6&date=2020-08-01&last_date=2020-09-01'
+        f'&resolution={resolution}')
+    resp = api.simulate_get(f'/weather/aggregate?{params}')
+    with settings(WEATHER_AGGREGATE_ROLLUPS=True):
+        rollups_resp = api.simulate_get(f'/weather/aggregate?{params}')
+    assert rollups_resp.status_code == 200
+    assert len(rollups_resp.json['weather']) == (
+        3 if resolution == 'day' else 1)
+    assert rollups_resp.json == resp.json
+
+
+def _full_records(source, start, hours, offset=0):
+    return [
+        {
+            'timestamp': start + datetime.timedelta(hours=i),
+            **source,
+            'cloud_cover': (i * 3 + offset) % 100,
+            'condition': ['dry', 'rain'][(i + offset) % 7 // 5],
+            'dew_point': 275. + (i * 5 % 11) / 4,
+            'precipitation': (i + offset) % 4 / 10,
+            'pressure_msl': 100000 + 10 * i + offset,
+            'sunshine': (i * 17 + offset) % 60,
+            'temperature': 280. + (i * 7 % 13) / 4 + offset,
+            'visibility': 10000 + 100 * i,
+            'wind_direction': (i * 40 + offset) % 360,
+            'wind_speed': 3. + (i % 5) / 2,
+            'wind_gust_speed': 5. + (i * 3 % 7),
+        }
+        for i in range(hours)
+    ]
+
+
+@pytest.mark.parametrize('resolution', ['day', 'month'])
+def test_weather_aggregate_rollups_partial_days(db, api, resolution):
+    start = datetime.datetime(2020, 8, 19, tzinfo=tzutc())
+    recent = _full_records(SOURCES[2], start, 58)
+    # Filled from the current source
+    recent[30]['pressure_msl'] = None
+    DBExporter().export(
+        recent +
+        _full_records(SOURCES[1], start + datetime.timedelta(days=1), 24, 5) +
+        # Starts within the last day of the recent records
+        _full_records(SOURCES[0], start + datetime.timedelta(days=2), 48, 9))
+    params = (
+        f'lat=52&lon=7.6&date=2020-08-19&last_date=2020-08-23'
+        f'&resolution={resolution}')
+    resp = api.simulate_get(f'/weather/aggregate?{params}')
+    assert resp.status_code == 200
+    assert len(resp.json['weather']) == (4 if resolution == 'day' else 1)
+    with settings(WEATHER_AGGREGATE_ROLLUPS=True):
+        rollups_resp = api.simulate_get(f'/weather/aggregate?{params}')
+    assert rollups_resp.json == resp.json
+
+
+def test_weather_snapshot(data, api):
+    params = 'bbox=7,51,8,53&date=2020-08-21T12:00:00%2B02:00'
+    resp = api.simulate_get(f'/weather/snapshot?{params}&units=si')
+    assert resp.status_code == 200
+    weather = resp.json['weather']
+    sources = resp.json['sources']
+    assert sources['observation_type'] == ['current', 'forecast']
+    assert weather['source_id'] == sources['id']
+    assert weather['timestamp'] == ['2020-08-21T12:00:00+02:00'] * 2
+    assert weather['temperature'] == [222, 302]
+    assert set(weather) == {'source_id', 'timestamp', *WEATHER_FIELDS}
+    resp = api.simulate_get(
+        f'/weather/snapshot?{params}&fields=temperature,condition&tz=UTC')
+    assert resp.json['weather'] == {
+        'source_id': sources['id'],
+        'timestamp': ['2020-08-21T10:00:00+00:00'] * 2,
+        'temperature': [-51.15, 28.85],
+        'condition': [None, None],
+    }
+    resp = api.simulate_get(
+        '/weather/snapshot?bbox=8,51,9,53&date=2020-08-21T10:00')
+    assert resp.status_code == 200
+    assert resp.json['sources']['id'] == []
+    assert resp.json['weather']['temperature'] == []
+
+
+def test_weather_snapshot_current_weather(synop_data, api):
+    resp = api.simulate_get('/weather/snapshot?bbox=7,51,8,53')
+    assert resp.status_code == 200
+    current_resp = api.simulate_get('/current_weather?lat=52&lon=7.6')
+    assert resp.json['sources']['id'] == [
+        current_resp.json['sources'][0]['id']]
+    for field in ['timestamp', 'temperature', 'precipitation_60']:
+        assert resp.json['weather'][field] == [
+            current_resp.json['weather'][field]]
+
+
+def test_weather_snapshot_parameters(data, api):
+    for params in [
+            '',
+            'bbox=7,51,8',
+            'bbox=7,91,8,92',
+            'bbox=8,51,7,53',
+            'bbox=7,51,8,53&date=yesterday',
+            'bbox=7,51,8,53&date=2020-08-21&fields=temperature,temp',
+            'bbox=7,51,8,53&fields=precipitation']:
+        resp = api.simulate_get(f'/weather/snapshot?{params}')
+        assert resp.status_code == 400, params
+
+
 def test_synop_disallows_lat_lon(data, api):
     resp = api.simulate_get(
         '/synop',
@@ -433,6 +1096,119 @@ def test_current_weather_response(synop_data, api, db):
         assert resp.json['weather'][k] == v, k
 
 
+@pytest.mark.parametrize('fields', [
+    'temperature,sunshine_60',
+    'icon',
+    'cloud_cover,icon',
+])
+def test_current_weather_fields(synop_data, api, fields):
+    expected = api.simulate_get('/current_weather?lat=52&lon=7.6').json
+    resp = api.simulate_get(f'/current_weather?lat=52&lon=7.6&fields={fields}')
+    assert resp.status_code == 200
+    assert resp.json['weather'] == _project(
+        expected['weather'], fields.split(','))
+
+
+@pytest.mark.parametrize('path', [
+    '/weather?lat=52&lon=7.6&date=2020-08-20',
+    '/current_weather?lat=52&lon=7.6',
+    f"/synop?wmo_station_id={SYNOP_SOURCE['wmo_station_id']}"
+    f"&date={SYNOP_NOW.date().isoformat()}",
+    '/sources?lat=52&lon=7.6',
+])
+def test_conditional_get(data, synop_data, api, path):
+    resp = api.simulate_get(path)
+    assert resp.status_code == 200
+    etag = resp.headers['ETag']
+    last_modified = resp.headers['Last-Modified']
+    assert resp.headers['Cache-Control'].startswith('max-age=')
+    for headers in [
+            {'If-None-Match': etag},
+            {'If-None-Match': f'"other", {etag}'},
+            {'If-Modified-Since': last_modified}]:
+        resp = api.simulate_get(path, headers=headers)
+        assert resp.status_code == 304
+        assert not resp.content
+        assert resp.headers['ETag'] == etag
+    resp = api.simulate_get(path, headers={'If-None-Match': '"other"'})
+    assert resp.status_code == 200
+    assert api.simulate_get(
+        f'{path}&units=si', headers={'If-None-Match': etag}
+    ).status_code == 200
+    # New records for any of the sources change the validators
+    DBExporter().export(RECENT_RECORDS[-1:])
+    SYNOPExporter().export(SYNOP_RECORDS[-1:])
+    resp = api.simulate_get(path, headers={'If-None-Match': etag})
+    assert resp.status_code == 200
+    assert resp.headers['ETag'] != etag
+
+
+def _count_queries(monkeypatch):
+    queries = []
+    fetch = brightsky.query.fetch
+    monkeypatch.setattr(
+        brightsky.query, 'fetch',
+        lambda *args, **kwargs: queries.append(args) or fetch(*args, **kwargs))
+    return queries
+
+
+@pytest.mark.parametrize('config,expected_queries', [
+    # Sources, records and validators in one statement
+    ({}, 1),
+    # The sun parameters and the streamed records need the sources first
+    ({'WEATHER_SQL_JSON': True}, 2),
+    ({'WEATHER_STREAMING_THRESHOLD': 1, 'WEATHER_STREAMING_CHUNK_SIZE': 5}, 2),
+])
+@pytest.mark.parametrize('params', ['', '&layout=columns'])
+def test_weather_validators_lookups(
+        data, api, monkeypatch, config, expected_queries, params):
+    if params and config:
+        expected_queries = 1
+    queries = _count_queries(monkeypatch)
+    path = f'/weather?lat=52&lon=7.6&date=2020-08-20{params}'
+    with settings(**config):
+        resp = api.simulate_get(path)
+        assert resp.status_code == 200
+        assert len(queries) == expected_queries
+        queries.clear()
+        resp = api.simulate_get(
+            path, headers={'If-None-Match': resp.headers['ETag']})
+    assert resp.status_code == 304
+    # Sources and validators only
+    assert len(queries) == 2
+
+
+@pytest.mark.parametrize('path,expected_queries', [
+    # Current weather and validators, and fallback
+    ('/current_weather?lat=52&lon=7.6', 3),
+    (f"/synop?wmo_station_id={SYNOP_SOURCE['wmo_station_id']}"
+     f"&date={SYNOP_NOW.date().isoformat()}", 2),
+])
+def test_synop_validators_lookups(
+        synop_data, api, monkeypatch, path, expected_queries):
+    queries = _count_queries(monkeypatch)
+    resp = api.simulate_get(path)
+    assert resp.status_code == 200
+    assert len(queries) == expected_queries
+    queries.clear()
+    resp = api.simulate_get(
+        path, headers={'If-None-Match': resp.headers['ETag']})
+    assert resp.status_code == 304
+    assert len(queries) == 2
+
+
+def test_cache_control(data, api):
+    resp = api.simulate_get('/weather?lat=52&lon=7.6&date=2020-08-20')
+    recent_source_id = next(
+        s['id']
+        for s in api.simulate_get('/sources?lat=52&lon=7.6').json['sources']
+        if s['observation_type'] == 'recent')
+    recent_resp = api.simulate_get(
+        f'/weather?source_id={recent_source_id}&date=2020-08-20')
+    assert recent_resp.headers['Cache-Control'] == 'max-age=900'
+    assert int(resp.headers['Cache-Control'][8:]) <= 300
+
+
 def test_status_response(api):
     resp = api.simulate_get('/')
     assert resp.status_code == 200